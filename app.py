@@ -1,31 +1,265 @@
 import streamlit as st
-import psycopg2
 import pandas as pd
-import hashlib
+import secrets
+import json
 import uuid
 import urllib.parse
 from datetime import datetime
+from contextlib import contextmanager, nullcontext
 import plotly.express as px
+import db
+import budgets
+import outbox
+import archive
+import worklists
+import pivot
+import offline_queue
+import cards
+import auth
+import jobs
+import scoring
+import prepared
+import group_commit
+import prefetch
+import memory
+import trends
 
 # ================== CONFIG ================== #
 
 st.set_page_config(page_title="OphthalmoAI SaaS", layout="wide")
 
+# ================== SESSION RESTORE ================== #
+
+@st.cache_resource
+def process_secret():
+    return secrets.token_hex(32)
+
+
+# Without a configured secret, tokens still survive reconnects but not a
+# server restart.
+SESSION_SECRET = st.secrets.get("SESSION_SECRET") or process_secret()
+
+
+def start_session(user_id, role, hospital_id, username):
+    st.session_state.login = True
+    st.session_state.user_id = user_id
+    st.session_state.role = role
+    st.session_state.hospital_id = hospital_id
+    st.session_state.username = username
+
+
+# A reconnecting tab carries its signed token in the URL; restoring from it
+# needs neither a login nor a users query.
+if not st.session_state.get("login"):
+    claims = auth.read_token(st.query_params.get(auth.TOKEN_PARAM), SESSION_SECRET)
+    if claims:
+        start_session(claims["uid"], claims["role"], claims["hid"], claims["name"])
+        st.session_state.session_id = claims.get("sid")
+        st.session_state.session_checked = False
+
+
 # ================== DATABASE ================== #
 
 DB_URL = st.secrets["DB_URL"]
 
+# Queue Save Patient / Convert locally and sync in the background.
+OFFLINE_QUEUE = bool(st.secrets.get("OFFLINE_QUEUE", False))
+
+@st.cache_resource
+def session_pool():
+    return prepared.SessionPool(lambda: db.connect(DB_URL, budgets.APP_STATEMENT_TIMEOUT_MS))
+
+
+# Each browser session keeps one leased connection across reruns, so hot
+# statements stay prepared on it (see prepared.py).
+if "session_key" not in st.session_state:
+    st.session_state.session_key = uuid.uuid4().hex
+
+
+def lease_connection(fresh=False):
+    conn = session_pool().get(st.session_state.session_key, fresh)
+    conn.rollback()
+    return conn
+
+
 try:
-    conn = psycopg2.connect(
-        DB_URL,
-        sslmode="require",
-        connect_timeout=10
-    )
+    try:
+        conn = lease_connection()
+    except Exception:
+        # The lease may have died server-side (restart, dropped network,
+        # terminated backend); a new connection often still works.
+        session_pool().discard(st.session_state.session_key)
+        conn = lease_connection(fresh=True)
     cur = conn.cursor()
 except Exception as e:
-    st.error("Database connection failed ❌")
-    st.write(e)
-    st.stop()
+    session_pool().discard(st.session_state.session_key)
+    if OFFLINE_QUEUE and st.session_state.get("login"):
+        conn = cur = None
+    else:
+        st.error("Database connection failed ❌")
+        st.write(e)
+        st.stop()
+
+
+@st.cache_resource
+def init_schema():
+    db.ensure_schema(conn)
+    return True
+
+
+@st.cache_resource
+def patient_cache():
+    return db.PatientCache()
+
+
+@st.cache_resource
+def reference_cache():
+    return db.ReferenceCache()
+
+
+@st.cache_resource
+def pivot_cache():
+    return pivot.PivotCache()
+
+
+@st.cache_resource
+def trend_cache():
+    return trends.TrendCache()
+
+
+@st.cache_data(ttl=60)
+def cached_overview(_conn, sort, descending, limit, offset, search):
+    with _conn.cursor() as c:
+        ov = db.hospital_overview(c, sort, descending, limit, offset, search)
+    _conn.rollback()
+    return ov
+
+
+@st.cache_resource
+def model_cache():
+    return scoring.ModelCache()
+
+
+@st.cache_resource
+def job_runner():
+    return jobs.JobRunner(DB_URL).start()
+
+
+@st.cache_resource
+def prefetcher():
+    return prefetch.PageCache(DB_URL, {"pivot": pivot_cache(), "models": model_cache()})
+
+
+@st.cache_resource
+def memory_ledger():
+    # Reclaim order: pivots, prefetched pages, then patient frames (spilled).
+    return memory.MemoryLedger([
+        ("pivot", pivot_cache()),
+        ("trends", trend_cache()),
+        ("pages", prefetcher()),
+        ("patients", patient_cache()),
+    ])
+
+
+@st.cache_resource
+def write_service():
+    return group_commit.WriteService(DB_URL).start()
+
+
+@st.cache_resource
+def local_queue():
+    queue = offline_queue.OfflineQueue()
+    offline_queue.SyncThread(queue, DB_URL).start()
+    return queue
+
+
+@contextmanager
+def durable_write():
+    # Save and Convert go through the shared group-commit writer and return
+    # once their batch is committed.
+    try:
+        yield
+    except group_commit.WriteFailed as e:
+        st.error(f"Not saved: {e}")
+        st.stop()
+
+
+def save_patient(record):
+    if OFFLINE_QUEUE:
+        local_queue().enqueue(
+            "save_patient", st.session_state.hospital_id, st.session_state.user_id, record
+        )
+    else:
+        with durable_write():
+            write_service().save_patient(
+                st.session_state.hospital_id, st.session_state.user_id, record
+            )
+
+
+def convert_patients(patient_ids):
+    if OFFLINE_QUEUE:
+        local_queue().enqueue(
+            "convert", st.session_state.hospital_id, st.session_state.user_id,
+            {"patient_ids": list(patient_ids)}
+        )
+    else:
+        with durable_write():
+            write_service().convert(
+                st.session_state.hospital_id, st.session_state.user_id, patient_ids
+            )
+
+
+def tenant_budget():
+    if "budget" not in st.session_state:
+        st.session_state.budget = budgets.tenant_budget(cur, st.session_state.hospital_id)
+        conn.rollback()
+    return st.session_state.budget
+
+
+@contextmanager
+def query_budget():
+    # Expensive page queries share a per-tenant slot pool and run under the
+    # tier's statement_timeout; over budget, the page degrades instead.
+    try:
+        with budgets.heavy_query(conn, st.session_state.hospital_id, tenant_budget()):
+            yield
+    except budgets.BudgetExceeded as e:
+        st.warning(f"{e} Try a narrower date range.")
+        st.stop()
+
+
+# CSV bytes handed to download buttons this rerun; Streamlit keeps them
+# until the session's next rerun.
+exports = {}
+
+
+def csv_download(label, frame, file_name, **kwargs):
+    # Exports larger than a session may hold are left to the Jobs page.
+    if not memory_ledger().fits_session(memory.size_of(frame)):
+        st.info(f"{label}: too large to download from the page, use an export on the Jobs page.")
+        return
+    exports[file_name] = db.csv_export(db.frame_chunks(frame), frame.columns)
+    st.download_button(label, exports[file_name], file_name, "text/csv", **kwargs)
+
+
+def page_data(page, ctx, guard=query_budget):
+    # Served from the prefetch cache when still current, loaded otherwise.
+    return prefetcher().get(conn, st.session_state.hospital_id, page, ctx, guard)
+
+
+if conn is not None:
+    init_schema()
+    job_runner()
+
+# A restored token is checked against user_sessions once, so one revoked
+# by Logout no longer signs in. Offline, the check waits for the database.
+if conn is not None and not st.session_state.get("session_checked", True):
+    if auth.session_active(conn, st.session_state.session_id):
+        st.session_state.session_checked = True
+    else:
+        st.session_state.clear()
+        st.query_params.clear()
+        st.rerun()
 
 
 # ================== STYLING ================== #
@@ -55,10 +289,160 @@ body {background-color:#f4f6f9;}
 </style>
 """, unsafe_allow_html=True)
 
-# ================== PASSWORD HASH ================== #
+# ================== ADD PATIENT FORM ================== #
+
+def add_patient_form(ref):
+
+    procedures = ref["procedures"]
+    iol_types = ref["iol_types"]
+    doctors = ref["doctors"]
+    counsellors = ref["counsellors"]
+
+    vision_list = [
+        "6/6","6/9","6/12","6/18","6/24",
+        "6/36","6/60","HM","PLPR+","PLPR-"
+    ]
+
+    # ================= ADD PATIENT ================= #
+
+    st.markdown("### Add Patient")
+
+    col1, col2 = st.columns(2)
+
+    with col1:
+        name = st.text_input("Patient Name", key="p_name")
+        phone = st.text_input("WhatsApp Number", key="p_phone")
+        city = st.text_input("City", key="p_city")
+        age = st.number_input("Age", 1, 120, key="p_age")
+        gender = st.selectbox("Gender", ["Male","Female"], key="p_gender")
+
+    with col2:
+        vision_od = st.selectbox("Vision OD", vision_list, key="p_od")
+        vision_os = st.selectbox("Vision OS", vision_list, key="p_os")
+
+        procedure = st.selectbox("Procedure", procedures, key="p_procedure")
+
+        # 🔥 IOL SHOW ONLY FOR CATARACT
+        if procedure == "Cataract":
+            iol = st.selectbox("IOL Type", iol_types, key="p_iol")
+        else:
+            iol = None
+
+        doctor = st.selectbox(
+            "Doctor",
+            doctors if doctors else ["Not Added"],
+            key="p_doctor"
+        )
+
+        counsellor = st.selectbox(
+            "Counsellor",
+            counsellors if counsellors else ["Not Added"],
+            key="p_counsellor"
+        )
+
+        cost = st.number_input("Estimated Cost", key="p_cost")
+        status = st.selectbox("Status", ["Pending","Converted"], key="p_status")
+
+    if st.button("Save Patient", key="save_patient_btn"):
+
+        record = {
+            "patient_id": "PAT" + str(uuid.uuid4())[:6],
+            "name": name, "phone": phone, "city": city,
+            "age": age, "gender": gender,
+            "vision_od": vision_od, "vision_os": vision_os,
+            "procedure": procedure, "iol": iol,
+            "doctor": doctor, "counsellor": counsellor,
+            "cost": cost, "status": status,
+            "created_on": datetime.now(),
+        }
+
+        # Offline saves are checked for duplicates when they sync.
+        dups = pd.DataFrame()
+        if conn is not None:
+            dups = db.find_duplicates(cur, st.session_state.hospital_id, record)
+            conn.rollback()
+
+        if dups.empty:
+            save_patient(record)
+            st.success("Patient Saved Successfully ✅")
+            st.rerun()
+
+        st.session_state.dup_record = record
+        st.session_state.dup_rows = dups
+
+    if "dup_record" in st.session_state:
+
+        st.warning("This looks like a patient who is already registered:")
+        st.dataframe(
+            st.session_state.dup_rows[["patient_id","name","phone","procedure","status","created_on"]],
+            use_container_width=True,
+            hide_index=True
+        )
+
+        d1, d2 = st.columns(2)
+
+        if d1.button("Save Anyway", key="dup_save_btn"):
+            save_patient({**st.session_state.dup_record, "confirmed": True})
+            del st.session_state.dup_record, st.session_state.dup_rows
+            st.rerun()
+
+        if d2.button("Cancel", key="dup_cancel_btn"):
+            del st.session_state.dup_record, st.session_state.dup_rows
+            st.rerun()
+
+
+# ================== OFFLINE QUEUE ================== #
+
+def offline_convert_form():
+    # Patients known pending when the session was last online; a Patient ID
+    # can be typed when the list is missing or out of date.
+    st.markdown("### Convert Patient")
+
+    known = st.session_state.get("offline_pending")
+    queued = st.session_state.setdefault("offline_converted", set())
+    if known is not None:
+        known = known[~known["patient_id"].isin(queued)]
+
+    if known is not None and not known.empty:
+        labels = dict(zip(known["patient_id"], known["name"].fillna("") + " · " + known["phone"].fillna("")))
+        patient_id = st.selectbox(
+            "Pending Patient", list(labels), format_func=lambda x: f"{x} · {labels[x]}",
+            key="offline_convert_pick"
+        )
+    else:
+        patient_id = st.text_input("Patient ID", key="offline_convert_id").strip()
+
+    if st.button("Convert", key="offline_convert_btn") and patient_id:
+        convert_patients([patient_id])
+        queued.add(patient_id)
+        st.success(f"{patient_id} will be converted when the connection returns ✅")
+        st.rerun()
+
+
+def sync_conflicts():
+    rows = local_queue().conflicts(st.session_state.hospital_id)
+    if not rows:
+        return
+
+    with st.expander(f"⚠️ {len(rows)} queued changes could not be synced"):
+        for seq, op, payload, error, created_at in rows:
+            payload = json.loads(payload)
+            if op == "save_patient":
+                what = f"Save {payload['patient_id']} · {payload.get('name', '')} · {payload.get('phone', '')}"
+                retry_label = "Save Anyway"
+            else:
+                what = f"Convert {', '.join(payload['patient_ids'])}"
+                retry_label = "Retry"
+
+            c1, c2, c3 = st.columns([6,1,1])
+            c1.markdown(f"**{what}**  \n{error or ''} · queued {created_at[:16].replace('T', ' ')}")
+            if c2.button(retry_label, key=f"conflict_retry_{seq}"):
+                local_queue().retry(st.session_state.hospital_id, seq)
+                st.rerun()
+            if c3.button("Discard", key=f"conflict_discard_{seq}"):
+                local_queue().discard(st.session_state.hospital_id, seq)
+                st.rerun()
 
-def hash_pwd(p):
-    return hashlib.sha256(p.encode()).hexdigest()
 
 # ================== SESSION INIT ================== #
 
@@ -76,18 +460,14 @@ if not st.session_state.login:
 
     if st.button("Login"):
 
-        cur.execute(
-            "SELECT id, role, hospital_id FROM users WHERE username=%s AND password=%s",
-            (username, password)
-        )
-        user = cur.fetchone()
+        user = auth.login(conn, username, password)
 
         if user:
-            st.session_state.login = True
-            st.session_state.user_id = user[0]
-            st.session_state.role = user[1]
-            st.session_state.hospital_id = user[2]
-            st.session_state.username = username
+            start_session(user[0], user[1], user[2], username)
+            st.session_state.session_id = auth.open_session(conn, user[0])
+            st.query_params[auth.TOKEN_PARAM] = auth.issue_token(
+                SESSION_SECRET, st.session_state.session_id, user[0], user[1], user[2], username
+            )
             st.rerun()
         else:
             st.error("Invalid Credentials")
@@ -95,22 +475,39 @@ if not st.session_state.login:
     st.stop()
 
 
+# ================== OFFLINE MODE ================== #
 
-# ================== LOAD DATA ================== #
+if conn is None:
 
-cur.execute(
-    "SELECT * FROM patients WHERE hospital_id=%s",
-    (st.session_state.hospital_id,)
-)
-rows = cur.fetchall()
+    st.warning("Database unreachable. New patients and conversions are saved locally and synced when the connection returns.")
+
+    backlog = local_queue().backlog(st.session_state.hospital_id)
+    st.caption(f"Waiting to sync: {backlog.get('pending', 0)}")
+    sync_conflicts()
+
+    if "ref_lists" in st.session_state:
+        add_patient_form(st.session_state.ref_lists)
+    else:
+        st.info("Open the Patients page once while online to enable offline entry.")
+
+    st.markdown("---")
+    offline_convert_form()
+
+    st.stop()
 
-columns = [
-    "id","patient_id","name","phone","city","age","gender",
-    "vision_od","vision_os","procedure","iol",
-    "doctor","counsellor","cost","status","created_on","hospital_id"
-]
 
-df = pd.DataFrame(rows, columns=columns) if rows else pd.DataFrame(columns=columns)
+
+# ================== LOAD DATA ================== #
+
+# Full tenant dataset, delta-synced on each rerun (see db.PatientCache).
+df_all = patient_cache().get(conn, st.session_state.hospital_id)
+
+# Kept for offline Convert; ids queued offline are synced by now or parked.
+if OFFLINE_QUEUE:
+    st.session_state.offline_pending = df_all.loc[
+        df_all["status"] == "Pending", ["patient_id","name","phone"]
+    ]
+    st.session_state.offline_converted = set()
 
 # ==========================================================
 # ===================== SIDEBAR =============================
@@ -182,6 +579,16 @@ section[data-testid="stSidebar"] label {
 # ---------------- TITLE ---------------- #
 
 st.sidebar.markdown("## 🏥 OphthalmoAI")
+
+if OFFLINE_QUEUE:
+    backlog = local_queue().backlog(st.session_state.hospital_id)
+    if backlog.get("pending") or backlog.get("conflict"):
+        st.sidebar.caption(
+            f"⏳ {backlog.get('pending', 0)} waiting to sync · "
+            f"{backlog.get('conflict', 0)} conflicts"
+        )
+    sync_conflicts()
+
 st.sidebar.markdown("---")
 
 
@@ -204,10 +611,12 @@ elif st.session_state.role == "hospital_admin":
         menu_item("Patients", "👥"): "Patients",
         menu_item("Daily Reminders", "🔔"): "Daily Reminders",
         menu_item("Conversion", "📈"): "Conversion",
+        menu_item("Trends", "📉"): "Trends",
         menu_item("Pending", "⏳"): "Pending",
         menu_item("Revenue", "💰"): "Revenue",
         menu_item("Doctors", "🩺"): "Doctors",
         menu_item("Demographics", "📊"): "Demographics",
+        menu_item("Jobs", "⚙️"): "Jobs",
     }
 
 else:
@@ -217,11 +626,20 @@ else:
         menu_item("Daily Reminders", "🔔"): "Daily Reminders",
         menu_item("Pending", "⏳"): "Pending",
         menu_item("Doctors", "🩺"): "Doctors",
+        menu_item("Jobs", "⚙️"): "Jobs",
     }
 
 choice_display = st.sidebar.radio("", list(menu.keys()))
 choice = menu[choice_display]
 
+# A menu switch cancels this session's prefetches for other pages.
+if st.session_state.get("last_page") != choice:
+    prefetcher().navigate(
+        st.session_state.session_key, st.session_state.role,
+        st.session_state.get("last_page"), choice
+    )
+    st.session_state.last_page = choice
+
 st.sidebar.markdown("---")
 
 
@@ -273,6 +691,14 @@ if st.sidebar.button("Apply", use_container_width=True):
     st.session_state.end_date = end_date
     st.rerun()
 
+# Sampled pivots and demographics for very large tenants (see pivot.py).
+if st.session_state.role == "hospital_admin":
+    st.sidebar.checkbox(
+        "⚡ Fast approximate analytics",
+        key="approx",
+        help="Pivot and Demographics run on a sample with 95% intervals when the range is very large."
+    )
+
 st.sidebar.markdown("---")
 
 
@@ -281,7 +707,10 @@ st.sidebar.markdown("---")
 # ==========================================================
 
 if st.sidebar.button("🚪 Logout", use_container_width=True):
+    if st.session_state.get("session_id"):
+        auth.revoke_session(conn, st.session_state.session_id)
     st.session_state.clear()
+    st.query_params.clear()
     st.rerun()
 
 
@@ -299,27 +728,36 @@ end_datetime = datetime.combine(
     time.max
 )
 
-cur.execute("""
-    SELECT *
-    FROM patients
-    WHERE hospital_id=%s
-    AND created_on BETWEEN %s AND %s
-    ORDER BY created_on DESC
-""", (
-    st.session_state.hospital_id,
-    start_datetime,
-    end_datetime
-))
-
-rows = cur.fetchall()
+columns = db.PATIENT_COLUMNS
+
+# Sample percentage for approximate mode; None runs exactly, which is also
+# what small ranges get.
+sample_pct = None
+if st.session_state.get("approx") and choice in ("Conversion", "Demographics"):
+    sample_pct = pivot.sample_percent(cur, st.session_state.hospital_id, start_datetime, end_datetime)
+    conn.rollback()
+
+# Only the date-filtered analytics pages read this, under the tenant's budget.
+if choice == "Revenue":
+
+    with query_budget():
+        df = db.read_frame(conn, f"""
+            SELECT {db.PATIENT_SELECT}
+            FROM patients
+            WHERE hospital_id=%s
+            AND created_on BETWEEN %s AND %s
+            ORDER BY created_on DESC
+        """, (
+            st.session_state.hospital_id,
+            start_datetime,
+            end_datetime
+        ), columns)
 
-columns = [
-    "id","patient_id","name","phone","city","age","gender",
-    "vision_od","vision_os","procedure","iol",
-    "doctor","counsellor","cost","status","created_on","hospital_id"
-]
+    # Ranges reaching past the archive horizon also read the Parquet archive.
+    df = archive.with_archived(df, st.session_state.hospital_id, start_datetime, end_datetime)
 
-df = pd.DataFrame(rows, columns=columns) if rows else pd.DataFrame(columns=columns)
+else:
+    df = pd.DataFrame(columns=columns)
 
 
 # ================= DASHBOARD ================= #
@@ -350,145 +788,141 @@ if choice == "Dashboard":
     st.markdown("<div class='page-title'>Master Dashboard</div>", unsafe_allow_html=True)
     st.markdown("<div class='page-sub'>Real-time hospital performance intelligence</div>", unsafe_allow_html=True)
 
-    cur.execute("""
-        SELECT procedure, status, cost
-        FROM patients
-        WHERE hospital_id=%s
-    """, (st.session_state.hospital_id,))
-    rows = cur.fetchall()
+    # ---------- MASTER: ALL HOSPITALS ---------- #
 
-    df_dash = pd.DataFrame(rows, columns=["procedure","status","cost"])
+    if st.session_state.role == "master":
 
-    total = len(df_dash)
-    converted = len(df_dash[df_dash["status"]=="Converted"])
-    pending = len(df_dash[df_dash["status"]=="Pending"])
+        o1, o2, o3, o4 = st.columns([3,2,1,1])
 
-    revenue_done = df_dash[df_dash["status"]=="Converted"]["cost"].sum() if total>0 else 0
-    revenue_pending = df_dash[df_dash["status"]=="Pending"]["cost"].sum() if total>0 else 0
+        search_h = o1.text_input("Search Hospital", key="ov_search")
+        sort_by = o2.selectbox(
+            "Sort By",
+            list(db.OVERVIEW_SORTS),
+            index=1,
+            format_func=lambda k: k.replace("_", " ").title(),
+            key="ov_sort"
+        )
+        descending = o3.selectbox("Order", ["Desc","Asc"], key="ov_order") == "Desc"
+        page_size = o4.selectbox("Rows", [25, 50, 100], key="ov_size")
 
-    conversion_rate = (converted/total*100) if total>0 else 0
+        # A new search or page size starts again from page 1, so the offset
+        # cannot point past the last page of the narrower result.
+        if st.session_state.get("ov_filters") != (search_h, page_size):
+            st.session_state.ov_filters = (search_h, page_size)
+            st.session_state.ov_page = 1
+        page_no = st.session_state.get("ov_page", 1)
 
-    # ---------- TOP ROW ---------- #
-
-    c1, c2, c3, c4 = st.columns(4)
-
-    with c1:
-        st.markdown(f"""
-        <div class='card'>
-            <div class='card-title'>TOTAL ADVISED</div>
-            <div class='card-value'>{total}</div>
-        </div>
-        """, unsafe_allow_html=True)
-
-    with c2:
-        st.markdown(f"""
-        <div class='card'>
-            <div class='card-title'>CONVERSION RATE</div>
-            <div class='card-value'>{conversion_rate:.1f}%</div>
-        </div>
-        """, unsafe_allow_html=True)
-
-    with c3:
-        st.markdown(f"""
-        <div class='card'>
-            <div class='card-title'>REVENUE DONE</div>
-            <div class='card-value'>₹{revenue_done:,.0f}</div>
-        </div>
-        """, unsafe_allow_html=True)
-
-    with c4:
-        st.markdown(f"""
-        <div class='card'>
-            <div class='card-title'>REVENUE PENDING</div>
-            <div class='card-value'>₹{revenue_pending:,.0f}</div>
-        </div>
-        """, unsafe_allow_html=True)
+        ov = cached_overview(conn, sort_by, descending, page_size, (page_no - 1) * page_size, search_h)
 
-    st.markdown("<br>", unsafe_allow_html=True)
+        if ov.empty and page_no > 1:
+            st.session_state.ov_page = 1
+            st.rerun()
 
-    # ---------- CATEGORY CARDS ---------- #
+        if ov.empty:
+            st.info("No hospitals found")
+            st.stop()
+
+        hospitals_n = int(ov["hospitals"].iloc[0])
+        all_total = int(ov["all_total"].iloc[0])
+        all_converted = int(ov["all_converted"].iloc[0])
+        all_revenue = float(ov["all_revenue"].iloc[0])
+
+        m1, m2, m3, m4 = st.columns(4)
+        m1.metric("Hospitals", hospitals_n)
+        m2.metric("Total Advised", f"{all_total:,}")
+        m3.metric("Conversion Rate", f"{(all_converted / all_total * 100) if all_total else 0:.1f}%")
+        m4.metric("Revenue Done", f"₹{all_revenue:,.0f}")
+
+        st.dataframe(
+            ov[["name","subscription","total","converted","conversion_rate","revenue","last_activity"]]
+            .set_axis(["Hospital","Subscription","Patients","Converted","Conversion %","Revenue","Last Activity"], axis=1),
+            use_container_width=True,
+            hide_index=True
+        )
 
-    colA, colB = st.columns(2)
+        pages = max(1, -(-hospitals_n // page_size))
+        st.number_input(f"Page (of {pages})", 1, pages, key="ov_page")
 
-    with colA:
-        st.markdown("<div class='card'>", unsafe_allow_html=True)
-        st.markdown("### 📈 Top Performing Category")
-
-        if total > 0:
-            top_proc = df_dash["procedure"].value_counts().idxmax()
-            top_total = len(df_dash[df_dash["procedure"] == top_proc])
-            top_converted = len(
-                df_dash[
-                    (df_dash["procedure"] == top_proc) &
-                    (df_dash["status"] == "Converted")
-                ]
-            )
+        st.stop()
 
-            top_rate = (top_converted / top_total * 100) if top_total > 0 else 0
+    df_dash = df_all[["procedure","status","cost"]]
 
-            st.markdown(f"<h2 style='color:#059669'>{top_rate:.1f}%</h2>", unsafe_allow_html=True)
-            st.markdown(f"<div style='font-size:20px;font-weight:600'>{top_proc}</div>", unsafe_allow_html=True)
-            st.markdown(f"<div style='color:#6b7280'>{top_converted} of {top_total} patients converted</div>", unsafe_allow_html=True)
+    # Archived patients are all converted; they only exist as totals here.
+    arch = db.archived_stats(cur, st.session_state.hospital_id)
+    conn.rollback()
+    arch_proc = arch.groupby("procedure")[["total","converted"]].sum()
 
-        else:
-            st.info("No Data")
+    proc_stats = df_dash.assign(
+        total=1,
+        converted=(df_dash["status"] == "Converted").astype(int)
+    ).groupby("procedure")[["total","converted"]].sum()
+    proc_stats = proc_stats.add(arch_proc, fill_value=0)
 
-        st.markdown("</div>", unsafe_allow_html=True)
+    total = len(df_dash) + int(arch["total"].sum())
+    converted = len(df_dash[df_dash["status"]=="Converted"]) + int(arch["converted"].sum())
+    pending = len(df_dash[df_dash["status"]=="Pending"])
 
-    with colB:
-        st.markdown("<div class='card'>", unsafe_allow_html=True)
-        st.markdown("### ⚠ Needs Attention")
-
-        if pending > 0:
-            worst_proc = df_dash[df_dash["status"] == "Pending"]["procedure"].value_counts().idxmax()
-            worst_total = len(df_dash[df_dash["procedure"] == worst_proc])
-            worst_pending = len(
-                df_dash[
-                    (df_dash["procedure"] == worst_proc) &
-                    (df_dash["status"] == "Pending")
-                ]
-            )
+    revenue_done = (df_dash[df_dash["status"]=="Converted"]["cost"].sum() + arch["revenue"].sum()) if total>0 else 0
+    revenue_pending = df_dash[df_dash["status"]=="Pending"]["cost"].sum() if total>0 else 0
 
-            worst_rate = (worst_pending / worst_total * 100) if worst_total > 0 else 0
+    conversion_rate = (converted/total*100) if total>0 else 0
 
-            st.markdown(f"<h2 style='color:#dc2626'>{worst_rate:.1f}%</h2>", unsafe_allow_html=True)
-            st.markdown(f"<div style='font-size:20px;font-weight:600'>{worst_proc}</div>", unsafe_allow_html=True)
-            st.markdown(f"<div style='color:#6b7280'>{worst_pending} pending cases</div>", unsafe_allow_html=True)
+    # ---------- CARDS ---------- #
 
-        else:
-            st.success("No Pending Cases")
+    top_row = [
+        cards.kpi_card("TOTAL ADVISED", total),
+        cards.kpi_card("CONVERSION RATE", f"{conversion_rate:.1f}%"),
+        cards.kpi_card("REVENUE DONE", f"₹{revenue_done:,.0f}"),
+        cards.kpi_card("REVENUE PENDING", f"₹{revenue_pending:,.0f}"),
+    ]
 
-        st.markdown("</div>", unsafe_allow_html=True)
+    if total > 0:
+        top_proc = proc_stats["total"].idxmax()
+        top_total = int(proc_stats.loc[top_proc, "total"])
+        top_converted = int(proc_stats.loc[top_proc, "converted"])
 
-    st.markdown("<br>", unsafe_allow_html=True)
+        top_rate = (top_converted / top_total * 100) if top_total > 0 else 0
 
-    # ---------- OVERALL ---------- #
+        top_card = cards.highlight_card(
+            "📈 Top Performing Category", f"{top_rate:.1f}%", top_proc,
+            f"{top_converted} of {top_total} patients converted", "#059669"
+        )
+    else:
+        top_card = cards.highlight_card("📈 Top Performing Category", "-", "No Data", "", "#6b7280")
+
+    if pending > 0:
+        worst_proc = df_dash[df_dash["status"] == "Pending"]["procedure"].value_counts().idxmax()
+        worst_total = int(proc_stats.loc[worst_proc, "total"])
+        worst_pending = len(
+            df_dash[
+                (df_dash["procedure"] == worst_proc) &
+                (df_dash["status"] == "Pending")
+            ]
+        )
 
-    c5, c6, c7 = st.columns(3)
+        worst_rate = (worst_pending / worst_total * 100) if worst_total > 0 else 0
 
-    with c5:
-        st.markdown(f"""
-        <div class='card'>
-            <div class='card-title'>Total Advised</div>
-            <div class='card-value'>{total}</div>
-        </div>
-        """, unsafe_allow_html=True)
+        worst_card = cards.highlight_card(
+            "⚠ Needs Attention", f"{worst_rate:.1f}%", worst_proc,
+            f"{worst_pending} pending cases", "#dc2626"
+        )
+    else:
+        worst_card = cards.highlight_card("⚠ Needs Attention", "-", "No Pending Cases", "", "#059669")
 
-    with c6:
-        st.markdown(f"""
-        <div class='card'>
-            <div class='card-title'>Total Converted</div>
-            <div class='card-value'>{converted}</div>
-        </div>
-        """, unsafe_allow_html=True)
+    overall = [
+        cards.kpi_card("Total Advised", total),
+        cards.kpi_card("Total Converted", converted),
+        cards.kpi_card("Pending", pending),
+    ]
 
-    with c7:
-        st.markdown(f"""
-        <div class='card'>
-            <div class='card-title'>Pending</div>
-            <div class='card-value'>{pending}</div>
-        </div>
-        """, unsafe_allow_html=True)
+    # One delta for the whole page body.
+    st.markdown(
+        cards.GRID_CSS
+        + cards.grid(top_row, 4)
+        + cards.grid([top_card, worst_card], 2)
+        + cards.grid(overall, 3),
+        unsafe_allow_html=True
+    )
 
 
 # ================== PATIENTS ================== #
@@ -499,91 +933,10 @@ elif choice == "Patients":
 
     # -------- FETCH MASTER DATA -------- #
 
-    cur.execute("SELECT name FROM procedures")
-    procedures = [x[0] for x in cur.fetchall()]
+    ref = reference_cache().get(conn, st.session_state.hospital_id)
+    st.session_state.ref_lists = ref
 
-    cur.execute("SELECT name FROM iol_types")
-    iol_types = [x[0] for x in cur.fetchall()]
-
-    cur.execute(
-        "SELECT name FROM doctors WHERE hospital_id=%s",
-        (st.session_state.hospital_id,)
-    )
-    doctors = [x[0] for x in cur.fetchall()]
-
-    cur.execute(
-        "SELECT name FROM counsellors WHERE hospital_id=%s",
-        (st.session_state.hospital_id,)
-    )
-    counsellors = [x[0] for x in cur.fetchall()]
-
-    vision_list = [
-        "6/6","6/9","6/12","6/18","6/24",
-        "6/36","6/60","HM","PLPR+","PLPR-"
-    ]
-
-    # ================= ADD PATIENT ================= #
-
-    st.markdown("### Add Patient")
-
-    col1, col2 = st.columns(2)
-
-    with col1:
-        name = st.text_input("Patient Name", key="p_name")
-        phone = st.text_input("WhatsApp Number", key="p_phone")
-        city = st.text_input("City", key="p_city")
-        age = st.number_input("Age", 1, 120, key="p_age")
-        gender = st.selectbox("Gender", ["Male","Female"], key="p_gender")
-
-    with col2:
-        vision_od = st.selectbox("Vision OD", vision_list, key="p_od")
-        vision_os = st.selectbox("Vision OS", vision_list, key="p_os")
-
-        procedure = st.selectbox("Procedure", procedures, key="p_procedure")
-
-        # 🔥 IOL SHOW ONLY FOR CATARACT
-        if procedure == "Cataract":
-            iol = st.selectbox("IOL Type", iol_types, key="p_iol")
-        else:
-            iol = None
-
-        doctor = st.selectbox(
-            "Doctor",
-            doctors if doctors else ["Not Added"],
-            key="p_doctor"
-        )
-
-        counsellor = st.selectbox(
-            "Counsellor",
-            counsellors if counsellors else ["Not Added"],
-            key="p_counsellor"
-        )
-
-        cost = st.number_input("Estimated Cost", key="p_cost")
-        status = st.selectbox("Status", ["Pending","Converted"], key="p_status")
-
-    if st.button("Save Patient", key="save_patient_btn"):
-
-        patient_id = "PAT" + str(uuid.uuid4())[:6]
-
-        cur.execute("""
-            INSERT INTO patients
-            (patient_id,name,phone,city,age,gender,
-             vision_od,vision_os,procedure,iol,
-             doctor,counsellor,cost,status,
-             created_on,hospital_id)
-            VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s)
-        """, (
-            patient_id,name,phone,city,age,gender,
-            vision_od,vision_os,procedure,iol,
-            doctor,counsellor,cost,status,
-            datetime.now(),
-            st.session_state.hospital_id
-        ))
-
-        conn.commit()
-        st.success("Patient Saved Successfully ✅")
-        st.rerun()
+    add_patient_form(ref)
 
     st.markdown("---")
 
@@ -596,20 +949,17 @@ elif choice == "Patients":
         key="patient_search"
     )
 
-    cur.execute("""
-        SELECT patient_id,name,phone,procedure,iol,
-               doctor,counsellor,cost,status
-        FROM patients
-        WHERE hospital_id=%s
-        ORDER BY created_on DESC
-    """, (st.session_state.hospital_id,))
-
-    rows = cur.fetchall()
+    df_records = archive.with_archived(
+        df_all, st.session_state.hospital_id, start_datetime, end_datetime
+    )
 
-    df_patients = pd.DataFrame(rows, columns=[
+    df_patients = df_records[[
+        "patient_id","name","phone","procedure","iol",
+        "doctor","counsellor","cost","status"
+    ]].set_axis([
         "Patient ID","Name","Phone","Procedure","IOL",
         "Doctor","Counsellor","Cost","Status"
-    ])
+    ], axis=1)
 
     if search:
         df_patients = df_patients[
@@ -620,13 +970,7 @@ elif choice == "Patients":
 
     if not df_patients.empty:
 
-        csv = df_patients.to_csv(index=False).encode("utf-8")
-        st.download_button(
-            "Download Patient Report",
-            csv,
-            "patients_export.csv",
-            "text/csv"
-        )
+        csv_download("Download Patient Report", df_patients, "patients_export.csv")
 
         st.markdown("---")
 
@@ -662,11 +1006,7 @@ elif choice == "Patients":
                     "Convert",
                     key=f"convert_{row['Patient ID']}"
                 ):
-                    cur.execute(
-                        "UPDATE patients SET status='Converted' WHERE patient_id=%s",
-                        (row["Patient ID"],)
-                    )
-                    conn.commit()
+                    convert_patients([row["Patient ID"]])
                     st.rerun()
 
                 msg = f"Dear {row['Name']}, reminder for your {row['Procedure']} treatment."
@@ -724,25 +1064,29 @@ elif choice == "Daily Reminders":
 
     # ---------------- FETCH DATA ---------------- #
 
-    cur.execute("""
-        SELECT patient_id, name, phone, procedure, cost, created_on
-        FROM patients
-        WHERE hospital_id=%s AND status='Pending'
-        ORDER BY created_on DESC
-    """, (st.session_state.hospital_id,))
+    f1, f2 = st.columns(2)
 
-    rows = cur.fetchall()
+    order = f2.selectbox(
+        "Sort By",
+        ["score", "newest"],
+        format_func={"score": "Conversion likelihood", "newest": "Newest first"}.get,
+        key="rem_order"
+    )
 
-    if rows:
-        df_pending = pd.DataFrame(rows, columns=[
-            "patient_id","name","phone","procedure","cost","created_on"
-        ])
+    # Scores new/changed pending rows first so the list can be ordered by score.
+    df_pending = page_data("Daily Reminders", {"order": order}, nullcontext)["pending"]
+
+    if not df_pending.empty:
         df_pending["created_on"] = pd.to_datetime(df_pending["created_on"])
         df_pending["Days"] = (pd.Timestamp.now() - df_pending["created_on"]).dt.days
     else:
-        df_pending = pd.DataFrame(columns=[
-            "patient_id","name","phone","procedure","cost","created_on","Days"
-        ])
+        df_pending = pd.DataFrame(columns=worklists.SCORED_COLUMNS + ["Days"])
+
+    assigned = sorted(df_pending["counsellor"].dropna().unique())
+    counsellor_filter = f1.selectbox("Counsellor", ["All"] + assigned, key="rem_counsellor")
+
+    if counsellor_filter != "All":
+        df_pending = df_pending[df_pending["counsellor"] == counsellor_filter]
 
     # ---------------- BUCKETS ---------------- #
 
@@ -791,15 +1135,30 @@ elif choice == "Daily Reminders":
 
     # ---------------- EXPORT ---------------- #
 
-    colA, colB = st.columns([8,2])
+    colA, colB, colC = st.columns([6,2,2])
+
+    with colA:
+        sent_today = outbox.outbox_summary(cur, st.session_state.hospital_id)
+        conn.rollback()
+        if sent_today:
+            st.caption("Reminders today: " + " · ".join(
+                f"{k} {v}" for k, v in sorted(sent_today.items())
+            ))
+
     with colB:
         if not filtered.empty:
-            csv = filtered.to_csv(index=False).encode("utf-8")
-            st.download_button(
-                "⬇ Export Filtered",
-                csv,
-                "pending_patients.csv",
-                "text/csv",
+            if st.button("📨 Send Reminders", use_container_width=True):
+                queued = outbox.enqueue_reminders(
+                    conn,
+                    st.session_state.hospital_id,
+                    filtered[["patient_id","name","phone","procedure"]].itertuples(index=False)
+                )
+                st.success(f"{queued} reminders queued ✅")
+
+    with colC:
+        if not filtered.empty:
+            csv_download(
+                "⬇ Export Filtered", filtered, "pending_patients.csv",
                 use_container_width=True
             )
 
@@ -831,25 +1190,30 @@ elif choice == "Daily Reminders":
 
             c3.markdown(str(row["Days"]))
 
-            if row["Days"] > 60:
+            if pd.notna(row["score"]):
+                likely = scoring.priority(row["score"])
+                label = f"{likely} · {row['score']:.0%} likely"
+                if likely == "High":
+                    c4.success(label)
+                elif likely == "Medium":
+                    c4.warning(label)
+                else:
+                    c4.error(label)
+            elif row["Days"] > 60:
                 c4.error("High Priority")
             elif row["Days"] > 30:
                 c4.warning("Moderate Priority")
             else:
                 c4.success("Normal")
 
-            msg = f"Dear {row['name']}, this is a reminder for your {row['procedure']} treatment. Please contact us."
+            msg = outbox.reminder_message(row["name"], row["procedure"])
             encoded = urllib.parse.quote(msg)
             wa_link = f"https://wa.me/{row['phone']}?text={encoded}"
 
             btn1, btn2 = c5.columns(2)
 
             if btn1.button("Convert", key=f"conv_{row['patient_id']}"):
-                cur.execute(
-                    "UPDATE patients SET status='Converted' WHERE patient_id=%s",
-                    (row["patient_id"],)
-                )
-                conn.commit()
+                convert_patients([row["patient_id"]])
                 st.rerun()
 
             btn2.markdown(f"[WA]({wa_link})")
@@ -867,30 +1231,13 @@ elif choice == "Conversion":
     st.markdown('<div class="page-sub">Analyze conversion patterns and trends</div>', unsafe_allow_html=True)
 
     # ---- FETCH DATA ---- #
-    cur.execute("""
-        SELECT procedure,
-               COUNT(*) AS total,
-               SUM(CASE WHEN status='Converted' THEN 1 ELSE 0 END) AS converted,
-               SUM(CASE WHEN status='Pending' THEN 1 ELSE 0 END) AS pending
-        FROM patients
-        WHERE hospital_id=%s
-        GROUP BY procedure
-    """, (st.session_state.hospital_id,))
+    conv_data = page_data("Conversion", {"start": start_datetime, "end": end_datetime})
+    df_conv = conv_data["conv"]
 
-    rows = cur.fetchall()
-
-    if not rows:
+    if df_conv.empty:
         st.info("No data available")
         st.stop()
 
-    df_conv = pd.DataFrame(rows, columns=[
-        "procedure", "total", "converted", "pending"
-    ])
-
-    df_conv["conversion_rate"] = (
-        df_conv["converted"] / df_conv["total"] * 100
-    ).round(1)
-
     # ---- CHART ---- #
     fig = px.bar(
         df_conv,
@@ -909,50 +1256,158 @@ elif choice == "Conversion":
 
     # ---- KPI CARDS GRID ---- #
 
-    cols = st.columns(2)
+    st.markdown(
+        cards.GRID_CSS + cards.grid(cards.procedure_cards(df_conv), 2),
+        unsafe_allow_html=True
+    )
 
-    for i, row in df_conv.iterrows():
+    # ---- TIME TO CONVERSION ---- #
 
-        col = cols[i % 2]
+    st.markdown("### ⏱ Time to Conversion")
+    st.caption("Days from advice to conversion, for conversions recorded with a date")
 
-        with col:
+    lag_proc, lag_doc = conv_data["lag_proc"], conv_data["lag_doc"]
 
-            st.markdown("""
-                <div style="
-                    background:white;
-                    padding:25px;
-                    border-radius:16px;
-                    box-shadow:0 6px 20px rgba(0,0,0,0.08);
-                ">
-            """, unsafe_allow_html=True)
+    if lag_proc.empty:
+        st.info("No dated conversions yet")
+    else:
+        lag1, lag2 = st.columns(2)
 
-            # Procedure Title
-            st.markdown(f"### {row['procedure']}")
+        for col, lag, label in ((lag1, lag_proc, "Procedure"), (lag2, lag_doc, "Doctor")):
+            lag = lag.set_axis([label, "Converted", "Median Days", "P90 Days"], axis=1)
+            lag[["Median Days", "P90 Days"]] = lag[["Median Days", "P90 Days"]].astype(float).round(1)
+            col.markdown(f"**By {label}**")
+            col.dataframe(lag, use_container_width=True, hide_index=True)
 
-            # Big Conversion %
-            st.markdown(
-                f"<h1 style='color:#ef4444;margin-bottom:5px;'>{row['conversion_rate']}%</h1>",
-                unsafe_allow_html=True
-            )
+    # ---- PIVOT ANALYSIS ---- #
+
+    st.markdown("### 🧮 Pivot Analysis")
+    st.caption("Any 1–3 dimensions for the selected date range")
 
-            st.markdown("<div style='color:#6b7280;margin-bottom:20px;'>conversion</div>",
-                        unsafe_allow_html=True)
+    pv1, pv2 = st.columns([3,1])
 
-            # Bottom Metrics Row
-            m1, m2, m3 = st.columns(3)
+    dims = pv1.multiselect(
+        "Dimensions",
+        list(pivot.DIMENSIONS),
+        default=["doctor", "procedure"],
+        format_func=pivot.LABELS.get,
+        max_selections=pivot.MAX_DIMENSIONS,
+        key="pivot_dims"
+    )
+
+    measure = pv2.selectbox(
+        "Measure",
+        pivot.MEASURES,
+        index=2,
+        format_func=lambda m: m.replace("_", " ").title(),
+        key="pivot_measure"
+    )
 
-            m1.markdown(f"Total<br><strong>{int(row['total'])}</strong>", unsafe_allow_html=True)
-            m2.markdown(
-                f"<span style='color:#059669;'>Converted<br><strong>{int(row['converted'])}</strong></span>",
-                unsafe_allow_html=True
+    if dims:
+        with query_budget():
+            df_pivot = pivot_cache().get(
+                conn, st.session_state.hospital_id, dims, start_datetime, end_datetime, sample_pct
             )
-            m3.markdown(
-                f"<span style='color:#f97316;'>Pending<br><strong>{int(row['pending'])}</strong></span>",
-                unsafe_allow_html=True
+
+        # Archived patients in range are counted exactly from Parquet, as on
+        # Demographics, so the pivot agrees with the tables above.
+        df_pivot = pivot.add_archived(df_pivot, dims, archive.load_archived(
+            st.session_state.hospital_id, start_datetime, end_datetime, pivot.archived_columns(dims)
+        ))
+
+        if sample_pct is not None:
+            st.caption(
+                f"⚡ Approximate: {sample_pct}% block sample, "
+                "± columns are 95% intervals"
             )
 
-            st.markdown("</div>", unsafe_allow_html=True)
-            st.markdown("<br>", unsafe_allow_html=True)
+        if df_pivot.empty:
+            st.info("No data in this date range")
+        elif len(dims) == 1:
+            fig = px.bar(df_pivot, x=dims[0], y=measure, text=measure,
+                         error_y=f"{measure}_ci" if sample_pct is not None else None,
+                         labels=pivot.LABELS)
+            st.plotly_chart(fig, use_container_width=True)
+        else:
+            fig = px.density_heatmap(
+                df_pivot,
+                x=dims[0],
+                y=dims[1],
+                z=measure,
+                facet_col=dims[2] if len(dims) == 3 else None,
+                histfunc="sum",
+                text_auto=True,
+                color_continuous_scale="Teal",
+                labels=pivot.LABELS
+            )
+            st.plotly_chart(fig, use_container_width=True)
+
+        with st.expander("Table"):
+            st.dataframe(df_pivot, use_container_width=True, hide_index=True)
+
+
+# ================== TRENDS ================== #
+
+elif choice == "Trends":
+
+    st.markdown('<div class="page-title">Conversion Trends</div>', unsafe_allow_html=True)
+    st.markdown('<div class="page-sub">Advised vs converted patients and revenue over time</div>', unsafe_allow_html=True)
+
+    t1, t2 = st.columns([3,1])
+
+    span = t1.radio(
+        "Range",
+        ["Date filter", "Last 12 months", "Last 5 years", "All time"],
+        horizontal=True,
+        key="trend_span"
+    )
+
+    unit_choice = t2.selectbox("Granularity", ["auto"] + trends.GRANULARITIES, key="trend_unit")
+
+    trend_end = end_datetime
+    if span == "Date filter":
+        trend_start = start_datetime
+    elif span == "Last 12 months":
+        trend_start = datetime.combine(date.today() - timedelta(days=365), time.min)
+    elif span == "Last 5 years":
+        trend_start = datetime.combine(date.today() - timedelta(days=5 * 365), time.min)
+    else:
+        first = trends.first_patient(cur, st.session_state.hospital_id)
+        conn.rollback()
+        trend_start = datetime.combine((first or datetime.now()).date(), time.min)
+
+    unit = trends.pick_granularity(trend_start, trend_end) if unit_choice == "auto" else unit_choice
+
+    with query_budget():
+        df_trend, trend_figs = trend_cache().get(
+            conn, st.session_state.hospital_id, unit, trend_start, trend_end
+        )
+
+    if df_trend.empty:
+        st.info("No patients in this range")
+        st.stop()
+
+    st.markdown(
+        cards.GRID_CSS + cards.grid([
+            cards.kpi_card("Advised", f"{df_trend['advised'].sum():,}"),
+            cards.kpi_card("Converted", f"{df_trend['converted'].sum():,}"),
+            cards.kpi_card("Revenue", f"₹{df_trend['revenue'].sum():,.0f}"),
+        ], 3),
+        unsafe_allow_html=True
+    )
+
+    st.plotly_chart(trend_figs["counts"], use_container_width=True)
+    st.plotly_chart(trend_figs["revenue"], use_container_width=True)
+
+    caption = f"{trend_start:%d %b %Y} – {trend_end:%d %b %Y}, per {unit}"
+    if trend_figs["points"] < trend_figs["buckets"]:
+        caption += f" · chart shows {trend_figs['points']} of {trend_figs['buckets']} points"
+    st.caption(caption)
+
+    with st.expander("Table"):
+        st.dataframe(df_trend, use_container_width=True, hide_index=True)
+
+    csv_download("Download Trend", df_trend, f"trend_{unit}.csv")
 
 
 # ================== REVENUE ================== #
@@ -1007,32 +1462,37 @@ elif choice == "Master Control":
     st.markdown("---")
     st.markdown("### Existing Hospitals")
 
-    cur.execute("SELECT id,name,subscription FROM hospitals")
+    cur.execute("SELECT id,name,subscription FROM hospitals ORDER BY name")
     hospitals = cur.fetchall()
+    conn.rollback()
+
+    df_h = pd.DataFrame(hospitals, columns=["id","Hospital","Subscription"])
+    df_h.insert(0, "Select", False)
+
+    edited = st.data_editor(
+        df_h,
+        column_config={"id": None},
+        disabled=["Hospital","Subscription"],
+        use_container_width=True,
+        hide_index=True,
+        key="hospital_editor"
+    )
 
-    for h in hospitals:
-
-        col1,col2,col3 = st.columns([3,1,1])
+    selected_ids = [int(x) for x in edited.loc[edited["Select"], "id"]]
 
-        col1.write(f"**{h[1]}**")
-        col2.write(h[2])
+    b1, b2, _ = st.columns([1,1,3])
 
-        if col3.button("Toggle", key=h[0]):
-            new_status = "inactive" if h[2]=="active" else "active"
-            cur.execute(
-                "UPDATE hospitals SET subscription=%s WHERE id=%s",
-                (new_status, h[0])
-            )
-            conn.commit()
+    for btn, new_status in ((b1, "active"), (b2, "inactive")):
+        if btn.button(f"Set {new_status.title()} ({len(selected_ids)})",
+                      disabled=not selected_ids, use_container_width=True):
+            db.set_subscriptions(conn, selected_ids, new_status)
+            cached_overview.clear()
             st.rerun()
 
     st.markdown("---")
     st.markdown("### Create Hospital Admin")
 
-    cur.execute("SELECT id,name FROM hospitals")
-    hospital_list = cur.fetchall()
-
-    hospital_options = {h[1]:h[0] for h in hospital_list}
+    hospital_options = {h[1]:h[0] for h in hospitals}
 
     selected_hospital = st.selectbox("Select Hospital", list(hospital_options.keys()))
     admin_username = st.text_input("Admin Username")
@@ -1042,13 +1502,45 @@ elif choice == "Master Control":
 
         cur.execute(
             "INSERT INTO users (username,password,role,hospital_id) VALUES (%s,%s,%s,%s)",
-            (admin_username, admin_password, "hospital_admin", hospital_options[selected_hospital])
+            (admin_username, auth.hash_password(admin_password), "hospital_admin", hospital_options[selected_hospital])
         )
         conn.commit()
 
         st.success("Hospital Admin Created")
         st.rerun()
 
+    st.markdown("---")
+
+    with st.expander("Prepared statements (this server process)"):
+        leased, free = session_pool().size()
+        st.caption(f"Session connections: {leased} leased · {free} idle")
+        st.dataframe(pd.DataFrame(prepared.stats()), use_container_width=True, hide_index=True)
+
+    with st.expander("Group commit (this server process)"):
+        st.dataframe(pd.DataFrame([write_service().stats()]), use_container_width=True, hide_index=True)
+
+    with st.expander("Page prefetch (this server process)"):
+        st.dataframe(pd.DataFrame([prefetcher().stats()]), use_container_width=True, hide_index=True)
+
+    st.markdown("---")
+    st.markdown("### Memory (this server process)")
+
+    if st.button("Measure now"):
+        memory_ledger().enforce(force=True)
+
+    mem = memory_ledger().summary()
+    st.caption(
+        f"RSS {mem['rss_mb']} MB · cached frames {mem['cache_mb']} of {mem['budget_mb']} MB · "
+        f"sessions {mem['session_mb']} MB · reclaimed {mem['evicted']} evicted, "
+        f"{mem['spilled']} spilled ({mem['bytes'] / memory.MB:.0f} MB)"
+    )
+
+    m1, m2 = st.columns(2)
+    m1.markdown("**Heaviest sessions**")
+    m1.dataframe(memory_ledger().sessions(), use_container_width=True, hide_index=True)
+    m2.markdown("**Heaviest tenants**")
+    m2.dataframe(memory_ledger().tenants(), use_container_width=True, hide_index=True)
+
 # ================= PENDING ================= #
 
 elif choice == "Pending":
@@ -1060,30 +1552,12 @@ elif choice == "Pending":
 
     # ---------- FETCH DATA ---------- #
 
-    cur.execute("""
-        SELECT patient_id,name,phone,procedure,doctor,cost,status,created_on
-        FROM patients
-        WHERE hospital_id=%s AND status='Pending'
-        ORDER BY created_on DESC
-    """, (st.session_state.hospital_id,))
-
-    rows = cur.fetchall()
+    df_pending = page_data("Pending", {})["pending"]
 
-    if not rows:
+    if df_pending.empty:
         st.info("No pending patients.")
         st.stop()
 
-    df_pending = pd.DataFrame(rows, columns=[
-        "patient_id",
-        "name",
-        "phone",
-        "procedure",
-        "doctor",
-        "cost",
-        "status",
-        "created_on"
-    ])
-
     df_pending["created_on"] = pd.to_datetime(df_pending["created_on"])
     df_pending["Days"] = (pd.Timestamp.now() - df_pending["created_on"]).dt.days
 
@@ -1103,14 +1577,7 @@ elif choice == "Pending":
 
     st.dataframe(display_df, use_container_width=True)
 
-    csv = display_df.to_csv(index=False).encode("utf-8")
-
-    st.download_button(
-        "Download Pending Report",
-        csv,
-        "pending_patients.csv",
-        "text/csv"
-    )
+    csv_download("Download Pending Report", display_df, "pending_patients.csv")
 
 # ================= DOCTORS ================= #
 
@@ -1121,67 +1588,27 @@ elif choice == "Doctors":
     <div class='page-sub'>Compare conversion rates and revenue by doctor</div>
     """, unsafe_allow_html=True)
 
-    cur.execute("""
-        SELECT doctor,
-               COUNT(*) as total_cases,
-               SUM(CASE WHEN status='Converted' THEN 1 ELSE 0 END) as converted,
-               SUM(cost) as revenue
-        FROM patients
-        WHERE hospital_id=%s
-        GROUP BY doctor
-    """, (st.session_state.hospital_id,))
-    
-    rows = cur.fetchall()
+    df_doc = page_data("Doctors", {})["doc"]
 
-    if not rows:
+    if df_doc.empty:
         st.info("No doctor data available.")
         st.stop()
 
-    df_doc = pd.DataFrame(rows, columns=[
-        "doctor","total_cases","converted","revenue"
-    ])
-
-    df_doc["conversion_rate"] = (
-        df_doc["converted"] / df_doc["total_cases"] * 100
-    ).round(1)
-
-    df_doc["revenue"] = df_doc["revenue"].fillna(0)
-
-    # -------- TOP PERFORMER -------- #
+    # -------- TOP PERFORMER + ALL DOCTORS -------- #
 
     top_doc = df_doc.sort_values("conversion_rate", ascending=False).iloc[0]
 
-    st.markdown("""
-    <div class='card' style='background:#e6f4f1;'>
-    """, unsafe_allow_html=True)
-
-    st.markdown("### 🏆 Top Performer")
-    st.markdown(f"## {top_doc['doctor']}")
-    st.markdown(f"""
-    Conversion Rate: **{top_doc['conversion_rate']}%**  
-    Revenue: **₹{top_doc['revenue']:,.0f}**
-    """)
-
-    st.markdown("</div>", unsafe_allow_html=True)
-
-    st.markdown("<br>", unsafe_allow_html=True)
-
-    # -------- ALL DOCTORS CARDS -------- #
-
-    for _, row in df_doc.iterrows():
-
-        st.markdown("<div class='card'>", unsafe_allow_html=True)
-
-        col1, col2, col3 = st.columns(3)
-
-        col1.metric("Total Cases", row["total_cases"])
-        col2.metric("Conversion %", f"{row['conversion_rate']}%")
-        col3.metric("Revenue", f"₹{row['revenue']:,.0f}")
-
-        st.markdown(f"### 👨‍⚕️ {row['doctor']}")
+    top_card = cards.highlight_card(
+        "🏆 Top Performer", f"{top_doc['conversion_rate']}%", top_doc["doctor"],
+        f"Revenue: ₹{top_doc['revenue']:,.0f}", "#059669"
+    )
 
-        st.markdown("</div>", unsafe_allow_html=True)
-        st.markdown("<br>", unsafe_allow_html=True)
+    st.markdown(
+        cards.GRID_CSS
+        + cards.grid([top_card], 1)
+        + cards.grid(cards.doctor_cards(df_doc), 2),
+        unsafe_allow_html=True
+    )
 
 # ================= SETTINGS ================= #
 
@@ -1203,6 +1630,7 @@ elif choice == "Settings":
         (st.session_state.hospital_id,)
     )
     hospital = cur.fetchone()
+    conn.rollback()
 
     st.markdown("### 🏥 Hospital Information")
 
@@ -1244,6 +1672,7 @@ elif choice == "Settings":
                 VALUES (%s,%s)
             """, (new_doc, st.session_state.hospital_id))
             conn.commit()
+            reference_cache().invalidate(st.session_state.hospital_id)
             st.success("Doctor Added ✅")
             st.rerun()
 
@@ -1252,6 +1681,7 @@ elif choice == "Settings":
         WHERE hospital_id=%s
     """, (st.session_state.hospital_id,))
     docs = cur.fetchall()
+    conn.rollback()
 
     for d in docs:
         col1, col2 = st.columns([4,1])
@@ -1259,6 +1689,7 @@ elif choice == "Settings":
         if col2.button("Delete", key=f"doc_{d[0]}"):
             cur.execute("DELETE FROM doctors WHERE id=%s", (d[0],))
             conn.commit()
+            reference_cache().invalidate(st.session_state.hospital_id)
             st.rerun()
 
     st.markdown("---")
@@ -1276,6 +1707,7 @@ elif choice == "Settings":
                 VALUES (%s,%s)
             """, (new_coun, st.session_state.hospital_id))
             conn.commit()
+            reference_cache().invalidate(st.session_state.hospital_id)
             st.success("Counsellor Added ✅")
             st.rerun()
 
@@ -1284,6 +1716,7 @@ elif choice == "Settings":
         WHERE hospital_id=%s
     """, (st.session_state.hospital_id,))
     couns = cur.fetchall()
+    conn.rollback()
 
     for c in couns:
         col1, col2 = st.columns([4,1])
@@ -1291,6 +1724,7 @@ elif choice == "Settings":
         if col2.button("Delete", key=f"coun_{c[0]}"):
             cur.execute("DELETE FROM counsellors WHERE id=%s", (c[0],))
             conn.commit()
+            reference_cache().invalidate(st.session_state.hospital_id)
             st.rerun()
 
     st.markdown("---")
@@ -1305,11 +1739,13 @@ elif choice == "Settings":
         if new_proc:
             cur.execute("INSERT INTO procedures (name) VALUES (%s)", (new_proc,))
             conn.commit()
+            reference_cache().invalidate()
             st.success("Procedure Added ✅")
             st.rerun()
 
     cur.execute("SELECT id, name FROM procedures")
     procs = cur.fetchall()
+    conn.rollback()
 
     for p in procs:
         col1, col2 = st.columns([4,1])
@@ -1317,6 +1753,7 @@ elif choice == "Settings":
         if col2.button("Delete", key=f"proc_{p[0]}"):
             cur.execute("DELETE FROM procedures WHERE id=%s", (p[0],))
             conn.commit()
+            reference_cache().invalidate()
             st.rerun()
 
     st.markdown("---")
@@ -1331,11 +1768,13 @@ elif choice == "Settings":
         if new_iol:
             cur.execute("INSERT INTO iol_types (name) VALUES (%s)", (new_iol,))
             conn.commit()
+            reference_cache().invalidate()
             st.success("IOL Type Added ✅")
             st.rerun()
 
     cur.execute("SELECT id, name FROM iol_types")
     iols = cur.fetchall()
+    conn.rollback()
 
     for i in iols:
         col1, col2 = st.columns([4,1])
@@ -1343,6 +1782,7 @@ elif choice == "Settings":
         if col2.button("Delete", key=f"iol_{i[0]}"):
             cur.execute("DELETE FROM iol_types WHERE id=%s", (i[0],))
             conn.commit()
+            reference_cache().invalidate()
             st.rerun()
 
 
@@ -1352,33 +1792,188 @@ elif choice == "Demographics":
 
     st.markdown("## Patient Demographics Intelligence")
 
-    if not df.empty:
+    # Both modes group in SQL with the pivot's buckets (exactly when
+    # sample_pct is None) and add archived patients counted exactly from
+    # Parquet, so switching modes only changes the sampling error.
+    with query_budget():
+        demo = {
+            dim: pivot_cache().get(
+                conn, st.session_state.hospital_id, [dim], start_datetime, end_datetime, sample_pct
+            )
+            for dim in ("age_band", "gender", "city")
+        }
 
-        # AGE GROUPS
-        bins = [0,20,40,60,80,120]
-        labels = ["0-20","21-40","41-60","61-80","80+"]
+    archived = archive.load_archived(
+        st.session_state.hospital_id, start_datetime, end_datetime,
+        pivot.archived_columns(list(demo))
+    )
+    demo = {
+        dim: pivot.add_archived(frame, [dim], archived)
+        for dim, frame in demo.items()
+    }
+    error_y = "total_ci" if sample_pct is not None else None
 
-        df["age_group"] = pd.cut(df["age"], bins=bins, labels=labels)
+    if demo["gender"].empty:
+        st.info("No data available for demographics")
+
+    else:
+
+        if sample_pct is not None:
+            st.caption(
+                f"⚡ Approximate: {sample_pct}% block sample of "
+                f"~{demo['gender']['total'].sum():,} patients, error bars are 95% intervals"
+            )
 
         col1,col2 = st.columns(2)
 
         with col1:
             st.markdown("### Age Distribution")
-            age_group = df["age_group"].value_counts().reset_index()
-            age_group.columns=["Age Group","Count"]
-            fig_age = px.bar(age_group, x="Age Group", y="Count")
+            fig_age = px.bar(demo["age_band"].sort_values("age_band"), x="age_band", y="total",
+                             error_y=error_y, labels={"age_band": "Age Group", "total": "Count"})
             st.plotly_chart(fig_age, use_container_width=True)
 
         with col2:
             st.markdown("### Gender Distribution")
-            fig_gender = px.pie(df, names="gender")
+            fig_gender = px.pie(demo["gender"], names="gender", values="total")
             st.plotly_chart(fig_gender, use_container_width=True)
 
         st.markdown("### City Analysis")
-        city_group = df["city"].value_counts().reset_index()
-        city_group.columns=["City","Patients"]
-        fig_city = px.bar(city_group, x="City", y="Patients")
+        fig_city = px.bar(demo["city"].sort_values("total", ascending=False), x="city", y="total",
+                          error_y=error_y, labels={"city": "City", "total": "Patients"})
         st.plotly_chart(fig_city, use_container_width=True)
 
-    else:
-        st.info("No data available for demographics")
+# ================= JOBS ================= #
+
+elif choice == "Jobs":
+
+    st.markdown("""
+    <div class='page-title'>Background Jobs</div>
+    <div class='page-sub'>Long exports, imports and rebuilds run here; you can leave or refresh the page</div>
+    """, unsafe_allow_html=True)
+
+    hid = st.session_state.hospital_id
+
+    def start_job(kind, params=None):
+        try:
+            jobs.submit(conn, hid, st.session_state.user_id, kind, params)
+        except jobs.JobLimitReached as e:
+            st.warning(str(e))
+        else:
+            st.rerun()
+
+    j1, j2 = st.columns(2)
+
+    with j1:
+        st.markdown("#### Export")
+        if st.button("Export patients in date range", use_container_width=True):
+            start_job("export_patients", {"start": start_datetime, "end": end_datetime})
+        if st.button("Export all patients", use_container_width=True):
+            start_job("export_patients")
+
+        if st.session_state.role == "hospital_admin":
+            st.markdown("#### Maintenance")
+            if st.button("Rebuild reminder worklist", use_container_width=True):
+                start_job("rebuild_worklist")
+            if st.button("Retrain conversion scores", use_container_width=True):
+                start_job("train_scoring")
+            if st.button("Archive old converted patients", use_container_width=True):
+                start_job("archive")
+
+    with j2:
+        st.markdown("#### Import")
+        upload = st.file_uploader(
+            "Patients CSV (" + ", ".join(db.PATIENT_INSERT_COLUMNS) + ")",
+            type="csv"
+        )
+        if upload is not None and st.button("Start Import", use_container_width=True):
+            start_job("import_patients", {"path": jobs.stage_upload(upload.getvalue())})
+
+    st.markdown("---")
+
+    h1, h2 = st.columns([4,1])
+    h1.markdown("### Recent Jobs")
+    if h2.button("🔄 Refresh", use_container_width=True):
+        st.rerun()
+
+    job_list = jobs.list_jobs(cur, hid)
+    conn.rollback()
+
+    if job_list.empty:
+        st.info("No jobs yet")
+
+    for _, job in job_list.iterrows():
+
+        c1, c2, c3 = st.columns([3,3,1])
+
+        c1.markdown(f"**{jobs.LABELS.get(job['kind'], job['kind'])}** #{job['id']}")
+        c1.caption(f"{job['status'].title()} · {job['created_at']:%d %b %H:%M}")
+
+        if job["status"] in ("queued", "running"):
+            c2.progress(float(job["progress"]), text=job["message"] or job["status"].title())
+            if c3.button("Cancel", key=f"job_cancel_{job['id']}"):
+                jobs.cancel(conn, hid, int(job["id"]))
+                st.rerun()
+
+        elif job["status"] == "done":
+            c2.write(job["message"] or "")
+            # Only the job picked for download is read into memory, and it
+            # is counted in the session's exports like any page export.
+            if st.session_state.get("job_download") != job["id"]:
+                if job["result_name"] and c3.button("⬇", key=f"job_pick_{job['id']}"):
+                    st.session_state.job_download = job["id"]
+                    st.rerun()
+                continue
+            path = jobs.result_path(cur, hid, int(job["id"]))
+            conn.rollback()
+            if path:
+                with open(path, "rb") as f:
+                    exports[job["result_name"]] = f.read()
+                c3.download_button(
+                    "Save",
+                    exports[job["result_name"]],
+                    job["result_name"],
+                    key=f"job_dl_{job['id']}"
+                )
+
+        else:
+            c2.write(job["error"] or job["status"].title())
+
+
+# ================= PREFETCH ================= #
+
+# Warm the likely next pages while this one is being read.
+if st.session_state.hospital_id is not None:
+    prefetcher().schedule(
+        st.session_state.session_key,
+        st.session_state.hospital_id,
+        st.session_state.role,
+        choice,
+        set(menu.values()),
+        {
+            "Conversion": {"start": start_datetime, "end": end_datetime},
+            "Daily Reminders": {"order": st.session_state.get("rem_order", "score")},
+        }
+    )
+
+
+# The leased connection outlives this rerun; never leave it idle in a
+# transaction holding locks until the next click.
+if conn is not None:
+    conn.rollback()
+
+
+# ================= MEMORY ================= #
+
+# What this session held after the rerun; over budget, the shared caches
+# give memory back (see memory.py).
+memory_ledger().record_session(
+    st.session_state.session_key,
+    st.session_state.hospital_id,
+    st.session_state.username,
+    {
+        **{name: obj for name, obj in globals().items() if name in memory.SESSION_OBJECTS},
+        **{f"export:{name}": data for name, data in exports.items()},
+        **{f"state:{k}": v for k, v in st.session_state.items() if isinstance(v, (pd.DataFrame, dict))},
+    }
+)
+memory_ledger().enforce()
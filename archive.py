@@ -0,0 +1,346 @@
+import argparse
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import time
+import uuid
+from datetime import datetime, timedelta
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from dotenv import load_dotenv
+
+import db
+
+log = logging.getLogger("archive")
+
+# Cold storage for converted patients that are no longer edited. Each run
+# writes one zstd Parquet file per hospital under ARCHIVE_DIR holding exactly
+# the rows it deletes from `patients`, records it in manifest.json, and folds
+# those rows into archived_patient_stats so the Dashboard, Conversion and
+# Doctors totals stay unchanged.
+#
+#   python archive.py run --older-than-days 730
+#   python archive.py list
+
+ARCHIVE_DIR = os.environ.get("ARCHIVE_DIR", "archive")
+ARCHIVE_AFTER_DAYS = int(os.environ.get("ARCHIVE_AFTER_DAYS", "730"))
+MANIFEST = "manifest.json"
+MANIFEST_LOCK = "manifest.lock"
+
+ARCHIVE_COLUMNS = db.PATIENT_COLUMNS + ["updated_at", "converted_on"]
+
+# ================== MANIFEST ================== #
+
+def manifest_path(root=ARCHIVE_DIR):
+    return os.path.join(root, MANIFEST)
+
+
+def read_manifest(root=ARCHIVE_DIR):
+    try:
+        with open(manifest_path(root)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {"files": []}
+
+
+def write_manifest(manifest, root=ARCHIVE_DIR):
+    os.makedirs(root, exist_ok=True)
+    tmp = f"{manifest_path(root)}.{os.getpid()}.{uuid.uuid4().hex}.tmp"
+    with open(tmp, "w") as f:
+        json.dump(manifest, f, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, manifest_path(root))
+
+
+def add_manifest_entry(entry, root=ARCHIVE_DIR):
+    # Archive jobs for different hospitals run at once; the read-modify-write
+    # is serialised so neither drops the other's entry.
+    os.makedirs(root, exist_ok=True)
+    with open(os.path.join(root, MANIFEST_LOCK), "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            manifest = read_manifest(root)
+            manifest["files"].append(entry)
+            write_manifest(manifest, root)
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def remove_manifest_entry(entry, root=ARCHIVE_DIR):
+    with open(os.path.join(root, MANIFEST_LOCK), "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            manifest = read_manifest(root)
+            manifest["files"] = [e for e in manifest["files"] if e["file"] != entry["file"]]
+            write_manifest(manifest, root)
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def sha256_file(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+# ================== ARCHIVE ================== #
+
+TEXT_COLUMNS = [
+    "patient_id","name","phone","city","gender","vision_od","vision_os",
+    "procedure","iol","doctor","counsellor","status"
+]
+
+
+def normalise_chunk(chunk):
+    # Give every chunk the same Arrow schema, even when a column happens to
+    # be entirely NULL in the first one.
+    chunk = chunk.copy()
+    chunk[TEXT_COLUMNS] = chunk[TEXT_COLUMNS].astype("string")
+    chunk["cost"] = pd.to_numeric(chunk["cost"], errors="coerce").astype("float64")
+    chunk["age"] = pd.to_numeric(chunk["age"], errors="coerce").astype("Int64")
+    chunk["created_on"] = pd.to_datetime(chunk["created_on"])
+    chunk["converted_on"] = pd.to_datetime(chunk["converted_on"])
+    chunk["updated_at"] = pd.to_datetime(chunk["updated_at"], utc=True)
+    return chunk
+
+
+def keep_rows(staged, path, ids):
+    # Rewrite the staged file with only the given ids, in the same order.
+    # Returns (rows, first created_on, last created_on).
+    source = pq.ParquetFile(staged)
+    keep = pa.array(sorted(ids), type=pa.int64())
+    writer = None
+    rows = 0
+    first = last = None
+    try:
+        for batch in source.iter_batches():
+            batch = batch.filter(pc.is_in(batch.column("id").cast(pa.int64()), value_set=keep))
+            if batch.num_rows == 0:
+                continue
+            if writer is None:
+                writer = pq.ParquetWriter(path, source.schema_arrow, compression="zstd")
+            writer.write_batch(batch)
+            rows += batch.num_rows
+            created = batch.column("created_on")
+            first = first if first is not None else created[0].as_py()
+            last = created[-1].as_py()
+    finally:
+        if writer is not None:
+            writer.close()
+    os.remove(staged)
+    return rows, first, last
+
+
+def remove_file(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def stage_rows(conn, hospital_id, cutoff, staged):
+    # Returns (ids, first created_on, last created_on) of the rows written.
+    writer = None
+    ids = []
+    first = last = None
+    try:
+        for chunk in db.stream_frames(conn, f"""
+            SELECT {", ".join(ARCHIVE_COLUMNS)}
+            FROM patients
+            WHERE hospital_id=%s AND status='Converted' AND created_on < %s
+            ORDER BY created_on
+        """, (hospital_id, cutoff), ARCHIVE_COLUMNS):
+            table = pa.Table.from_pandas(normalise_chunk(chunk), preserve_index=False)
+            if writer is None:
+                writer = pq.ParquetWriter(staged, table.schema, compression="zstd")
+            writer.write_table(table.cast(writer.schema))
+            ids.extend(int(x) for x in chunk["id"])
+            first = first if first is not None else chunk["created_on"].iloc[0]
+            last = chunk["created_on"].iloc[-1]
+    finally:
+        if writer is not None:
+            writer.close()
+    return ids, first, last
+
+
+def archive_hospital(conn, hospital_id, cutoff, root=ARCHIVE_DIR):
+    with conn.cursor() as cur:
+        snapshot_at = db.server_now(cur)
+    conn.rollback()
+
+    folder = os.path.join(root, f"hospital_{hospital_id}")
+    os.makedirs(folder, exist_ok=True)
+    # Unique per run, so two runs in the same second never share a file.
+    name = f"patients_{datetime.now():%Y%m%d_%H%M%S}_{uuid.uuid4().hex[:8]}.parquet"
+    path = os.path.join(folder, name)
+    staged = path + ".partial"
+
+    try:
+        ids, first, last = stage_rows(conn, hospital_id, cutoff, staged)
+    except Exception:
+        remove_file(staged)
+        raise
+
+    if not ids:
+        return 0
+
+    # Rows edited after the snapshot stay hot. The delete is held open until
+    # the file holds exactly the deleted rows and is listed, so nothing is
+    # both archived and hot once it commits.
+    try:
+        with conn.cursor() as cur:
+            cur.execute("""
+                WITH gone AS (
+                    DELETE FROM patients
+                    WHERE hospital_id=%s AND id = ANY(%s)
+                    AND status='Converted' AND updated_at <= %s
+                    RETURNING id, procedure, doctor, cost
+                ), folded AS (
+                    INSERT INTO archived_patient_stats AS s
+                    (hospital_id, procedure, doctor, total, converted, revenue)
+                    SELECT %s, COALESCE(procedure, '-'), COALESCE(doctor, '-'),
+                           COUNT(*), COUNT(*), COALESCE(SUM(cost), 0)
+                    FROM gone
+                    GROUP BY 2, 3
+                    ON CONFLICT (hospital_id, procedure, doctor) DO UPDATE
+                    SET total = s.total + EXCLUDED.total,
+                        converted = s.converted + EXCLUDED.converted,
+                        revenue = s.revenue + EXCLUDED.revenue
+                )
+                SELECT id FROM gone
+            """, (hospital_id, ids, snapshot_at, hospital_id))
+            deleted = [x[0] for x in cur.fetchall()]
+
+        if not deleted:
+            conn.rollback()
+            remove_file(staged)
+            return 0
+
+        if len(deleted) == len(ids):
+            os.replace(staged, path)
+            rows = len(ids)
+        else:
+            rows, first, last = keep_rows(staged, path, deleted)
+
+        # Listed before the commit: a crash in between leaves rows in both
+        # places, and readers prefer the hot copy.
+        entry = {
+            "hospital_id": hospital_id,
+            "file": os.path.relpath(path, root),
+            "rows": rows,
+            "min_created_on": pd.Timestamp(first).isoformat(),
+            "max_created_on": pd.Timestamp(last).isoformat(),
+            "sha256": sha256_file(path),
+            "archived_at": datetime.now().isoformat(timespec="seconds"),
+        }
+        add_manifest_entry(entry, root)
+    except Exception:
+        conn.rollback()
+        remove_file(staged)
+        remove_file(path)
+        raise
+
+    try:
+        conn.commit()
+    except Exception:
+        # The file stays: a commit that failed on the way back may still
+        # have deleted the rows, and it is then their only copy.
+        remove_manifest_entry(entry, root)
+        raise
+    return rows
+
+
+def archive_all(conn, older_than_days=ARCHIVE_AFTER_DAYS, hospital_ids=None, root=ARCHIVE_DIR):
+    cutoff = datetime.now() - timedelta(days=older_than_days)
+
+    if hospital_ids is None:
+        with conn.cursor() as cur:
+            cur.execute("SELECT id FROM hospitals ORDER BY id")
+            hospital_ids = [x[0] for x in cur.fetchall()]
+        conn.rollback()
+
+    for hospital_id in hospital_ids:
+        started = time.monotonic()
+        rows = archive_hospital(conn, hospital_id, cutoff, root)
+        if rows:
+            log.info("hospital %s: archived %s rows in %.1fs",
+                     hospital_id, rows, time.monotonic() - started)
+
+# ================== READ ================== #
+
+def archived_files(hospital_id, start, end, root=ARCHIVE_DIR):
+    files = []
+    for entry in read_manifest(root)["files"]:
+        if entry["hospital_id"] != hospital_id:
+            continue
+        if start is not None and pd.Timestamp(entry["max_created_on"]) < pd.Timestamp(start):
+            continue
+        if end is not None and pd.Timestamp(entry["min_created_on"]) > pd.Timestamp(end):
+            continue
+        files.append(os.path.join(root, entry["file"]))
+    return files
+
+
+def load_archived(hospital_id, start=None, end=None, columns=None, root=ARCHIVE_DIR):
+    columns = columns or db.PATIENT_COLUMNS
+    files = archived_files(hospital_id, start, end, root)
+    if not files:
+        return pd.DataFrame(columns=columns)
+
+    filters = []
+    if start is not None:
+        filters.append(("created_on", ">=", pd.Timestamp(start)))
+    if end is not None:
+        filters.append(("created_on", "<=", pd.Timestamp(end)))
+
+    frames = [
+        pd.read_parquet(f, columns=columns, filters=filters or None)
+        for f in files
+    ]
+    return pd.concat(frames, ignore_index=True)
+
+
+def with_archived(df, hospital_id, start=None, end=None, root=ARCHIVE_DIR):
+    # Append archived rows in range to a hot frame with the same columns.
+    # Rows present in both (interrupted archive run) keep the hot copy.
+    archived = load_archived(hospital_id, start, end, list(df.columns), root)
+    if archived.empty:
+        return df
+    archived = archived[~archived["id"].isin(df["id"])] if "id" in df.columns else archived
+    merged = pd.concat([df, archived], ignore_index=True)
+    return merged.sort_values("created_on", ascending=False, ignore_index=True)
+
+# ================== CLI ================== #
+
+def main():
+    load_dotenv()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(name)s %(message)s")
+
+    parser = argparse.ArgumentParser(description="Archive old converted patients to Parquet")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    run = sub.add_parser("run")
+    run.add_argument("--older-than-days", type=int, default=ARCHIVE_AFTER_DAYS)
+    run.add_argument("--hospital", type=int, action="append")
+    sub.add_parser("list")
+    args = parser.parse_args()
+
+    if args.cmd == "list":
+        for entry in read_manifest()["files"]:
+            print(f"{entry['hospital_id']:>6}  {entry['rows']:>9}  "
+                  f"{entry['min_created_on'][:10]} .. {entry['max_created_on'][:10]}  {entry['file']}")
+        return
+
+    conn = db.connect()
+    db.ensure_schema(conn)
+    archive_all(conn, args.older_than_days, args.hospital)
+
+
+if __name__ == "__main__":
+    main()
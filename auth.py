@@ -0,0 +1,233 @@
+import argparse
+import base64
+import hashlib
+import hmac
+import json
+import os
+import secrets
+import time
+
+from dotenv import load_dotenv
+
+import db
+import prepared
+
+# Passwords are stored as "pbkdf2_sha256$<iterations>$<salt>$<hash>".
+# Rows still holding a plaintext password, or a hash made with fewer
+# iterations than PBKDF2_ITERATIONS, are rehashed on their next good login.
+#
+# Session tokens are HMAC-signed and carry user_id/role/hospital_id, so a
+# reconnecting browser tab is restored without a login or a users query.
+# Each also names a row in user_sessions, checked once per restored
+# session, so Logout revokes the token server-side rather than waiting out
+# TOKEN_TTL. The token travels in the URL (Streamlit has no cookie API
+# here), so a shared link is only as safe as that revocation.
+#
+#   python auth.py bench --iterations 600000
+#   python auth.py upgrade
+
+SCHEME = "pbkdf2_sha256"
+PBKDF2_ITERATIONS = int(os.environ.get("AUTH_PBKDF2_ITERATIONS", "310000"))
+SALT_BYTES = 16
+
+TOKEN_PARAM = "s"
+TOKEN_TTL = int(os.environ.get("AUTH_TOKEN_TTL_S", str(12 * 3600)))
+
+# ================== PASSWORDS ================== #
+
+def b64(raw):
+    return base64.urlsafe_b64encode(raw).rstrip(b"=").decode()
+
+
+def unb64(text):
+    return base64.urlsafe_b64decode(text + "=" * (-len(text) % 4))
+
+
+def hash_password(password, iterations=PBKDF2_ITERATIONS, salt=None):
+    salt = salt or secrets.token_bytes(SALT_BYTES)
+    digest = hashlib.pbkdf2_hmac("sha256", password.encode(), salt, iterations)
+    return f"{SCHEME}${iterations}${b64(salt)}${b64(digest)}"
+
+
+def verify_password(stored, password, iterations=PBKDF2_ITERATIONS):
+    # Returns (ok, needs_rehash)
+    if not stored:
+        return False, False
+
+    if not stored.startswith(SCHEME + "$"):
+        # Legacy plaintext row.
+        ok = hmac.compare_digest(stored.encode(), password.encode())
+        return ok, ok
+
+    try:
+        _, rounds, salt, digest = stored.split("$")
+        rounds = int(rounds)
+        candidate = hashlib.pbkdf2_hmac("sha256", password.encode(), unb64(salt), rounds)
+        digest = unb64(digest)
+    except ValueError:
+        # Malformed stored hash; reject the login rather than fail the form.
+        return False, False
+    ok = hmac.compare_digest(candidate, digest)
+    return ok, ok and rounds < iterations
+
+
+# Spent on unknown usernames so they take as long as a wrong password.
+DUMMY_HASH = hash_password(secrets.token_hex(8))
+
+
+LOGIN = prepared.register(
+    "login", "SELECT id, role, hospital_id, password FROM users WHERE username=%s"
+)
+
+
+def login(conn, username, password):
+    # Returns (user_id, role, hospital_id) or None.
+    with conn.cursor() as cur:
+        prepared.execute(cur, LOGIN, (username,))
+        row = cur.fetchone()
+
+        if row is None:
+            verify_password(DUMMY_HASH, password)
+            conn.rollback()
+            return None
+
+        ok, needs_rehash = verify_password(row[3], password)
+        if ok and needs_rehash:
+            cur.execute(
+                "UPDATE users SET password=%s WHERE id=%s AND password=%s",
+                (hash_password(password), row[0], row[3])
+            )
+    conn.commit()
+    return row[:3] if ok else None
+
+
+def upgrade_plaintext(conn):
+    # Hash every remaining plaintext password in one pass.
+    with conn.cursor() as cur:
+        cur.execute(
+            "SELECT id, password FROM users WHERE password IS NOT NULL AND password NOT LIKE %s",
+            (SCHEME + "$%",)
+        )
+        rows = cur.fetchall()
+        for user_id, password in rows:
+            cur.execute(
+                "UPDATE users SET password=%s WHERE id=%s AND password=%s",
+                (hash_password(password), user_id, password)
+            )
+    conn.commit()
+    return len(rows)
+
+# ================== SESSION TOKENS ================== #
+
+def sign(body, secret):
+    return b64(hmac.new(secret.encode(), body.encode(), hashlib.sha256).digest())
+
+
+def issue_token(secret, session_id, user_id, role, hospital_id, username, ttl=TOKEN_TTL):
+    body = b64(json.dumps({
+        "sid": session_id,
+        "uid": user_id,
+        "role": role,
+        "hid": hospital_id,
+        "name": username,
+        "exp": int(time.time()) + ttl,
+    }, separators=(",", ":")).encode())
+    return f"{body}.{sign(body, secret)}"
+
+
+def read_token(token, secret):
+    # Returns the claims dict, or None if the token is malformed, forged or
+    # expired.
+    if not token or "." not in token:
+        return None
+    body, signature = token.rsplit(".", 1)
+    # Compared as bytes: compare_digest rejects non-ASCII str.
+    if not hmac.compare_digest(signature.encode(), sign(body, secret).encode()):
+        return None
+    try:
+        claims = json.loads(unb64(body))
+    except ValueError:
+        return None
+    if claims.get("exp", 0) < time.time():
+        return None
+    return claims
+
+def open_session(conn, user_id, ttl=TOKEN_TTL):
+    session_id = secrets.token_urlsafe(16)
+    with conn.cursor() as cur:
+        cur.execute(
+            "DELETE FROM user_sessions WHERE user_id=%s AND expires_at < now()",
+            (user_id,)
+        )
+        cur.execute("""
+            INSERT INTO user_sessions (id, user_id, expires_at)
+            VALUES (%s, %s, now() + make_interval(secs => %s))
+        """, (session_id, user_id, ttl))
+    conn.commit()
+    return session_id
+
+
+def session_active(conn, session_id):
+    if not session_id:
+        return False
+    with conn.cursor() as cur:
+        cur.execute("""
+            SELECT 1 FROM user_sessions
+            WHERE id=%s AND revoked_at IS NULL AND expires_at > now()
+        """, (session_id,))
+        active = cur.fetchone() is not None
+    conn.rollback()
+    return active
+
+
+def revoke_session(conn, session_id):
+    with conn.cursor() as cur:
+        cur.execute(
+            "UPDATE user_sessions SET revoked_at=now() WHERE id=%s AND revoked_at IS NULL",
+            (session_id,)
+        )
+    conn.commit()
+
+# ================== CLI ================== #
+
+def bench(iterations, attempts):
+    stored = hash_password("correct horse", iterations)
+    started = time.perf_counter()
+    for _ in range(attempts):
+        verify_password(stored, "wrong guess", iterations)
+    per_attempt = (time.perf_counter() - started) / attempts
+
+    secret = secrets.token_hex(32)
+    token = issue_token(secret, secrets.token_urlsafe(16), 1, "hospital_admin", 1, "admin")
+    started = time.perf_counter()
+    for _ in range(1000):
+        read_token(token, secret)
+    per_token = (time.perf_counter() - started) / 1000
+
+    print(f"pbkdf2-sha256 x{iterations:,}: {per_attempt * 1000:.1f} ms per login attempt "
+          f"(~{1 / per_attempt:.0f} attempts/s per core)")
+    print(f"session token restore: {per_token * 1e6:.1f} µs")
+
+
+def main():
+    load_dotenv()
+
+    parser = argparse.ArgumentParser(description="Password hashing and session tokens")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    b = sub.add_parser("bench", help="time one login attempt")
+    b.add_argument("--iterations", type=int, default=PBKDF2_ITERATIONS)
+    b.add_argument("--attempts", type=int, default=20)
+    sub.add_parser("upgrade", help="hash all remaining plaintext passwords")
+    args = parser.parse_args()
+
+    if args.cmd == "bench":
+        bench(args.iterations, args.attempts)
+        return
+
+    conn = db.connect()
+    db.ensure_schema(conn)
+    print(f"hashed {upgrade_plaintext(conn)} plaintext passwords")
+
+
+if __name__ == "__main__":
+    main()
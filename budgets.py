@@ -0,0 +1,108 @@
+import os
+import time
+from contextlib import contextmanager
+
+from psycopg2 import errors
+
+# Per-tenant limits for the expensive page queries (analytics, exports).
+# Limits come from subscription_tiers via hospitals.tier; concurrency slots
+# are Postgres advisory locks, so they hold across every app process that
+# shares the database.
+
+TIER_DEFAULTS = {
+    # tier: (statement_timeout_ms, heavy_slots, queue_timeout_s)
+    "basic": (5000, 1, 5),
+    "standard": (15000, 2, 10),
+    "enterprise": (60000, 4, 20),
+}
+
+# Default for every other app query; heavy queries use their tier's value.
+APP_STATEMENT_TIMEOUT_MS = int(os.environ.get("APP_STATEMENT_TIMEOUT_MS", "10000"))
+
+# Cap on heavy queries running at once across all tenants.
+GLOBAL_HEAVY_SLOTS = int(os.environ.get("GLOBAL_HEAVY_SLOTS", "8"))
+
+TENANT_LOCK_NS = 72410100
+GLOBAL_LOCK_NS = 72410200
+POLL_INTERVAL = 0.2
+
+
+class BudgetExceeded(Exception):
+    pass
+
+
+def tenant_budget(cur, hospital_id):
+    cur.execute("""
+        SELECT t.statement_timeout_ms, t.heavy_slots, t.queue_timeout_s
+        FROM hospitals h
+        JOIN subscription_tiers t ON t.tier = h.tier
+        WHERE h.id=%s
+    """, (hospital_id,))
+    row = cur.fetchone()
+    return row if row else TIER_DEFAULTS["standard"]
+
+# ================== SLOTS ================== #
+
+def try_slot(cur, namespace, key, slots):
+    for slot in range(slots):
+        cur.execute("SELECT pg_try_advisory_lock(%s, %s)", (namespace + slot, key))
+        if cur.fetchone()[0]:
+            return namespace + slot
+    return None
+
+
+def acquire_slots(conn, hospital_id, slots, queue_timeout):
+    # Waiting tenants poll until the deadline, so one tenant holding all of
+    # its own slots never blocks another tenant's queue.
+    deadline = time.monotonic() + queue_timeout
+    with conn.cursor() as cur:
+        while True:
+            tenant = try_slot(cur, TENANT_LOCK_NS, hospital_id, slots)
+            if tenant is not None:
+                shared = try_slot(cur, GLOBAL_LOCK_NS, 0, GLOBAL_HEAVY_SLOTS)
+                if shared is not None:
+                    return [(tenant, hospital_id), (shared, 0)]
+                cur.execute("SELECT pg_advisory_unlock(%s, %s)", (tenant, hospital_id))
+
+            if time.monotonic() >= deadline:
+                return None
+            time.sleep(POLL_INTERVAL)
+
+
+def release_slots(conn, held):
+    with conn.cursor() as cur:
+        for key1, key2 in held:
+            cur.execute("SELECT pg_advisory_unlock(%s, %s)", (key1, key2))
+
+# ================== HEAVY QUERY ================== #
+
+def set_statement_timeout(conn, ms):
+    # Session-level SET is undone by a rollback, so commit it straight away.
+    with conn.cursor() as cur:
+        if ms is None:
+            cur.execute("RESET statement_timeout")
+        else:
+            cur.execute("SELECT set_config('statement_timeout', %s, false)", (str(ms),))
+    conn.commit()
+
+
+@contextmanager
+def heavy_query(conn, hospital_id, budget):
+    timeout_ms, slots, queue_timeout = budget
+
+    held = acquire_slots(conn, hospital_id, slots, queue_timeout)
+    if held is None:
+        conn.rollback()
+        raise BudgetExceeded("The server is busy with other reports for your hospital.")
+
+    set_statement_timeout(conn, timeout_ms)
+    try:
+        yield
+    except errors.QueryCanceled:
+        conn.rollback()
+        raise BudgetExceeded("This report took longer than your plan allows.")
+    finally:
+        conn.rollback()
+        set_statement_timeout(conn, None)
+        release_slots(conn, held)
+        conn.commit()
@@ -0,0 +1,176 @@
+import argparse
+import html
+import time
+from string import Template
+
+import pandas as pd
+
+# Card grids rendered as one HTML string, so a whole grid costs a single
+# st.markdown delta instead of several markdown/columns elements per card.
+# Templates are compiled once at import, i.e. once per server process.
+
+GRID_CSS = """
+<style>
+.card-grid {
+    display:grid;
+    gap:20px;
+    margin-bottom:20px;
+}
+.card-grid .card {
+    background:white;
+    padding:20px;
+    border-radius:14px;
+    box-shadow:0 6px 20px rgba(0,0,0,0.08);
+    text-align:left;
+}
+.card-grid .card-title {
+    font-size:13px;
+    color:#6b7280;
+    margin-bottom:8px;
+}
+.card-grid .card-value {
+    font-size:24px;
+    font-weight:700;
+}
+.card-grid .card-name {
+    font-size:20px;
+    font-weight:600;
+    margin-bottom:6px;
+}
+.card-grid .card-big {
+    font-size:34px;
+    font-weight:700;
+    margin-bottom:5px;
+}
+.card-grid .card-note {
+    color:#6b7280;
+    margin-bottom:16px;
+}
+.card-grid .card-stats {
+    display:grid;
+    grid-template-columns:repeat(3, 1fr);
+    gap:10px;
+}
+@media (max-width: 640px) {
+    .card-grid { grid-template-columns:1fr !important; }
+}
+</style>
+"""
+
+GRID = Template("""<div class='card-grid' style='grid-template-columns:repeat($columns, 1fr);'>$cards</div>""")
+
+KPI_CARD = Template("""
+<div class='card'>
+    <div class='card-title'>$title</div>
+    <div class='card-value'>$value</div>
+</div>""")
+
+HIGHLIGHT_CARD = Template("""
+<div class='card'>
+    <div class='card-title'>$title</div>
+    <div class='card-big' style='color:$color'>$value</div>
+    <div class='card-name'>$name</div>
+    <div class='card-note'>$note</div>
+</div>""")
+
+STAT = Template("""<div style='color:$color'>$label<br><strong>$value</strong></div>""")
+
+STATS_CARD = Template("""
+<div class='card'>
+    <div class='card-name'>$name</div>
+    <div class='card-big' style='color:$color'>$value</div>
+    <div class='card-note'>$note</div>
+    <div class='card-stats'>$stats</div>
+</div>""")
+
+# ================== CARDS ================== #
+
+def esc(value):
+    return html.escape(str(value))
+
+
+def kpi_card(title, value):
+    return KPI_CARD.substitute(title=esc(title), value=esc(value))
+
+
+def highlight_card(title, value, name, note, color):
+    return HIGHLIGHT_CARD.substitute(
+        title=esc(title), value=esc(value), name=esc(name), note=esc(note), color=color
+    )
+
+
+def stats_card(name, value, note, stats, color="#111827"):
+    # stats: [(label, value, color)]
+    return STATS_CARD.substitute(
+        name=esc(name), value=esc(value), note=esc(note), color=color,
+        stats="".join(
+            STAT.substitute(label=esc(label), value=esc(v), color=c)
+            for label, v, c in stats
+        )
+    )
+
+
+def grid(cards, columns):
+    return GRID.substitute(columns=int(columns), cards="".join(cards))
+
+# ================== PAGES ================== #
+
+def procedure_cards(df_conv):
+    return [
+        stats_card(
+            row.procedure, f"{row.conversion_rate}%", "conversion",
+            [
+                ("Total", int(row.total), "#111827"),
+                ("Converted", int(row.converted), "#059669"),
+                ("Pending", int(row.pending), "#f97316"),
+            ],
+            color="#ef4444"
+        )
+        for row in df_conv.itertuples(index=False)
+    ]
+
+
+def doctor_cards(df_doc):
+    return [
+        stats_card(
+            f"👨‍⚕️ {row.doctor}", f"{row.conversion_rate}%", "conversion",
+            [
+                ("Total Cases", int(row.total_cases), "#111827"),
+                ("Conversion %", f"{row.conversion_rate}%", "#059669"),
+                ("Revenue", f"₹{row.revenue:,.0f}", "#111827"),
+            ]
+        )
+        for row in df_doc.itertuples(index=False)
+    ]
+
+# ================== BENCH ================== #
+
+def main():
+    parser = argparse.ArgumentParser(description="Time card-grid rendering")
+    parser.add_argument("--cards", type=int, default=40)
+    parser.add_argument("--rounds", type=int, default=200)
+    args = parser.parse_args()
+
+    n = args.cards
+    df_conv = pd.DataFrame({
+        "procedure": [f"Procedure {i}" for i in range(n)],
+        "total": [100 + i for i in range(n)],
+        "converted": [40 + i for i in range(n)],
+        "pending": [60 for _ in range(n)],
+        "conversion_rate": [round((40 + i) / (100 + i) * 100, 1) for i in range(n)],
+    })
+
+    started = time.perf_counter()
+    for _ in range(args.rounds):
+        page = grid(procedure_cards(df_conv), 2)
+    elapsed = (time.perf_counter() - started) / args.rounds
+
+    # Per card before: 6 st.markdown, an st.columns(3) block with its three
+    # columns and a markdown in each; plus the shared st.columns(2).
+    before = n * 13 + 3
+    print(f"{n} cards: {len(page):,} bytes, {elapsed * 1000:.2f} ms to render")
+    print(f"element deltas: {before} -> 1")
+
+
+if __name__ == "__main__":
+    main()
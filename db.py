@@ -0,0 +1,1313 @@
+import io
+import os
+import re
+import threading
+import time
+import uuid
+from datetime import date, timedelta
+
+import pandas as pd
+import psycopg2
+
+import prepared
+
+# ================== CONNECTION ================== #
+
+def connect(db_url=None, statement_timeout_ms=None):
+    options = f"-c statement_timeout={statement_timeout_ms}" if statement_timeout_ms else None
+    return psycopg2.connect(
+        db_url or os.environ["DB_URL"],
+        sslmode="require",
+        connect_timeout=10,
+        options=options
+    )
+
+# ================== SCHEMA ================== #
+
+# Every statement is idempotent, and schema_version counts how many have
+# been applied, so a process start with nothing new runs no DDL and takes no
+# locks on hot tables. New migrations are appended, never edited in place.
+
+SCHEMA_LOCK_ID = 72410001
+
+SCHEMA_SQL = [
+    # ---- updated_at watermark for delta sync ---- #
+    """
+    ALTER TABLE patients
+    ADD COLUMN IF NOT EXISTS updated_at timestamptz NOT NULL DEFAULT now()
+    """,
+    """
+    CREATE OR REPLACE FUNCTION touch_updated_at() RETURNS trigger AS $$
+    BEGIN
+        NEW.updated_at := clock_timestamp();
+        RETURN NEW;
+    END
+    $$ LANGUAGE plpgsql
+    """,
+    "DROP TRIGGER IF EXISTS patients_touch_updated_at ON patients",
+    """
+    CREATE TRIGGER patients_touch_updated_at
+    BEFORE INSERT OR UPDATE ON patients
+    FOR EACH ROW EXECUTE FUNCTION touch_updated_at()
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS patients_hospital_updated_idx
+    ON patients (hospital_id, updated_at)
+    """,
+    # ---- tombstones so deletes reach cached copies ---- #
+    """
+    CREATE TABLE IF NOT EXISTS patients_deleted (
+        id integer NOT NULL,
+        hospital_id integer,
+        deleted_at timestamptz NOT NULL DEFAULT clock_timestamp()
+    )
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS patients_deleted_hospital_idx
+    ON patients_deleted (hospital_id, deleted_at)
+    """,
+    """
+    CREATE OR REPLACE FUNCTION record_patient_delete() RETURNS trigger AS $$
+    BEGIN
+        INSERT INTO patients_deleted (id, hospital_id) VALUES (OLD.id, OLD.hospital_id);
+        RETURN OLD;
+    END
+    $$ LANGUAGE plpgsql
+    """,
+    "DROP TRIGGER IF EXISTS patients_record_delete ON patients",
+    """
+    CREATE TRIGGER patients_record_delete
+    AFTER DELETE ON patients
+    FOR EACH ROW EXECUTE FUNCTION record_patient_delete()
+    """,
+    # ---- WhatsApp reminder outbox ---- #
+    """
+    CREATE TABLE IF NOT EXISTS reminder_outbox (
+        id bigserial PRIMARY KEY,
+        hospital_id integer NOT NULL,
+        patient_id text NOT NULL,
+        phone text NOT NULL,
+        message text NOT NULL,
+        status text NOT NULL DEFAULT 'queued',
+        attempts integer NOT NULL DEFAULT 0,
+        next_attempt_at timestamptz NOT NULL DEFAULT now(),
+        claimed_at timestamptz,
+        last_error text,
+        queued_on date NOT NULL DEFAULT current_date,
+        created_at timestamptz NOT NULL DEFAULT now(),
+        sent_at timestamptz
+    )
+    """,
+    """
+    CREATE UNIQUE INDEX IF NOT EXISTS reminder_outbox_daily_uq
+    ON reminder_outbox (hospital_id, patient_id, queued_on)
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS reminder_outbox_due_idx
+    ON reminder_outbox (next_attempt_at)
+    WHERE status = 'queued'
+    """,
+    # ---- nightly reminder worklists ---- #
+    """
+    CREATE TABLE IF NOT EXISTS reminder_worklist (
+        hospital_id integer NOT NULL,
+        snapshot_date date NOT NULL,
+        patient_id text NOT NULL,
+        name text,
+        phone text,
+        procedure text,
+        cost numeric,
+        counsellor text,
+        created_on timestamp,
+        days_pending integer NOT NULL,
+        bucket text NOT NULL,
+        priority text NOT NULL,
+        PRIMARY KEY (hospital_id, snapshot_date, patient_id)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS reminder_worklist_runs (
+        hospital_id integer NOT NULL,
+        snapshot_date date NOT NULL,
+        taken_at timestamptz NOT NULL,
+        row_count integer NOT NULL,
+        PRIMARY KEY (hospital_id, snapshot_date)
+    )
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS reminder_worklist_patient_idx
+    ON reminder_worklist (hospital_id, patient_id)
+    """,
+    # Converted or deleted patients leave the precomputed list immediately.
+    """
+    CREATE OR REPLACE FUNCTION drop_from_worklist() RETURNS trigger AS $$
+    BEGIN
+        IF TG_OP = 'UPDATE' AND NEW.status = 'Pending' THEN
+            RETURN NULL;
+        END IF;
+        DELETE FROM reminder_worklist
+        WHERE hospital_id = OLD.hospital_id AND patient_id = OLD.patient_id;
+        RETURN NULL;
+    END
+    $$ LANGUAGE plpgsql
+    """,
+    "DROP TRIGGER IF EXISTS patients_drop_from_worklist ON patients",
+    """
+    CREATE TRIGGER patients_drop_from_worklist
+    AFTER UPDATE OF status OR DELETE ON patients
+    FOR EACH ROW
+    WHEN (OLD.status = 'Pending')
+    EXECUTE FUNCTION drop_from_worklist()
+    """,
+    # ---- status history / time to conversion ---- #
+    "ALTER TABLE patients ADD COLUMN IF NOT EXISTS converted_on timestamp",
+    """
+    CREATE TABLE IF NOT EXISTS patient_status_events (
+        id bigserial PRIMARY KEY,
+        patient_pk integer NOT NULL,
+        hospital_id integer,
+        old_status text,
+        new_status text NOT NULL,
+        changed_by integer,
+        changed_at timestamptz NOT NULL DEFAULT now()
+    )
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS patient_status_events_patient_idx
+    ON patient_status_events (patient_pk, changed_at)
+    """,
+    """
+    CREATE OR REPLACE FUNCTION stamp_converted_on() RETURNS trigger AS $$
+    BEGIN
+        IF NEW.status = 'Converted' AND (TG_OP = 'INSERT' OR OLD.status IS DISTINCT FROM 'Converted') THEN
+            NEW.converted_on := COALESCE(NEW.converted_on, localtimestamp);
+        ELSIF NEW.status IS DISTINCT FROM 'Converted' THEN
+            NEW.converted_on := NULL;
+        END IF;
+        RETURN NEW;
+    END
+    $$ LANGUAGE plpgsql
+    """,
+    "DROP TRIGGER IF EXISTS patients_stamp_converted_on ON patients",
+    """
+    CREATE TRIGGER patients_stamp_converted_on
+    BEFORE INSERT OR UPDATE OF status ON patients
+    FOR EACH ROW EXECUTE FUNCTION stamp_converted_on()
+    """,
+    # Runs inside the writing statement's transaction, so single and bulk
+    # converts are always recorded together with the status change.
+    """
+    CREATE OR REPLACE FUNCTION record_status_event() RETURNS trigger AS $$
+    BEGIN
+        IF TG_OP = 'INSERT' OR OLD.status IS DISTINCT FROM NEW.status THEN
+            INSERT INTO patient_status_events
+            (patient_pk, hospital_id, old_status, new_status, changed_by)
+            VALUES (
+                NEW.id, NEW.hospital_id,
+                CASE WHEN TG_OP = 'UPDATE' THEN OLD.status END,
+                NEW.status,
+                NULLIF(current_setting('app.user_id', true), '')::integer
+            );
+        END IF;
+        RETURN NULL;
+    END
+    $$ LANGUAGE plpgsql
+    """,
+    "DROP TRIGGER IF EXISTS patients_record_status_event ON patients",
+    """
+    CREATE TRIGGER patients_record_status_event
+    AFTER INSERT OR UPDATE OF status ON patients
+    FOR EACH ROW EXECUTE FUNCTION record_status_event()
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS patients_converted_procedure_idx
+    ON patients (hospital_id, procedure) INCLUDE (created_on, converted_on)
+    WHERE converted_on IS NOT NULL
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS patients_converted_doctor_idx
+    ON patients (hospital_id, doctor) INCLUDE (created_on, converted_on)
+    WHERE converted_on IS NOT NULL
+    """,
+    # ---- date-range and ageing access paths (also per partition) ---- #
+    """
+    CREATE INDEX IF NOT EXISTS patients_hospital_created_idx
+    ON patients (hospital_id, created_on)
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS patients_pending_idx
+    ON patients (hospital_id, created_on)
+    WHERE status = 'Pending'
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS patients_hospital_patient_idx
+    ON patients (hospital_id, patient_id)
+    """,
+    # ---- query budgets per subscription tier ---- #
+    "ALTER TABLE hospitals ADD COLUMN IF NOT EXISTS tier text NOT NULL DEFAULT 'standard'",
+    """
+    CREATE TABLE IF NOT EXISTS subscription_tiers (
+        tier text PRIMARY KEY,
+        statement_timeout_ms integer NOT NULL,
+        heavy_slots integer NOT NULL,
+        queue_timeout_s integer NOT NULL
+    )
+    """,
+    """
+    INSERT INTO subscription_tiers VALUES
+        ('basic', 5000, 1, 5),
+        ('standard', 15000, 2, 10),
+        ('enterprise', 60000, 4, 20)
+    ON CONFLICT (tier) DO NOTHING
+    """,
+    # ---- API keys for the read-only KPI endpoint ---- #
+    """
+    CREATE TABLE IF NOT EXISTS api_keys (
+        key_hash text PRIMARY KEY,
+        hospital_id integer NOT NULL,
+        label text,
+        created_at timestamptz NOT NULL DEFAULT now(),
+        revoked_at timestamptz
+    )
+    """,
+    # ---- totals of rows moved to the Parquet archive ---- #
+    """
+    CREATE TABLE IF NOT EXISTS archived_patient_stats (
+        hospital_id integer NOT NULL,
+        procedure text NOT NULL,
+        doctor text NOT NULL,
+        total bigint NOT NULL DEFAULT 0,
+        converted bigint NOT NULL DEFAULT 0,
+        revenue numeric NOT NULL DEFAULT 0,
+        PRIMARY KEY (hospital_id, procedure, doctor)
+    )
+    """,
+    # ---- room for salted password hashes (see auth.py) ---- #
+    """
+    DO $$
+    BEGIN
+        IF (SELECT data_type FROM information_schema.columns
+            WHERE table_schema = 'public' AND table_name = 'users'
+            AND column_name = 'password') <> 'text' THEN
+            ALTER TABLE users ALTER COLUMN password TYPE text;
+        END IF;
+    END
+    $$
+    """,
+    # ---- background jobs (see jobs.py) ---- #
+    """
+    CREATE TABLE IF NOT EXISTS jobs (
+        id bigserial PRIMARY KEY,
+        hospital_id integer NOT NULL,
+        user_id integer,
+        kind text NOT NULL,
+        params jsonb NOT NULL DEFAULT '{}',
+        status text NOT NULL DEFAULT 'queued',
+        progress real NOT NULL DEFAULT 0,
+        message text,
+        result_path text,
+        result_name text,
+        error text,
+        cancel_requested boolean NOT NULL DEFAULT false,
+        created_at timestamptz NOT NULL DEFAULT now(),
+        started_at timestamptz,
+        heartbeat_at timestamptz,
+        finished_at timestamptz
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS jobs_queued_idx ON jobs (id) WHERE status = 'queued'",
+    "CREATE INDEX IF NOT EXISTS jobs_hospital_idx ON jobs (hospital_id, id DESC)",
+    # ---- conversion likelihood scores (see scoring.py) ---- #
+    """
+    CREATE TABLE IF NOT EXISTS conversion_models (
+        version text PRIMARY KEY,
+        hospital_id integer NOT NULL,
+        trained_at timestamp NOT NULL,
+        rows integer NOT NULL,
+        auc real,
+        model jsonb NOT NULL
+    )
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS conversion_models_hospital_idx
+    ON conversion_models (hospital_id, trained_at DESC)
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS patient_scores (
+        hospital_id integer NOT NULL,
+        patient_id text NOT NULL,
+        score real NOT NULL,
+        model_version text NOT NULL,
+        row_updated_at timestamptz NOT NULL,
+        scored_at timestamptz NOT NULL DEFAULT now(),
+        PRIMARY KEY (hospital_id, patient_id)
+    )
+    """,
+    # ---- duplicate detection on normalised phone (see dedupe.py) ---- #
+    r"""
+    CREATE OR REPLACE FUNCTION normalise_phone(p text) RETURNS text AS $$
+        SELECT NULLIF(right(regexp_replace(COALESCE(p, ''), '\D', '', 'g'), 10), '')
+    $$ LANGUAGE sql IMMUTABLE
+    """,
+    """
+    CREATE OR REPLACE FUNCTION patient_names_match(a text, b text) RETURNS boolean AS $$
+        SELECT length(x) >= 3 AND length(y) >= 3
+               AND (x = y OR left(x, length(y)) = y OR left(y, length(x)) = x)
+        FROM (SELECT lower(regexp_replace(COALESCE(a, ''), '[^[:alpha:]]', '', 'g')) AS x,
+                     lower(regexp_replace(COALESCE(b, ''), '[^[:alpha:]]', '', 'g')) AS y) n
+    $$ LANGUAGE sql IMMUTABLE
+    """,
+    "ALTER TABLE patients ADD COLUMN IF NOT EXISTS phone_norm text",
+    """
+    CREATE OR REPLACE FUNCTION set_phone_norm() RETURNS trigger AS $$
+    BEGIN
+        NEW.phone_norm := normalise_phone(NEW.phone);
+        RETURN NEW;
+    END
+    $$ LANGUAGE plpgsql
+    """,
+    "DROP TRIGGER IF EXISTS patients_set_phone_norm ON patients",
+    """
+    CREATE TRIGGER patients_set_phone_norm
+    BEFORE INSERT OR UPDATE OF phone ON patients
+    FOR EACH ROW EXECUTE FUNCTION set_phone_norm()
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS patients_hospital_phone_idx
+    ON patients (hospital_id, phone_norm, created_on)
+    WHERE phone_norm IS NOT NULL
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS patient_merges (
+        id bigserial PRIMARY KEY,
+        hospital_id integer NOT NULL,
+        kept_patient_id text NOT NULL,
+        merged_patient_id text NOT NULL,
+        merged_row jsonb NOT NULL,
+        merged_at timestamptz NOT NULL DEFAULT now()
+    )
+    """,
+    # ---- conversions by date for the Trends page (see trends.py) ---- #
+    """
+    CREATE INDEX IF NOT EXISTS patients_hospital_converted_idx
+    ON patients (hospital_id, converted_on) INCLUDE (cost)
+    WHERE converted_on IS NOT NULL
+    """,
+    # ---- per-tenant data version for cache revalidation (see data_version) ---- #
+    """
+    CREATE TABLE IF NOT EXISTS patient_data_versions (
+        hospital_id integer PRIMARY KEY,
+        version bigint NOT NULL DEFAULT 0
+    )
+    """,
+    # Statement-level, so a bulk write bumps each tenant once. Tenants are
+    # bumped in id order so multi-tenant statements cannot deadlock.
+    """
+    CREATE OR REPLACE FUNCTION bump_data_version() RETURNS trigger AS $$
+    BEGIN
+        INSERT INTO patient_data_versions AS v (hospital_id, version)
+        SELECT DISTINCT hospital_id, 1 FROM changed
+        WHERE hospital_id IS NOT NULL
+        ORDER BY 1
+        ON CONFLICT (hospital_id) DO UPDATE SET version = v.version + 1;
+        RETURN NULL;
+    END
+    $$ LANGUAGE plpgsql
+    """,
+    "DROP TRIGGER IF EXISTS patients_version_insert ON patients",
+    """
+    CREATE TRIGGER patients_version_insert
+    AFTER INSERT ON patients
+    REFERENCING NEW TABLE AS changed
+    FOR EACH STATEMENT EXECUTE FUNCTION bump_data_version()
+    """,
+    "DROP TRIGGER IF EXISTS patients_version_update ON patients",
+    """
+    CREATE TRIGGER patients_version_update
+    AFTER UPDATE ON patients
+    REFERENCING NEW TABLE AS changed
+    FOR EACH STATEMENT EXECUTE FUNCTION bump_data_version()
+    """,
+    "DROP TRIGGER IF EXISTS patients_version_delete ON patients",
+    """
+    CREATE TRIGGER patients_version_delete
+    AFTER DELETE ON patients
+    REFERENCING OLD TABLE AS changed
+    FOR EACH STATEMENT EXECUTE FUNCTION bump_data_version()
+    """,
+    # ---- server-side sessions behind the signed tokens (see auth.py) ---- #
+    """
+    CREATE TABLE IF NOT EXISTS user_sessions (
+        id text PRIMARY KEY,
+        user_id integer NOT NULL,
+        created_at timestamptz NOT NULL DEFAULT now(),
+        expires_at timestamptz NOT NULL,
+        revoked_at timestamptz
+    )
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS user_sessions_user_idx
+    ON user_sessions (user_id, expires_at)
+    """,
+    # ---- Daily Reminders buckets its rows itself; drop the unread copies ---- #
+    """
+    ALTER TABLE reminder_worklist
+    DROP COLUMN IF EXISTS days_pending,
+    DROP COLUMN IF EXISTS bucket,
+    DROP COLUMN IF EXISTS priority
+    """,
+]
+
+# Months of empty partitions kept ahead of today once patients is
+# range-partitioned (see partition_patients.py).
+PARTITION_MONTHS_AHEAD = 3
+
+
+SCHEMA_VERSION_SQL = """
+    CREATE TABLE IF NOT EXISTS schema_version (
+        id boolean PRIMARY KEY DEFAULT true CHECK (id),
+        applied integer NOT NULL
+    )
+"""
+
+CREATE_INDEX = re.compile(
+    r"^\s*CREATE\s+(?:UNIQUE\s+)?INDEX\s+IF\s+NOT\s+EXISTS\s+(\w+)\s+ON\s+(\w+)", re.I
+)
+
+
+def applied_version(cur):
+    cur.execute("SELECT to_regclass('schema_version') IS NOT NULL")
+    if not cur.fetchone()[0]:
+        return 0
+    cur.execute("SELECT applied FROM schema_version")
+    row = cur.fetchone()
+    return row[0] if row else 0
+
+
+def set_applied_version(cur, applied):
+    cur.execute("""
+        INSERT INTO schema_version (id, applied) VALUES (true, %s)
+        ON CONFLICT (id) DO UPDATE SET applied = EXCLUDED.applied
+    """, (applied,))
+
+
+def create_index_concurrently(conn, stmt, name):
+    # Built outside a transaction so writes carry on meanwhile. A build that
+    # failed half way leaves an invalid index, which IF NOT EXISTS would
+    # keep; it is dropped and built again.
+    with conn.cursor() as cur:
+        cur.execute("""
+            SELECT i.indisvalid FROM pg_index i
+            JOIN pg_class c ON c.oid = i.indexrelid
+            WHERE c.relname = %s AND c.relnamespace = 'public'::regnamespace
+        """, (name,))
+        row = cur.fetchone()
+    conn.commit()
+    if row and row[0]:
+        return
+
+    conn.autocommit = True
+    try:
+        with conn.cursor() as cur:
+            if row:
+                cur.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {name}")
+            cur.execute(re.sub(r"\bINDEX\b", "INDEX CONCURRENTLY", stmt, count=1))
+    finally:
+        conn.autocommit = False
+
+
+def migrate(conn, applied):
+    # Plain statements run in one transaction per run of them, so a
+    # DROP/CREATE TRIGGER pair is never seen half done; indexes on existing
+    # tables are built concurrently between them. Partitioned tables cannot
+    # build concurrently and take the plain CREATE INDEX.
+    pending = False
+    for n in range(applied, len(SCHEMA_SQL)):
+        stmt = SCHEMA_SQL[n]
+        index = CREATE_INDEX.match(stmt)
+        with conn.cursor() as cur:
+            concurrent = bool(index) and not is_partitioned(cur, index.group(2).lower())
+            if not concurrent:
+                cur.execute(stmt)
+                set_applied_version(cur, n + 1)
+                pending = True
+                continue
+        conn.commit()
+        create_index_concurrently(conn, stmt, index.group(1))
+        with conn.cursor() as cur:
+            set_applied_version(cur, n + 1)
+        conn.commit()
+        pending = False
+    if pending:
+        conn.commit()
+
+
+def ensure_schema(conn, replay=False):
+    # replay re-runs every statement, e.g. after partition_patients.py
+    # swapped in a new patients table that lacks the triggers and indexes.
+    with conn.cursor() as cur:
+        behind = replay or applied_version(cur) < len(SCHEMA_SQL)
+    conn.rollback()
+
+    if behind:
+        with conn.cursor() as cur:
+            cur.execute("SET statement_timeout = 0")
+            cur.execute("SELECT pg_advisory_lock(%s)", (SCHEMA_LOCK_ID,))
+            cur.execute(SCHEMA_VERSION_SQL)
+            applied = 0 if replay else applied_version(cur)
+        conn.commit()
+        try:
+            migrate(conn, applied)
+        finally:
+            conn.rollback()
+            with conn.cursor() as cur:
+                cur.execute("SELECT pg_advisory_unlock(%s)", (SCHEMA_LOCK_ID,))
+                cur.execute("RESET statement_timeout")
+            conn.commit()
+
+    with conn.cursor() as cur:
+        if is_partitioned(cur, "patients"):
+            ensure_partitions(cur, "patients")
+    conn.commit()
+
+# ================== PARTITIONS ================== #
+
+def is_partitioned(cur, table):
+    cur.execute("""
+        SELECT 1 FROM pg_partitioned_table pt
+        JOIN pg_class c ON c.oid = pt.partrelid
+        WHERE c.relname = %s AND c.relnamespace = 'public'::regnamespace
+    """, (table,))
+    return cur.fetchone() is not None
+
+
+def month_start(d):
+    return date(d.year, d.month, 1)
+
+
+def add_months(d, n):
+    month = d.month - 1 + n
+    return date(d.year + month // 12, month % 12 + 1, 1)
+
+
+def ensure_partitions(cur, table, start=None, end=None):
+    # Monthly partitions on created_on from start (default: this month) up
+    # to PARTITION_MONTHS_AHEAD months ahead. Existing ones are skipped.
+    month = month_start(start or date.today())
+    end = end or add_months(date.today(), PARTITION_MONTHS_AHEAD + 1)
+
+    # Checked in the catalog first: CREATE TABLE ... PARTITION OF locks the
+    # parent even when the partition already exists.
+    cur.execute("""
+        SELECT c.relname FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = %s::regclass
+    """, (table,))
+    existing = {x[0] for x in cur.fetchall()}
+
+    created = []
+    while month < end:
+        nxt = add_months(month, 1)
+        name = f"{table}_p{month:%Y%m}"
+        if name in existing:
+            month = nxt
+            continue
+
+        # A month whose rows already landed in the default partition cannot
+        # be attached; skip it rather than failing the whole schema pass.
+        cur.execute("SAVEPOINT add_partition")
+        try:
+            cur.execute(f"""
+                CREATE TABLE IF NOT EXISTS {name}
+                PARTITION OF {table}
+                FOR VALUES FROM ('{month}') TO ('{nxt}')
+            """)
+        except psycopg2.Error:
+            cur.execute("ROLLBACK TO SAVEPOINT add_partition")
+        else:
+            cur.execute("RELEASE SAVEPOINT add_partition")
+            created.append(name)
+        month = nxt
+    return created
+
+# ================== PATIENTS ================== #
+
+PATIENT_COLUMNS = [
+    "id","patient_id","name","phone","city","age","gender",
+    "vision_od","vision_os","procedure","iol",
+    "doctor","counsellor","cost","status","created_on","hospital_id"
+]
+
+PATIENT_SELECT = ", ".join(PATIENT_COLUMNS)
+
+PATIENT_INSERT_COLUMNS = [
+    "patient_id","name","phone","city","age","gender",
+    "vision_od","vision_os","procedure","iol",
+    "doctor","counsellor","cost","status","created_on"
+]
+
+
+def insert_patient(cur, hospital_id, record):
+    # Returns False when the patient_id is already stored, which makes
+    # replaying a queued save harmless. The check and insert are serialised
+    # per patient_id with a transaction lock: a unique index is not possible
+    # once patients is range-partitioned, as it would have to include
+    # created_on.
+    cur.execute(
+        "SELECT pg_advisory_xact_lock(hashtextextended(%s, 0))",
+        (f"patient:{hospital_id}:{record['patient_id']}",)
+    )
+    cur.execute(
+        "SELECT 1 FROM patients WHERE hospital_id=%s AND patient_id=%s",
+        (hospital_id, record["patient_id"])
+    )
+    if cur.fetchone():
+        return False
+
+    cur.execute(f"""
+        INSERT INTO patients
+        ({", ".join(PATIENT_INSERT_COLUMNS)}, hospital_id)
+        VALUES ({", ".join(["%s"] * (len(PATIENT_INSERT_COLUMNS) + 1))})
+    """, [record[c] for c in PATIENT_INSERT_COLUMNS] + [hospital_id])
+    return True
+
+
+# Same hospital, same normalised phone, same procedure, matching names and
+# registered within this many days of each other.
+DUPLICATE_WINDOW_DAYS = 90
+
+
+def find_duplicates(cur, hospital_id, record, window_days=DUPLICATE_WINDOW_DAYS):
+    cur.execute(f"""
+        SELECT {PATIENT_SELECT}
+        FROM patients
+        WHERE hospital_id=%(hid)s
+        AND phone_norm = normalise_phone(%(phone)s)
+        AND created_on BETWEEN %(created)s - make_interval(days => %(days)s)
+                           AND %(created)s + make_interval(days => %(days)s)
+        AND procedure IS NOT DISTINCT FROM %(procedure)s
+        AND patient_names_match(name, %(name)s)
+        AND patient_id <> %(pid)s
+        ORDER BY created_on
+    """, {
+        "hid": hospital_id,
+        "phone": record["phone"],
+        "created": record["created_on"],
+        "days": window_days,
+        "procedure": record["procedure"],
+        "name": record["name"],
+        "pid": record["patient_id"],
+    })
+    return pd.DataFrame(cur.fetchall(), columns=PATIENT_COLUMNS)
+
+
+# Bulk import: each chunk is COPYed into a temp table, classified there and
+# inserted with one statement. Classification follows insert_patient and
+# find_duplicates, with earlier rows of the same file counting as stored.
+IMPORT_COLUMNS = ["line"] + PATIENT_INSERT_COLUMNS
+
+IMPORT_STAGE_SQL = [
+    """
+    CREATE TEMP TABLE IF NOT EXISTS import_rows (
+        line integer NOT NULL,
+        patient_id text, name text, phone text, city text, age integer,
+        gender text, vision_od text, vision_os text, procedure text, iol text,
+        doctor text, counsellor text, cost numeric, status text,
+        created_on timestamp,
+        phone_norm text,
+        outcome text
+    ) ON COMMIT DELETE ROWS
+    """,
+    "CREATE INDEX IF NOT EXISTS import_rows_patient_idx ON import_rows (patient_id, line)",
+    "CREATE INDEX IF NOT EXISTS import_rows_phone_idx ON import_rows (phone_norm, line)",
+]
+
+IMPORT_CLASSIFY_SQL = """
+    UPDATE import_rows r SET outcome = CASE
+        WHEN EXISTS (
+            SELECT 1 FROM patients p
+            WHERE p.hospital_id=%(hid)s AND p.patient_id=r.patient_id
+        ) OR EXISTS (
+            SELECT 1 FROM import_rows e
+            WHERE e.patient_id=r.patient_id AND e.line < r.line
+        ) THEN 'present'
+        WHEN r.phone_norm IS NOT NULL AND (EXISTS (
+            SELECT 1 FROM patients p
+            WHERE p.hospital_id=%(hid)s
+            AND p.phone_norm = r.phone_norm
+            AND p.created_on BETWEEN r.created_on - make_interval(days => %(days)s)
+                                 AND r.created_on + make_interval(days => %(days)s)
+            AND p.procedure IS NOT DISTINCT FROM r.procedure
+            AND patient_names_match(p.name, r.name)
+        ) OR EXISTS (
+            SELECT 1 FROM import_rows e
+            WHERE e.phone_norm = r.phone_norm AND e.line < r.line
+            AND e.created_on BETWEEN r.created_on - make_interval(days => %(days)s)
+                                 AND r.created_on + make_interval(days => %(days)s)
+            AND e.procedure IS NOT DISTINCT FROM r.procedure
+            AND patient_names_match(e.name, r.name)
+        )) THEN 'duplicate'
+        ELSE 'add'
+    END
+"""
+
+
+def import_patients(cur, hospital_id, frame, window_days=DUPLICATE_WINDOW_DAYS):
+    # frame: validated rows in IMPORT_COLUMNS order. Returns counts per
+    # outcome: add(ed), present, duplicate. The caller commits.
+    for stmt in IMPORT_STAGE_SQL:
+        cur.execute(stmt)
+    data = io.StringIO(frame[IMPORT_COLUMNS].to_csv(index=False, header=False))
+    cur.copy_expert(
+        f"COPY import_rows ({', '.join(IMPORT_COLUMNS)}) FROM STDIN WITH (FORMAT csv)", data
+    )
+    cur.execute("UPDATE import_rows SET phone_norm = normalise_phone(phone)")
+    cur.execute(IMPORT_CLASSIFY_SQL, {"hid": hospital_id, "days": window_days})
+    cur.execute(f"""
+        INSERT INTO patients ({", ".join(PATIENT_INSERT_COLUMNS)}, hospital_id)
+        SELECT {", ".join(PATIENT_INSERT_COLUMNS)}, %s
+        FROM import_rows
+        WHERE outcome = 'add'
+        ORDER BY line
+    """, (hospital_id,))
+    cur.execute("SELECT outcome, COUNT(*) FROM import_rows GROUP BY outcome")
+    return dict(cur.fetchall())
+
+
+UPDATE_STATUS = prepared.register("update_status", """
+    UPDATE patients SET status=%s
+    WHERE hospital_id=%s AND patient_id = ANY(%s) AND status <> %s
+""")
+
+
+def update_status(cur, hospital_id, patient_ids, status, user_id=None):
+    # One statement for any number of patients; the status-event and
+    # converted_on triggers run inside the same transaction.
+    if user_id is not None:
+        cur.execute("SELECT set_config('app.user_id', %s, true)", (str(user_id),))
+    prepared.execute(cur, UPDATE_STATUS, (status, hospital_id, list(patient_ids), status))
+    return cur.rowcount
+
+
+def missing_patients(cur, hospital_id, patient_ids):
+    cur.execute("""
+        SELECT p.id FROM unnest(%s::text[]) AS p(id)
+        WHERE NOT EXISTS (
+            SELECT 1 FROM patients WHERE hospital_id=%s AND patient_id=p.id
+        )
+    """, (list(patient_ids), hospital_id))
+    return [x[0] for x in cur.fetchall()]
+
+
+def convert_patients(conn, hospital_id, patient_ids, user_id=None):
+    with conn.cursor() as cur:
+        converted = update_status(cur, hospital_id, patient_ids, "Converted", user_id)
+    conn.commit()
+    return converted
+
+# ================== STREAMING FETCH ================== #
+
+# Rows pulled per round trip from a server-side cursor. Peak client memory
+# is one chunk of tuples plus whatever the caller keeps, not the full result.
+FETCH_ITERSIZE = int(os.environ.get("FETCH_ITERSIZE", "2000"))
+
+
+def stream_frames(conn, sql, params, columns, itersize=None):
+    itersize = itersize or FETCH_ITERSIZE
+
+    # Named cursors live server-side and only exist inside a transaction,
+    # which is closed again once the generator is exhausted or dropped.
+    cur = conn.cursor(name=f"stream_{uuid.uuid4().hex[:12]}")
+    cur.itersize = itersize
+    try:
+        cur.execute(sql, params)
+        while True:
+            rows = cur.fetchmany(itersize)
+            if not rows:
+                break
+            yield pd.DataFrame(rows, columns=columns)
+    finally:
+        cur.close()
+        conn.rollback()
+
+
+def read_frame(conn, sql, params, columns, itersize=None):
+    chunks = list(stream_frames(conn, sql, params, columns, itersize))
+    if not chunks:
+        return pd.DataFrame(columns=columns)
+    return pd.concat(chunks, ignore_index=True)
+
+
+def frame_chunks(df, size=None):
+    size = size or FETCH_ITERSIZE
+    for start in range(0, len(df), size):
+        yield df.iloc[start:start + size]
+
+
+def csv_export(chunks, columns):
+    out = io.BytesIO()
+    header = True
+    for chunk in chunks:
+        out.write(chunk.to_csv(index=False, header=header).encode("utf-8"))
+        header = False
+    if header:
+        out.write((",".join(columns) + "\n").encode("utf-8"))
+    out.seek(0)
+    return out
+
+# ================== DELTA SYNC ================== #
+
+# Rows committed by a transaction that started before the watermark was read
+# carry an older updated_at, so each delta re-reads a short overlap window.
+# Merging is keyed on id, which makes re-reading the same rows harmless.
+DELTA_OVERLAP = timedelta(seconds=10)
+
+# Tombstones older than this may be pruned, so a cache entry that has not
+# synced for that long is rebuilt from scratch instead.
+TOMBSTONE_RETENTION = timedelta(days=1)
+
+SYNC_COLUMNS = PATIENT_COLUMNS + ["updated_at"]
+
+
+def fetch_patients(conn, hospital_id):
+    return read_frame(conn, f"""
+        SELECT {", ".join(SYNC_COLUMNS)}
+        FROM patients
+        WHERE hospital_id=%s
+        ORDER BY created_on DESC
+    """, (hospital_id,), SYNC_COLUMNS)
+
+
+def fetch_patient_delta(cur, hospital_id, since):
+    cur.execute(f"""
+        SELECT {", ".join(SYNC_COLUMNS)}
+        FROM patients
+        WHERE hospital_id=%s AND updated_at > %s
+    """, (hospital_id, since))
+    changed = pd.DataFrame(cur.fetchall(), columns=SYNC_COLUMNS)
+
+    cur.execute("""
+        SELECT id
+        FROM patients_deleted
+        WHERE hospital_id=%s AND deleted_at > %s
+    """, (hospital_id, since))
+    deleted_ids = [x[0] for x in cur.fetchall()]
+
+    return changed, deleted_ids
+
+
+def merge_patient_delta(df, changed, deleted_ids):
+    if changed.empty and not deleted_ids:
+        return df
+
+    drop_ids = set(changed["id"]) | set(deleted_ids)
+    kept = df[~df["id"].isin(drop_ids)]
+
+    # Deleted ids can reappear in `changed` only if re-inserted with the same
+    # id, in which case the fresh row wins.
+    merged = pd.concat([kept, changed], ignore_index=True) if not changed.empty else kept
+    return merged.sort_values("created_on", ascending=False, ignore_index=True)
+
+
+def prune_patient_tombstones(conn):
+    with conn.cursor() as cur:
+        cur.execute(
+            "DELETE FROM patients_deleted WHERE deleted_at < now() - %s",
+            (TOMBSTONE_RETENTION,)
+        )
+    conn.commit()
+
+
+def data_version(cur, hospital_id):
+    # A counter bumped inside every writing transaction, so it moves exactly
+    # when the write becomes visible. MAX(updated_at) could not: a
+    # transaction committing late with an earlier clock_timestamp() left it
+    # unchanged. Concurrent writers to one tenant queue on the counter row
+    # until commit.
+    cur.execute(
+        "SELECT version FROM patient_data_versions WHERE hospital_id=%s",
+        (hospital_id,)
+    )
+    row = cur.fetchone()
+    return str(row[0] if row else 0)
+
+
+def server_now(cur):
+    cur.execute("SELECT clock_timestamp()")
+    return cur.fetchone()[0]
+
+
+class PatientCache:
+    # Process-wide cache of each tenant's patients. The first read loads the
+    # full table; every later read only pulls rows touched since the stored
+    # watermark and merges them in. Returned frames are shared between
+    # sessions and must be treated as read-only.
+    #
+    # Under memory pressure a tenant's frame is spilled to a pickle with its
+    # watermark (see memory.py); the next read loads it back and delta-syncs
+    # as usual.
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._tenant_locks = {}
+        self._entries = {}
+
+    def _tenant_lock(self, hospital_id):
+        with self._lock:
+            return self._tenant_locks.setdefault(hospital_id, threading.Lock())
+
+    def get(self, conn, hospital_id):
+        with self._tenant_lock(hospital_id):
+            entry = self._entries.get(hospital_id)
+            if entry is not None and "df" not in entry:
+                entry = self._unspill(entry)
+
+            with conn.cursor() as cur:
+                now = server_now(cur)
+
+                if entry is not None and now - entry["watermark"] <= TOMBSTONE_RETENTION:
+                    changed, deleted_ids = fetch_patient_delta(
+                        cur, hospital_id, entry["watermark"] - DELTA_OVERLAP
+                    )
+                    df = merge_patient_delta(entry["df"], changed, deleted_ids)
+                else:
+                    df = None
+
+            # Read-only statements still open a transaction in psycopg2.
+            conn.rollback()
+
+            if df is None:
+                df = fetch_patients(conn, hospital_id)
+
+            self._entries[hospital_id] = {"df": df, "watermark": now, "used": time.monotonic()}
+            return df
+
+    def invalidate(self, hospital_id=None):
+        with self._lock:
+            if hospital_id is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(hospital_id, None)
+
+    def entries(self):
+        with self._lock:
+            return [
+                (hid, hid, e["df"], e["used"])
+                for hid, e in self._entries.items() if "df" in e
+            ]
+
+    def evict(self, hospital_id):
+        self.invalidate(hospital_id)
+
+    def spill(self, hospital_id, directory):
+        with self._tenant_lock(hospital_id):
+            entry = self._entries.get(hospital_id)
+            if entry is None or "df" not in entry:
+                return
+            os.makedirs(directory, exist_ok=True)
+            # Unique per process and spill: app processes share the directory,
+            # and another's frame would be at a different watermark.
+            path = os.path.join(
+                directory, f"patients_{hospital_id}_{os.getpid()}_{uuid.uuid4().hex[:8]}.pkl"
+            )
+            entry["df"].to_pickle(path)
+            self._entries[hospital_id] = {
+                "path": path, "watermark": entry["watermark"], "used": entry["used"]
+            }
+
+    def _unspill(self, entry):
+        # A missing or unreadable file just means a full reload.
+        try:
+            df = pd.read_pickle(entry["path"])
+        except (OSError, ValueError, EOFError):
+            return None
+        finally:
+            try:
+                os.remove(entry["path"])
+            except OSError:
+                pass
+        return {**entry, "df": df}
+
+# ================== REFERENCE LISTS ================== #
+
+# Dropdown sources for the Patients form, fetched in a single round trip.
+REFERENCE_SQL = """
+    SELECT
+        (SELECT COALESCE(json_agg(name ORDER BY id), '[]') FROM procedures),
+        (SELECT COALESCE(json_agg(name ORDER BY id), '[]') FROM iol_types),
+        (SELECT COALESCE(json_agg(name ORDER BY id), '[]') FROM doctors WHERE hospital_id=%s),
+        (SELECT COALESCE(json_agg(name ORDER BY id), '[]') FROM counsellors WHERE hospital_id=%s)
+"""
+
+# Other app processes cannot invalidate this one, so entries also expire.
+REFERENCE_TTL = 300
+
+
+def fetch_reference_lists(cur, hospital_id):
+    cur.execute(REFERENCE_SQL, (hospital_id, hospital_id))
+    procedures, iol_types, doctors, counsellors = cur.fetchone()
+    return {
+        "procedures": procedures,
+        "iol_types": iol_types,
+        "doctors": doctors,
+        "counsellors": counsellors,
+    }
+
+
+class ReferenceCache:
+
+    def __init__(self, ttl=REFERENCE_TTL):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = {}
+
+    def get(self, conn, hospital_id):
+        with self._lock:
+            entry = self._entries.get(hospital_id)
+        if entry is not None and time.monotonic() - entry[0] < self.ttl:
+            return entry[1]
+
+        with conn.cursor() as cur:
+            lists = fetch_reference_lists(cur, hospital_id)
+        conn.rollback()
+
+        with self._lock:
+            self._entries[hospital_id] = (time.monotonic(), lists)
+        return lists
+
+    def invalidate(self, hospital_id=None):
+        # Procedures and IOL types are shared, so changing them drops every
+        # tenant; doctors and counsellors only drop their own hospital.
+        with self._lock:
+            if hospital_id is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(hospital_id, None)
+
+# ================== TIME TO CONVERSION ================== #
+
+def conversion_lag(cur, hospital_id, dimension):
+    # dimension is a trusted column name ("procedure" or "doctor"); the
+    # partial indexes above make this an index-only scan per tenant.
+    if dimension not in ("procedure", "doctor"):
+        raise ValueError(dimension)
+
+    cur.execute(f"""
+        SELECT {dimension},
+               COUNT(*) AS converted,
+               percentile_cont(0.5) WITHIN GROUP (ORDER BY lag_days) AS median_days,
+               percentile_cont(0.9) WITHIN GROUP (ORDER BY lag_days) AS p90_days
+        FROM (
+            SELECT {dimension},
+                   EXTRACT(EPOCH FROM converted_on - created_on) / 86400 AS lag_days
+            FROM patients
+            WHERE hospital_id=%s AND converted_on IS NOT NULL
+        ) t
+        GROUP BY {dimension}
+        ORDER BY median_days
+    """, (hospital_id,))
+    return pd.DataFrame(cur.fetchall(), columns=[
+        dimension, "converted", "median_days", "p90_days"
+    ])
+
+# ================== ARCHIVED TOTALS ================== #
+
+def archived_stats(cur, hospital_id):
+    cur.execute("""
+        SELECT procedure, doctor, total, converted, revenue
+        FROM archived_patient_stats
+        WHERE hospital_id=%s
+    """, (hospital_id,))
+    return pd.DataFrame(cur.fetchall(), columns=[
+        "procedure", "doctor", "total", "converted", "revenue"
+    ])
+
+# ================== MASTER OVERVIEW ================== #
+
+OVERVIEW_SORTS = {
+    "name": "h.name",
+    "patients": "total",
+    "conversion": "conversion_rate",
+    "revenue": "revenue",
+    "last_activity": "last_activity",
+}
+
+OVERVIEW_COLUMNS = [
+    "id", "name", "subscription", "total", "converted", "conversion_rate",
+    "revenue", "last_activity", "hospitals", "all_total", "all_converted",
+    "all_revenue"
+]
+
+
+def like_escape(text):
+    # Typed % and _ match literally.
+    return text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+def hospital_overview(cur, sort="patients", descending=True, limit=25, offset=0, search=""):
+    # One grouped pass over patients (plus archived totals) for every
+    # hospital; window aggregates carry the unpaginated totals along.
+    order = OVERVIEW_SORTS[sort]
+    direction = "DESC" if descending else "ASC"
+
+    cur.execute(f"""
+        WITH hot AS (
+            SELECT hospital_id,
+                   COUNT(*) AS total,
+                   COUNT(*) FILTER (WHERE status='Converted') AS converted,
+                   COALESCE(SUM(cost) FILTER (WHERE status='Converted'), 0) AS revenue,
+                   MAX(updated_at) AS last_activity
+            FROM patients
+            GROUP BY hospital_id
+        ),
+        cold AS (
+            SELECT hospital_id,
+                   SUM(total) AS total,
+                   SUM(converted) AS converted,
+                   SUM(revenue) AS revenue
+            FROM archived_patient_stats
+            GROUP BY hospital_id
+        ),
+        overview AS (
+            SELECT h.id, h.name, h.subscription,
+                   (COALESCE(hot.total, 0) + COALESCE(cold.total, 0))::bigint AS total,
+                   (COALESCE(hot.converted, 0) + COALESCE(cold.converted, 0))::bigint AS converted,
+                   COALESCE(hot.revenue, 0) + COALESCE(cold.revenue, 0) AS revenue,
+                   hot.last_activity
+            FROM hospitals h
+            LEFT JOIN hot ON hot.hospital_id = h.id
+            LEFT JOIN cold ON cold.hospital_id = h.id
+            WHERE h.name ILIKE %s ESCAPE '\\'
+        )
+        SELECT id, name, subscription, total, converted,
+               ROUND(converted * 100.0 / NULLIF(total, 0), 1) AS conversion_rate,
+               revenue, last_activity,
+               COUNT(*) OVER () AS hospitals,
+               SUM(total) OVER () AS all_total,
+               SUM(converted) OVER () AS all_converted,
+               SUM(revenue) OVER () AS all_revenue
+        FROM overview h
+        ORDER BY {order} {direction} NULLS LAST, id
+        LIMIT %s OFFSET %s
+    """, (f"%{like_escape(search)}%", limit, offset))
+    return pd.DataFrame(cur.fetchall(), columns=OVERVIEW_COLUMNS)
+
+
+def set_subscriptions(conn, hospital_ids, subscription):
+    with conn.cursor() as cur:
+        cur.execute(
+            "UPDATE hospitals SET subscription=%s WHERE id = ANY(%s)",
+            (subscription, list(hospital_ids))
+        )
+        changed = cur.rowcount
+    conn.commit()
+    return changed
+
+# ================== TENANT ANALYTICS ================== #
+
+# Shared by the Streamlit pages and the KPI endpoint (kpi_api.py). Each
+# adds the archived totals so figures survive archival.
+
+def tenant_kpis(cur, hospital_id):
+    cur.execute("""
+        SELECT SUM(total)::bigint, SUM(converted)::bigint, SUM(pending)::bigint,
+               COALESCE(SUM(revenue_done), 0), COALESCE(SUM(revenue_pending), 0)
+        FROM (
+            SELECT COUNT(*) AS total,
+                   COUNT(*) FILTER (WHERE status='Converted') AS converted,
+                   COUNT(*) FILTER (WHERE status='Pending') AS pending,
+                   SUM(cost) FILTER (WHERE status='Converted') AS revenue_done,
+                   SUM(cost) FILTER (WHERE status='Pending') AS revenue_pending
+            FROM patients
+            WHERE hospital_id=%s
+            UNION ALL
+            SELECT SUM(total), SUM(converted), 0, SUM(revenue), 0
+            FROM archived_patient_stats
+            WHERE hospital_id=%s
+        ) t
+    """, (hospital_id, hospital_id))
+    total, converted, pending, revenue_done, revenue_pending = cur.fetchone()
+    total = total or 0
+    converted = converted or 0
+    return {
+        "total_advised": total,
+        "converted": converted,
+        "pending": pending or 0,
+        "conversion_rate": round(converted / total * 100, 1) if total else 0.0,
+        "revenue_done": float(revenue_done),
+        "revenue_pending": float(revenue_pending),
+    }
+
+
+CONVERSION_BY_PROCEDURE = prepared.register("conversion_by_procedure", """
+    SELECT procedure,
+           SUM(total)::bigint AS total,
+           SUM(converted)::bigint AS converted,
+           SUM(pending)::bigint AS pending
+    FROM (
+        SELECT procedure,
+               COUNT(*) AS total,
+               SUM(CASE WHEN status='Converted' THEN 1 ELSE 0 END) AS converted,
+               SUM(CASE WHEN status='Pending' THEN 1 ELSE 0 END) AS pending
+        FROM patients
+        WHERE hospital_id=%s
+        GROUP BY procedure
+        UNION ALL
+        SELECT procedure, total, converted, 0
+        FROM archived_patient_stats
+        WHERE hospital_id=%s
+    ) t
+    GROUP BY procedure
+""")
+
+
+def conversion_by_procedure(cur, hospital_id):
+    prepared.execute(cur, CONVERSION_BY_PROCEDURE, (hospital_id, hospital_id))
+
+    df_conv = pd.DataFrame(cur.fetchall(), columns=[
+        "procedure", "total", "converted", "pending"
+    ])
+
+    df_conv["conversion_rate"] = (
+        df_conv["converted"] / df_conv["total"] * 100
+    ).round(1)
+
+    return df_conv
+
+
+DOCTOR_PERFORMANCE = prepared.register("doctor_performance", """
+    SELECT doctor,
+           SUM(total_cases)::bigint as total_cases,
+           SUM(converted)::bigint as converted,
+           SUM(revenue) as revenue
+    FROM (
+        SELECT doctor,
+               COUNT(*) as total_cases,
+               SUM(CASE WHEN status='Converted' THEN 1 ELSE 0 END) as converted,
+               SUM(cost) as revenue
+        FROM patients
+        WHERE hospital_id=%s
+        GROUP BY doctor
+        UNION ALL
+        SELECT doctor, total, converted, revenue
+        FROM archived_patient_stats
+        WHERE hospital_id=%s
+    ) t
+    GROUP BY doctor
+""")
+
+
+def doctor_performance(cur, hospital_id):
+    prepared.execute(cur, DOCTOR_PERFORMANCE, (hospital_id, hospital_id))
+
+    df_doc = pd.DataFrame(cur.fetchall(), columns=[
+        "doctor","total_cases","converted","revenue"
+    ])
+
+    df_doc["conversion_rate"] = (
+        df_doc["converted"] / df_doc["total_cases"] * 100
+    ).round(1)
+
+    df_doc["revenue"] = df_doc["revenue"].fillna(0)
+
+    return df_doc
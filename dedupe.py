@@ -0,0 +1,143 @@
+import argparse
+import logging
+import time
+
+from dotenv import load_dotenv
+
+import db
+
+log = logging.getLogger("dedupe")
+
+# Duplicate patients: same hospital, same normalised phone, same procedure,
+# matching names (patient_names_match) and registered within
+# db.DUPLICATE_WINDOW_DAYS of each other. New rows are checked on save and
+# import; this tool cleans up the ones already stored.
+#
+#   python dedupe.py backfill            # once, fills phone_norm for old rows
+#   python dedupe.py merge --dry-run
+#   python dedupe.py merge --hospital 3
+#
+# Within a group the converted row is kept, otherwise the earliest. Merged
+# rows are copied to patient_merges before they are deleted.
+
+BACKFILL_BATCH = 5000
+
+# Every duplicate paired with the best row it duplicates; only rows that are
+# not themselves duplicates can be kept, so chains settle over repeat runs.
+PAIRS_SQL = """
+    WITH pairs AS (
+        SELECT d.id AS dup_id, d.patient_id AS dup_pid,
+               k.id AS keep_id, k.patient_id AS keep_pid,
+               d.hospital_id,
+               ((k.status <> 'Converted'), k.created_on, k.id) AS keep_rank
+        FROM patients d
+        JOIN patients k
+          ON k.hospital_id = d.hospital_id
+         AND k.phone_norm = d.phone_norm
+         AND k.procedure IS NOT DISTINCT FROM d.procedure
+         AND k.created_on BETWEEN d.created_on - make_interval(days => %(days)s)
+                              AND d.created_on + make_interval(days => %(days)s)
+         AND ((k.status <> 'Converted'), k.created_on, k.id)
+           < ((d.status <> 'Converted'), d.created_on, d.id)
+         AND patient_names_match(k.name, d.name)
+        WHERE d.phone_norm IS NOT NULL
+        AND (%(hid)s::int IS NULL OR d.hospital_id = %(hid)s)
+    ),
+    chosen AS (
+        SELECT DISTINCT ON (dup_id) dup_id, dup_pid, keep_id, keep_pid, hospital_id
+        FROM pairs
+        WHERE keep_id NOT IN (SELECT dup_id FROM pairs)
+        ORDER BY dup_id, keep_rank
+    )
+"""
+
+
+def backfill(conn):
+    total = 0
+    while True:
+        with conn.cursor() as cur:
+            cur.execute("""
+                UPDATE patients SET phone_norm = normalise_phone(phone)
+                WHERE id IN (
+                    SELECT id FROM patients
+                    WHERE phone_norm IS NULL AND phone ~ '[0-9]'
+                    LIMIT %s
+                )
+            """, (BACKFILL_BATCH,))
+            done = cur.rowcount
+        conn.commit()
+        total += done
+        if done < BACKFILL_BATCH:
+            return total
+
+
+def find_pairs(conn, hospital_id=None, window_days=db.DUPLICATE_WINDOW_DAYS):
+    with conn.cursor() as cur:
+        cur.execute(PAIRS_SQL + """
+            SELECT hospital_id, keep_pid, dup_pid FROM chosen
+            ORDER BY hospital_id, keep_pid, dup_pid
+        """, {"hid": hospital_id, "days": window_days})
+        rows = cur.fetchall()
+    conn.rollback()
+    return rows
+
+
+def merge(conn, hospital_id=None, window_days=db.DUPLICATE_WINDOW_DAYS):
+    # One statement per pass: archive the duplicates, then delete them.
+    with conn.cursor() as cur:
+        cur.execute("SET LOCAL statement_timeout = 0")
+        cur.execute(PAIRS_SQL + """
+            , saved AS (
+                INSERT INTO patient_merges (hospital_id, kept_patient_id, merged_patient_id, merged_row)
+                SELECT c.hospital_id, c.keep_pid, c.dup_pid, to_jsonb(p)
+                FROM chosen c
+                JOIN patients p ON p.id = c.dup_id
+                RETURNING merged_patient_id
+            )
+            DELETE FROM patients p
+            USING chosen c
+            WHERE p.id = c.dup_id
+        """, {"hid": hospital_id, "days": window_days})
+        merged = cur.rowcount
+    conn.commit()
+    return merged
+
+# ================== CLI ================== #
+
+def main():
+    load_dotenv()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(name)s %(message)s")
+
+    parser = argparse.ArgumentParser(description="Find and merge duplicate patients")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    sub.add_parser("backfill", help="fill phone_norm for existing rows")
+    m = sub.add_parser("merge")
+    m.add_argument("--hospital", type=int)
+    m.add_argument("--window-days", type=int, default=db.DUPLICATE_WINDOW_DAYS)
+    m.add_argument("--dry-run", action="store_true")
+    args = parser.parse_args()
+
+    conn = db.connect()
+    db.ensure_schema(conn)
+
+    if args.cmd == "backfill":
+        started = time.monotonic()
+        log.info("normalised %s phones in %.1fs", backfill(conn), time.monotonic() - started)
+        return
+
+    if args.dry_run:
+        for hospital_id, keep, dup in find_pairs(conn, args.hospital, args.window_days):
+            print(f"{hospital_id:>6}  keep {keep}  merge {dup}")
+        return
+
+    total = 0
+    while True:
+        merged = merge(conn, args.hospital, args.window_days)
+        total += merged
+        if not merged:
+            break
+    log.info("merged %s duplicate patients", total)
+
+
+if __name__ == "__main__":
+    main()
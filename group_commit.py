@@ -0,0 +1,286 @@
+import argparse
+import logging
+import os
+import queue
+import threading
+import time
+from collections import deque
+
+import psycopg2
+from dotenv import load_dotenv
+
+import db
+
+log = logging.getLogger("group_commit")
+
+# One writer thread for Save Patient and Convert from every session in the
+# process. Writes are coalesced into a single transaction per batch, so a
+# busy front desk pays one commit (one WAL flush) per batch rather than one
+# per click. A batch closes when it holds GROUP_MAX_BATCH writes or
+# GROUP_MAX_WAIT_MS after its first write arrived, whichever comes first.
+# Each caller blocks in submit() until its batch has committed; a write
+# its caller gave up on before a batch took it is skipped.
+#
+# Every write runs under its own savepoint, so one bad row fails alone and
+# the rest of the batch still commits. Both ops are idempotent (a stored
+# patient_id is skipped, converting twice is a no-op), so a caller that saw
+# a connection error can simply retry.
+#
+#   python group_commit.py bench --hospital 3 --writers 16 --writes 50
+
+GROUP_MAX_BATCH = int(os.environ.get("GROUP_MAX_BATCH", "64"))
+GROUP_MAX_WAIT_MS = float(os.environ.get("GROUP_MAX_WAIT_MS", "5"))
+SUBMIT_TIMEOUT = float(os.environ.get("GROUP_SUBMIT_TIMEOUT_S", "15"))
+
+METRICS_WINDOW = 500
+
+OPS = ("save_patient", "convert")
+
+
+class WriteFailed(Exception):
+    pass
+
+
+class Write:
+
+    def __init__(self, op, hospital_id, user_id, payload):
+        self.op = op
+        self.hospital_id = hospital_id
+        self.user_id = user_id
+        self.payload = payload
+        self.queued_at = time.perf_counter()
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self._lock = threading.Lock()
+        self._state = "queued"
+
+    def claim(self):
+        # Called by the writer before applying; False once the caller gave up.
+        with self._lock:
+            if self._state == "abandoned":
+                return False
+            self._state = "claimed"
+            return True
+
+    def abandon(self):
+        # Called by a caller that timed out; False if a batch already took it.
+        with self._lock:
+            if self._state == "queued":
+                self._state = "abandoned"
+                return True
+            return False
+
+
+def apply_write(cur, write):
+    # The status-event trigger reads app.user_id; reset it for every write
+    # since the batch shares one transaction.
+    cur.execute(
+        "SELECT set_config('app.user_id', %s, true)",
+        ("" if write.user_id is None else str(write.user_id),)
+    )
+    if write.op == "save_patient":
+        return db.insert_patient(cur, write.hospital_id, write.payload)
+    return db.update_status(cur, write.hospital_id, write.payload, "Converted")
+
+
+class WriteService(threading.Thread):
+
+    def __init__(self, db_url=None, max_batch=GROUP_MAX_BATCH, max_wait_ms=GROUP_MAX_WAIT_MS):
+        super().__init__(name="group-commit", daemon=True)
+        self.db_url = db_url
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000
+        self.queue = queue.Queue()
+        self.conn = None
+
+        self._lock = threading.Lock()
+        self._batches = deque(maxlen=METRICS_WINDOW)    # (size, commit_ms)
+        self._latencies = deque(maxlen=METRICS_WINDOW * 4)
+        self._totals = [0, 0, 0]                        # batches, writes, failed
+
+    def start(self):
+        super().start()
+        return self
+
+    def submit(self, op, hospital_id, user_id, payload, timeout=SUBMIT_TIMEOUT):
+        # Blocks until the write is committed; returns insert_patient's or
+        # update_status's result, raises WriteFailed otherwise.
+        if op not in OPS:
+            raise ValueError(op)
+        write = Write(op, hospital_id, user_id, payload)
+        self.queue.put(write)
+        if not write.done.wait(timeout):
+            if write.abandon():
+                raise WriteFailed("Database write timed out, please retry.")
+            raise WriteFailed("Database write is slow and may still complete; check before retrying.")
+        if write.error is not None:
+            raise WriteFailed(write.error)
+        return write.result
+
+    def save_patient(self, hospital_id, user_id, record):
+        return self.submit("save_patient", hospital_id, user_id, record)
+
+    def convert(self, hospital_id, user_id, patient_ids):
+        return self.submit("convert", hospital_id, user_id, list(patient_ids))
+
+    def collect(self):
+        batch = [self.queue.get()]
+        deadline = time.perf_counter() + self.max_wait
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        # Take whatever else is already waiting without extending the wait.
+        while len(batch) < self.max_batch:
+            try:
+                batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def run(self):
+        while True:
+            batch = self.collect()
+            try:
+                self.commit_batch(batch)
+            except Exception:
+                log.exception("group commit of %s writes failed", len(batch))
+                self.reset()
+                for write in batch:
+                    write.error = "Database write failed, please retry."
+            self.acknowledge(batch)
+
+    def commit_batch(self, batch):
+        if self.conn is None or self.conn.closed:
+            self.conn = db.connect(self.db_url)
+
+        with self.conn.cursor() as cur:
+            for write in batch:
+                if not write.claim():
+                    continue
+                cur.execute("SAVEPOINT write")
+                try:
+                    write.result = apply_write(cur, write)
+                except psycopg2.DatabaseError as e:
+                    if self.conn.closed:
+                        raise
+                    cur.execute("ROLLBACK TO SAVEPOINT write")
+                    write.error = str(e).strip()[:500]
+                else:
+                    cur.execute("RELEASE SAVEPOINT write")
+
+        started = time.perf_counter()
+        self.conn.commit()
+        commit_ms = (time.perf_counter() - started) * 1000
+
+        with self._lock:
+            self._batches.append((len(batch), commit_ms))
+
+    def reset(self):
+        if self.conn is not None and not self.conn.closed:
+            try:
+                self.conn.rollback()
+            except psycopg2.Error:
+                self.conn.close()
+        if self.conn is not None and self.conn.closed:
+            self.conn = None
+
+    def acknowledge(self, batch):
+        now = time.perf_counter()
+        with self._lock:
+            self._totals[0] += 1
+            self._totals[1] += len(batch)
+            for write in batch:
+                self._latencies.append((now - write.queued_at) * 1000)
+                if write.error is not None:
+                    self._totals[2] += 1
+        for write in batch:
+            write.done.set()
+
+    def stats(self):
+        with self._lock:
+            batches, writes, failed = self._totals
+            sizes = sorted(size for size, _ in self._batches)
+            commits = sorted(ms for _, ms in self._batches)
+            latencies = sorted(self._latencies)
+
+        def pct(values, p):
+            return round(values[min(len(values) - 1, int(len(values) * p))], 2) if values else None
+
+        return {
+            "batches": batches,
+            "writes": writes,
+            "failed": failed,
+            "queued": self.queue.qsize(),
+            "avg_batch": round(sum(sizes) / len(sizes), 2) if sizes else None,
+            "max_batch": sizes[-1] if sizes else None,
+            "commit_ms_p50": pct(commits, 0.5),
+            "latency_ms_p50": pct(latencies, 0.5),
+            "latency_ms_p95": pct(latencies, 0.95),
+            "latency_ms_max": pct(latencies, 1.0),
+        }
+
+# ================== CLI ================== #
+
+def bench(hospital_id, writers, writes_each, max_batch, max_wait_ms):
+    # Converts from many concurrent "sessions", once with a commit per write
+    # and once through the service. Converting an unknown patient id writes
+    # nothing, so this measures round trips and commits, not row changes.
+    def per_write():
+        conn = db.connect()
+        with conn.cursor() as cur:
+            for _ in range(writes_each):
+                db.update_status(cur, hospital_id, ["BENCH"], "Converted")
+                conn.commit()
+        conn.close()
+
+    def grouped(service):
+        for _ in range(writes_each):
+            service.convert(hospital_id, None, ["BENCH"])
+
+    def run(target, *args):
+        threads = [threading.Thread(target=target, args=args) for _ in range(writers)]
+        started = time.perf_counter()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        return time.perf_counter() - started
+
+    total = writers * writes_each
+    elapsed = run(per_write)
+    print(f"commit per write   {total / elapsed:8.0f} writes/s")
+
+    service = WriteService(max_batch=max_batch, max_wait_ms=max_wait_ms).start()
+    elapsed = run(grouped, service)
+    print(f"group commit       {total / elapsed:8.0f} writes/s")
+    print(service.stats())
+
+
+def main():
+    load_dotenv()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(name)s %(message)s")
+
+    parser = argparse.ArgumentParser(description="Group-commit write service")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    b = sub.add_parser("bench")
+    b.add_argument("--hospital", type=int, required=True)
+    b.add_argument("--writers", type=int, default=16)
+    b.add_argument("--writes", type=int, default=50)
+    b.add_argument("--max-batch", type=int, default=GROUP_MAX_BATCH)
+    b.add_argument("--max-wait-ms", type=float, default=GROUP_MAX_WAIT_MS)
+    args = parser.parse_args()
+
+    conn = db.connect()
+    db.ensure_schema(conn)
+    conn.close()
+    bench(args.hospital, args.writers, args.writes, args.max_batch, args.max_wait_ms)
+
+
+if __name__ == "__main__":
+    main()
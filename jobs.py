@@ -0,0 +1,469 @@
+import argparse
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+from dotenv import load_dotenv
+
+import archive
+import db
+import scoring
+import worklists
+
+log = logging.getLogger("jobs")
+
+# Background jobs for anything too slow to run inside a Streamlit rerun.
+# A job is a row in `jobs`; runners (one per app process, or standalone via
+# `python jobs.py work`) claim queued rows with SKIP LOCKED, run them on a
+# thread pool with their own connection, and write progress back to the row,
+# so a refreshed browser simply reads the job list again.
+
+JOBS_DIR = os.environ.get("JOBS_DIR", "jobs")
+JOB_WORKERS = int(os.environ.get("JOB_WORKERS", "2"))
+JOB_TENANT_RUNNING = int(os.environ.get("JOB_TENANT_RUNNING", "1"))
+JOB_TENANT_QUEUED = int(os.environ.get("JOB_TENANT_QUEUED", "5"))
+JOB_RETENTION_DAYS = int(os.environ.get("JOB_RETENTION_DAYS", "7"))
+
+POLL_INTERVAL = 1.0
+PROGRESS_INTERVAL = 1.0
+STALE_AFTER = "2 minutes"
+PURGE_EVERY = 600
+
+JOB_LOCK_ID = 72410300
+
+JOB_COLUMNS = [
+    "id","kind","status","progress","message","result_name","error",
+    "created_at","started_at","finished_at"
+]
+
+
+class JobLimitReached(Exception):
+    pass
+
+
+class JobCancelled(Exception):
+    pass
+
+# ================== SUBMIT / READ ================== #
+
+def submit(conn, hospital_id, user_id, kind, params=None):
+    if kind not in KINDS:
+        raise ValueError(f"unknown job kind {kind}")
+
+    with conn.cursor() as cur:
+        # Serialise submits per tenant so the queue cap cannot be raced past.
+        cur.execute("SELECT pg_advisory_xact_lock(%s, %s)", (JOB_LOCK_ID, hospital_id))
+        cur.execute("""
+            SELECT COUNT(*) FROM jobs
+            WHERE hospital_id=%s AND status IN ('queued','running')
+        """, (hospital_id,))
+        if cur.fetchone()[0] >= JOB_TENANT_QUEUED:
+            conn.rollback()
+            raise JobLimitReached(
+                f"At most {JOB_TENANT_QUEUED} background jobs can be waiting at once."
+            )
+        cur.execute("""
+            INSERT INTO jobs (hospital_id, user_id, kind, params)
+            VALUES (%s,%s,%s,%s)
+            RETURNING id
+        """, (hospital_id, user_id, kind, json.dumps(params or {}, default=str)))
+        job_id = cur.fetchone()[0]
+    conn.commit()
+    return job_id
+
+
+def list_jobs(cur, hospital_id, limit=20):
+    cur.execute(f"""
+        SELECT {", ".join(JOB_COLUMNS)}
+        FROM jobs
+        WHERE hospital_id=%s
+        ORDER BY id DESC
+        LIMIT %s
+    """, (hospital_id, limit))
+    return pd.DataFrame(cur.fetchall(), columns=JOB_COLUMNS)
+
+
+def cancel(conn, hospital_id, job_id):
+    # Queued jobs stop at once; running ones stop at their next progress call.
+    with conn.cursor() as cur:
+        cur.execute("""
+            UPDATE jobs
+            SET cancel_requested = true,
+                status = CASE WHEN status='queued' THEN 'cancelled' ELSE status END,
+                finished_at = CASE WHEN status='queued' THEN now() ELSE finished_at END
+            WHERE id=%s AND hospital_id=%s AND status IN ('queued','running')
+        """, (job_id, hospital_id))
+    conn.commit()
+
+
+def result_path(cur, hospital_id, job_id):
+    cur.execute(
+        "SELECT result_path FROM jobs WHERE id=%s AND hospital_id=%s AND status='done'",
+        (job_id, hospital_id)
+    )
+    row = cur.fetchone()
+    return row[0] if row and row[0] and os.path.exists(row[0]) else None
+
+def stage_upload(data, root=JOBS_DIR):
+    # Uploaded files wait on disk for the import job, which removes them.
+    folder = os.path.join(root, "uploads")
+    os.makedirs(folder, exist_ok=True)
+    path = os.path.join(folder, f"{uuid.uuid4().hex}.csv")
+    with open(path, "wb") as f:
+        f.write(data)
+    return path
+
+# ================== JOB KINDS ================== #
+
+def export_patients(conn, job, hospital_id, params):
+    where = "WHERE hospital_id=%s"
+    args = [hospital_id]
+    if params.get("start") and params.get("end"):
+        where += " AND created_on BETWEEN %s AND %s"
+        args += [params["start"], params["end"]]
+
+    with conn.cursor() as cur:
+        cur.execute(f"SELECT COUNT(*) FROM patients {where}", args)
+        total = cur.fetchone()[0]
+    conn.rollback()
+
+    path = job.result_file("patients_export.csv")
+    rows = 0
+    with open(path, "w", newline="", encoding="utf-8") as f:
+        for chunk in db.stream_frames(conn, f"""
+            SELECT {db.PATIENT_SELECT}
+            FROM patients {where}
+            ORDER BY created_on DESC
+        """, args, db.PATIENT_COLUMNS):
+            f.write(chunk.to_csv(index=False, header=rows == 0))
+            rows += len(chunk)
+            job.progress(rows / total if total else 1, f"{rows:,} of {total:,} rows")
+        if rows == 0:
+            f.write(",".join(db.PATIENT_COLUMNS) + "\n")
+
+    return {"rows": rows}
+
+
+IMPORT_CHUNK = 5000
+IMPORT_STATUSES = ("Pending", "Converted")
+
+
+def validate_import(chunk, first_line, job_id):
+    # Returns (valid rows in db.IMPORT_COLUMNS order, rejected rows with
+    # their line number and reason). Line 1 is the header.
+    rows = chunk.reindex(columns=db.PATIENT_INSERT_COLUMNS).fillna("")
+    rows = rows.apply(lambda col: col.str.strip())
+    rows = rows.where(rows != "")
+    rows.insert(0, "line", range(first_line, first_line + len(rows)))
+
+    age = pd.to_numeric(rows["age"], errors="coerce")
+    cost = pd.to_numeric(rows["cost"], errors="coerce")
+    created = pd.to_datetime(rows["created_on"], errors="coerce")
+
+    reasons = pd.Series("", index=rows.index)
+    reasons[rows["age"].notna() & ~age.between(0, 150)] += "age is not a number from 0 to 150; "
+    reasons[rows["cost"].notna() & ~np.isfinite(cost)] += "cost is not a number; "
+    reasons[rows["created_on"].notna() & created.isna()] += "created_on is not a date; "
+    reasons[rows["status"].notna() & ~rows["status"].isin(IMPORT_STATUSES)] += "unknown status; "
+
+    bad = reasons != ""
+    rejected = rows[bad].assign(error=reasons[bad].str.rstrip("; "))
+
+    valid = rows[~bad].copy()
+    valid["age"] = age[~bad].round().astype("Int64")
+    valid["cost"] = cost[~bad]
+    valid["created_on"] = created[~bad].fillna(pd.Timestamp(datetime.now()))
+    valid["status"] = valid["status"].fillna("Pending")
+    valid["patient_id"] = valid["patient_id"].fillna(
+        valid["line"].map(lambda line: f"PAT{job_id}-{line}")
+    )
+    return valid[db.IMPORT_COLUMNS], rejected
+
+
+def import_patients(conn, job, hospital_id, params):
+    # Set-based: a bad row is reported in import_errors.csv rather than
+    # failing the rows around it.
+    path = params["path"]
+    with open(path, encoding="utf-8") as f:
+        total = max(sum(1 for _ in f) - 1, 0)
+
+    counts = {"add": 0, "present": 0, "duplicate": 0}
+    rejected = 0
+    done = 0
+    errors_path = None
+    try:
+        for chunk in pd.read_csv(path, chunksize=IMPORT_CHUNK, dtype=str, keep_default_na=False):
+            valid, bad = validate_import(chunk, done + 2, job.job_id)
+            done += len(chunk)
+
+            if not bad.empty:
+                if errors_path is None:
+                    errors_path = job.result_file("import_errors.csv")
+                with open(errors_path, "a", newline="", encoding="utf-8") as f:
+                    f.write(bad.to_csv(index=False, header=rejected == 0))
+                rejected += len(bad)
+
+            if not valid.empty:
+                with conn.cursor() as cur:
+                    for outcome, n in db.import_patients(cur, hospital_id, valid).items():
+                        counts[outcome] = counts.get(outcome, 0) + n
+                conn.commit()
+            job.progress(done / total if total else 1, f"{done:,} of {total:,} rows")
+    finally:
+        os.remove(path)
+
+    message = (
+        f"{counts['add']:,} added, {counts['present']:,} already present, "
+        f"{counts['duplicate']:,} possible duplicates skipped"
+    )
+    if rejected:
+        message += f", {rejected:,} invalid rows (see download)"
+    return {"rows": counts["add"], "message": message}
+
+
+def rebuild_worklist(conn, job, hospital_id, params):
+    return {"rows": worklists.build_worklist(conn, hospital_id)}
+
+
+def archive_patients(conn, job, hospital_id, params):
+    days = int(params.get("older_than_days", archive.ARCHIVE_AFTER_DAYS))
+    cutoff = datetime.now() - timedelta(days=days)
+    return {"rows": archive.archive_hospital(conn, hospital_id, cutoff)}
+
+
+def train_scoring(conn, job, hospital_id, params):
+    return {"rows": scoring.train_and_score(conn, hospital_id)}
+
+
+KINDS = {
+    "export_patients": export_patients,
+    "import_patients": import_patients,
+    "rebuild_worklist": rebuild_worklist,
+    "archive": archive_patients,
+    "train_scoring": train_scoring,
+}
+
+LABELS = {
+    "export_patients": "Patient export",
+    "import_patients": "Patient import",
+    "rebuild_worklist": "Reminder worklist rebuild",
+    "archive": "Archive old converted patients",
+    "train_scoring": "Conversion score retrain",
+}
+
+# ================== RUNNER ================== #
+
+class JobContext:
+
+    def __init__(self, runner, job_id, hospital_id):
+        self.runner = runner
+        self.job_id = job_id
+        self.hospital_id = hospital_id
+        self.result_path = None
+        self._last = 0.0
+
+    def result_file(self, name):
+        folder = os.path.join(self.runner.root, f"hospital_{self.hospital_id}")
+        os.makedirs(folder, exist_ok=True)
+        self.result_path = os.path.join(folder, f"{self.job_id}_{name}")
+        return self.result_path
+
+    def progress(self, fraction, message=None):
+        # Throttled; raises JobCancelled once a cancel has been requested.
+        now = time.monotonic()
+        if now - self._last < PROGRESS_INTERVAL and fraction < 1:
+            return
+        self._last = now
+        row = self.runner.control("""
+            UPDATE jobs SET progress=%s, message=%s, heartbeat_at=now()
+            WHERE id=%s
+            RETURNING cancel_requested
+        """, (min(max(fraction, 0.0), 1.0), message, self.job_id))
+        if row and row[0]:
+            raise JobCancelled()
+
+
+class JobRunner:
+
+    def __init__(self, db_url, workers=JOB_WORKERS, root=JOBS_DIR):
+        self.db_url = db_url
+        self.workers = workers
+        self.root = root
+        self.pool = ThreadPoolExecutor(workers, thread_name_prefix="job")
+        self.free = threading.Semaphore(workers)
+        self.running = set()
+        self._lock = threading.Lock()
+        self._conn = None
+        self._purged = 0.0
+
+    @contextmanager
+    def session(self):
+        # The shared control connection, one transaction at a time.
+        with self._lock:
+            if self._conn is None or self._conn.closed:
+                self._conn = db.connect(self.db_url)
+            try:
+                with self._conn.cursor() as cur:
+                    yield cur
+                self._conn.commit()
+            except Exception:
+                self._conn.rollback()
+                raise
+
+    def control(self, sql, params=()):
+        with self.session() as cur:
+            cur.execute(sql, params)
+            return cur.fetchone() if cur.description else None
+
+    def start(self):
+        threading.Thread(target=self.dispatch, name="job-dispatch", daemon=True).start()
+        return self
+
+    def claim(self):
+        # The lock makes the per-tenant running count exact across runners.
+        with self.session() as cur:
+            cur.execute("SELECT pg_advisory_xact_lock(%s, 0)", (JOB_LOCK_ID,))
+            cur.execute("""
+                UPDATE jobs SET status='running', started_at=now(), heartbeat_at=now()
+                WHERE id = (
+                    SELECT j.id FROM jobs j
+                    WHERE j.status='queued'
+                    AND (
+                        SELECT COUNT(*) FROM jobs r
+                        WHERE r.hospital_id = j.hospital_id AND r.status='running'
+                    ) < %s
+                    ORDER BY j.id
+                    LIMIT 1
+                    FOR UPDATE OF j SKIP LOCKED
+                )
+                RETURNING id, hospital_id, kind, params
+            """, (JOB_TENANT_RUNNING,))
+            return cur.fetchone()
+
+    def housekeeping(self):
+        with self._lock:
+            running = list(self.running)
+        if running:
+            self.control("UPDATE jobs SET heartbeat_at=now() WHERE id = ANY(%s)", (running,))
+
+        # Jobs whose runner died stop heartbeating.
+        self.control(f"""
+            UPDATE jobs SET status='failed', error='interrupted', finished_at=now()
+            WHERE status='running' AND heartbeat_at < now() - interval '{STALE_AFTER}'
+        """)
+
+        if time.monotonic() - self._purged > PURGE_EVERY:
+            self._purged = time.monotonic()
+            self.purge_expired()
+
+    def purge_expired(self):
+        with self.session() as cur:
+            cur.execute("""
+                DELETE FROM jobs
+                WHERE finished_at < now() - make_interval(days => %s)
+                RETURNING result_path
+            """, (JOB_RETENTION_DAYS,))
+            paths = [x[0] for x in cur.fetchall() if x[0]]
+        for path in paths:
+            if os.path.exists(path):
+                os.remove(path)
+
+    def dispatch(self):
+        while True:
+            try:
+                self.housekeeping()
+                while self.free.acquire(blocking=False):
+                    job = self.claim()
+                    if job is None:
+                        self.free.release()
+                        break
+                    with self._lock:
+                        self.running.add(job[0])
+                    self.pool.submit(self.run_job, *job)
+            except Exception:
+                log.exception("job dispatch failed")
+                with self._lock:
+                    self._conn = None
+            time.sleep(POLL_INTERVAL)
+
+    def run_job(self, job_id, hospital_id, kind, params):
+        job = JobContext(self, job_id, hospital_id)
+        started = time.monotonic()
+        conn = None
+        try:
+            conn = db.connect(self.db_url)
+            result = KINDS[kind](conn, job, hospital_id, params or {})
+            self.control("""
+                UPDATE jobs
+                SET status='done', progress=1, finished_at=now(),
+                    message=%s, result_path=%s, result_name=%s
+                WHERE id=%s
+            """, (
+                result.get("message") or f"{result.get('rows', 0):,} rows",
+                job.result_path,
+                os.path.basename(job.result_path).split("_", 1)[1] if job.result_path else None,
+                job_id
+            ))
+            log.info("job %s (%s, hospital %s) done in %.1fs",
+                     job_id, kind, hospital_id, time.monotonic() - started)
+        except JobCancelled:
+            self.discard(job)
+            self.control(
+                "UPDATE jobs SET status='cancelled', finished_at=now() WHERE id=%s",
+                (job_id,)
+            )
+        except Exception as e:
+            log.exception("job %s (%s) failed", job_id, kind)
+            self.discard(job)
+            self.control(
+                "UPDATE jobs SET status='failed', error=%s, finished_at=now() WHERE id=%s",
+                (str(e).strip()[:500], job_id)
+            )
+        finally:
+            if conn is not None:
+                conn.close()
+            with self._lock:
+                self.running.discard(job_id)
+            self.free.release()
+
+    def discard(self, job):
+        if job.result_path and os.path.exists(job.result_path):
+            os.remove(job.result_path)
+
+# ================== CLI ================== #
+
+def main():
+    load_dotenv()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(name)s %(message)s")
+
+    parser = argparse.ArgumentParser(description="Background job runner")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    work = sub.add_parser("work")
+    work.add_argument("--workers", type=int, default=JOB_WORKERS)
+    ls = sub.add_parser("list")
+    ls.add_argument("--hospital", type=int, required=True)
+    args = parser.parse_args()
+
+    conn = db.connect()
+    db.ensure_schema(conn)
+
+    if args.cmd == "list":
+        with conn.cursor() as cur:
+            print(list_jobs(cur, args.hospital).to_string(index=False))
+        return
+
+    JobRunner(os.environ["DB_URL"], args.workers).start()
+    while True:
+        time.sleep(3600)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,196 @@
+import argparse
+import hashlib
+import json
+import logging
+import os
+import secrets
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+from dotenv import load_dotenv
+from psycopg2.pool import PoolError, ThreadedConnectionPool
+
+import db
+
+log = logging.getLogger("kpi_api")
+
+# Read-only JSON feed for hospitals' own BI tools, served next to the
+# Streamlit app and built on the same db.py queries.
+#
+#   python kpi_api.py create-key --hospital 3 --label "Power BI"
+#   python kpi_api.py serve --port 8502
+#
+#   curl -H "Authorization: Bearer <key>" http://host:8502/v1/kpis
+#
+# Every response carries an ETag derived from the tenant's data version,
+# so a poller sending If-None-Match gets a bodiless 304 for the cost of
+# one index probe until a patient row actually changes.
+
+POOL_MIN = 1
+POOL_MAX = int(os.environ.get("KPI_API_POOL_MAX", "8"))
+
+# Valid keys are trusted this long before api_keys is read again, so a
+# revoked key stops working within KEY_CACHE_TTL seconds.
+KEY_CACHE_TTL = int(os.environ.get("KPI_API_KEY_TTL_S", "60"))
+
+ENDPOINTS = {
+    "/v1/kpis": lambda cur, hid: db.tenant_kpis(cur, hid),
+    "/v1/conversion": lambda cur, hid: records(db.conversion_by_procedure(cur, hid)),
+    "/v1/doctors": lambda cur, hid: records(db.doctor_performance(cur, hid)),
+}
+
+
+def records(df):
+    return json.loads(df.to_json(orient="records"))
+
+
+def hash_key(key):
+    return hashlib.sha256(key.encode()).hexdigest()
+
+
+def create_key(conn, hospital_id, label):
+    key = secrets.token_urlsafe(32)
+    with conn.cursor() as cur:
+        cur.execute(
+            "INSERT INTO api_keys (key_hash, hospital_id, label) VALUES (%s,%s,%s)",
+            (hash_key(key), hospital_id, label)
+        )
+    conn.commit()
+    return key
+
+# ================== SERVICE ================== #
+
+class KpiService:
+
+    def __init__(self, pool):
+        self.pool = pool
+        self._lock = threading.Lock()
+        self._keys = {}
+        self._responses = {}
+
+    def tenant_for(self, cur, key):
+        key_hash = hash_key(key)
+        with self._lock:
+            cached = self._keys.get(key_hash)
+        if cached is not None and time.monotonic() < cached[1]:
+            return cached[0]
+
+        cur.execute(
+            "SELECT hospital_id FROM api_keys WHERE key_hash=%s AND revoked_at IS NULL",
+            (key_hash,)
+        )
+        row = cur.fetchone()
+        hospital_id = row[0] if row else None
+
+        # Only valid keys are remembered, for KEY_CACHE_TTL.
+        with self._lock:
+            if hospital_id is None:
+                self._keys.pop(key_hash, None)
+            else:
+                self._keys[key_hash] = (hospital_id, time.monotonic() + KEY_CACHE_TTL)
+        return hospital_id
+
+    def handle(self, path, key, if_none_match):
+        # Returns (status, etag, body_bytes)
+        if path not in ENDPOINTS:
+            return 404, None, b'{"error": "not found"}'
+
+        try:
+            conn = self.pool.getconn()
+        except PoolError:
+            return 503, None, b'{"error": "busy, retry later"}'
+
+        try:
+            with conn.cursor() as cur:
+                hospital_id = self.tenant_for(cur, key) if key else None
+                if hospital_id is None:
+                    return 401, None, b'{"error": "invalid api key"}'
+
+                version = db.data_version(cur, hospital_id)
+                etag = f'"{hospital_id}-{hashlib.sha1((path + version).encode()).hexdigest()[:16]}"'
+
+                if if_none_match and etag in [t.strip() for t in if_none_match.split(",")]:
+                    return 304, etag, b""
+
+                cache_key = (hospital_id, path)
+                with self._lock:
+                    cached = self._responses.get(cache_key)
+                if cached is not None and cached[0] == etag:
+                    return 200, etag, cached[1]
+
+                body = json.dumps({
+                    "hospital_id": hospital_id,
+                    "data": ENDPOINTS[path](cur, hospital_id),
+                }, default=str).encode()
+
+                with self._lock:
+                    self._responses[cache_key] = (etag, body)
+                return 200, etag, body
+        finally:
+            conn.rollback()
+            self.pool.putconn(conn)
+
+
+def make_handler(service):
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            auth = self.headers.get("Authorization", "")
+            key = auth[7:] if auth.startswith("Bearer ") else self.headers.get("X-API-Key")
+
+            status, etag, body = service.handle(
+                urlparse(self.path).path, key, self.headers.get("If-None-Match")
+            )
+
+            self.send_response(status)
+            if etag:
+                self.send_header("ETag", etag)
+                self.send_header("Cache-Control", "private, no-cache")
+            if status != 304:
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            if status != 304:
+                self.wfile.write(body)
+
+        def log_message(self, fmt, *args):
+            log.info("%s %s", self.address_string(), fmt % args)
+
+    return Handler
+
+# ================== CLI ================== #
+
+def main():
+    load_dotenv()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(name)s %(message)s")
+
+    parser = argparse.ArgumentParser(description="Read-only KPI endpoint")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    serve = sub.add_parser("serve")
+    serve.add_argument("--host", default="0.0.0.0")
+    serve.add_argument("--port", type=int, default=8502)
+    ck = sub.add_parser("create-key")
+    ck.add_argument("--hospital", type=int, required=True)
+    ck.add_argument("--label", default="")
+    args = parser.parse_args()
+
+    if args.cmd == "create-key":
+        conn = db.connect()
+        db.ensure_schema(conn)
+        print(create_key(conn, args.hospital, args.label))
+        return
+
+    pool = ThreadedConnectionPool(
+        POOL_MIN, POOL_MAX, os.environ["DB_URL"],
+        sslmode="require", connect_timeout=10
+    )
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(KpiService(pool)))
+    log.info("serving on http://%s:%s", args.host, args.port)
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
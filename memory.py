@@ -0,0 +1,208 @@
+import os
+import resource
+import sys
+import threading
+import time
+
+import pandas as pd
+
+# Accounting for what the app holds in memory. Each rerun records the
+# frames and export bytes its session built; the shared caches (patients,
+# pivots, prefetched pages) report their entries per tenant. When the
+# cached frames grow past MEMORY_BUDGET_MB, enforce() reclaims the cheapest
+# to rebuild first: pivots, then prefetched pages, then whole tenants'
+# patient frames, which are spilled to disk and picked up again by the next
+# delta sync instead of a full reload.
+#
+# Sizes are estimates: object (string) columns of large frames are measured
+# on a row sample and scaled.
+
+MEMORY_BUDGET_MB = int(os.environ.get("MEMORY_BUDGET_MB", "1024"))
+SESSION_MEMORY_MB = int(os.environ.get("SESSION_MEMORY_MB", "64"))
+SPILL_DIR = os.environ.get("MEMORY_SPILL_DIR", "spill")
+
+# Caches are measured at most this often; reruns in between reuse the sizes.
+CHECK_INTERVAL = 30
+# Reclaim down to this share of the budget so enforce() does not run on
+# every rerun once the budget is reached.
+RECLAIM_TO = 0.8
+# Sessions not seen for this long are dropped from the ledger.
+SESSION_TTL = 3600
+
+SAMPLE_ROWS = 2000
+
+# Page variables worth counting when a rerun finishes. df_all is the shared
+# PatientCache frame and is counted there instead; filtered is a subset of
+# df_pending.
+SESSION_OBJECTS = (
+    "df", "df_dash", "df_patients", "df_pending",
+    "df_conv", "lag_proc", "lag_doc", "df_pivot", "df_doc", "display_df",
+)
+
+MB = 1024 * 1024
+
+# ================== SIZES ================== #
+
+def size_of(obj):
+    if isinstance(obj, pd.DataFrame):
+        n = len(obj)
+        if n <= SAMPLE_ROWS:
+            return int(obj.memory_usage(index=True, deep=True).sum())
+        shallow = obj.memory_usage(index=True, deep=False)
+        objects = [c for c, dtype in obj.dtypes.items() if pd.api.types.is_string_dtype(dtype)
+                   or pd.api.types.is_object_dtype(dtype)]
+        if not objects:
+            return int(shallow.sum())
+        sample = obj[objects].iloc[::n // SAMPLE_ROWS]
+        per_row = sample.memory_usage(index=False, deep=True).sum() / len(sample)
+        return int(shallow.drop(objects).sum() + per_row * n)
+    if isinstance(obj, pd.Series):
+        return int(obj.memory_usage(index=True, deep=True))
+    if hasattr(obj, "getbuffer"):
+        return obj.getbuffer().nbytes
+    if isinstance(obj, (bytes, bytearray, str)):
+        return sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        return sum(size_of(v) for v in obj.values())
+    if isinstance(obj, (list, tuple)):
+        return sum(size_of(v) for v in obj)
+    return sys.getsizeof(obj)
+
+
+def process_rss():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        # Peak rather than current, in KiB on Linux.
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+# ================== LEDGER ================== #
+
+class MemoryLedger:
+    # caches: (name, cache) in reclaim order. Each cache has entries(),
+    # returning (hospital_id, key, frame_or_dict, last_used) tuples, and
+    # evict(key); a cache with spill(key, directory) is spilled instead.
+
+    def __init__(self, caches, budget_mb=MEMORY_BUDGET_MB, session_mb=SESSION_MEMORY_MB,
+                 spill_dir=SPILL_DIR):
+        self.caches = caches
+        self.budget = budget_mb * MB
+        self.session_budget = session_mb * MB
+        self.spill_dir = spill_dir
+        self._lock = threading.Lock()
+        self._sessions = {}      # session key -> dict
+        self._cache_rows = []    # (cache name, hospital_id, key, bytes, last_used)
+        self._checked = 0.0
+        self._reclaimed = {"evicted": 0, "spilled": 0, "bytes": 0}
+
+    def record_session(self, session_key, hospital_id, username, objects):
+        sizes = {name: size_of(obj) for name, obj in objects.items() if obj is not None}
+        now = time.monotonic()
+        with self._lock:
+            self._sessions[session_key] = {
+                "hospital_id": hospital_id,
+                "username": username,
+                "objects": sizes,
+                "bytes": sum(sizes.values()),
+                "seen": now,
+            }
+            for key in [k for k, s in self._sessions.items() if now - s["seen"] > SESSION_TTL]:
+                del self._sessions[key]
+
+    def fits_session(self, nbytes):
+        return nbytes <= self.session_budget
+
+    def measure(self):
+        rows = []
+        for name, cache in self.caches:
+            for hospital_id, key, obj, last_used in cache.entries():
+                rows.append((name, hospital_id, key, size_of(obj), last_used))
+        with self._lock:
+            self._cache_rows = rows
+            self._checked = time.monotonic()
+        return rows
+
+    def enforce(self, force=False):
+        # Returns the bytes reclaimed.
+        with self._lock:
+            due = force or time.monotonic() - self._checked >= CHECK_INTERVAL
+        if not due:
+            return 0
+
+        rows = self.measure()
+        total = sum(r[3] for r in rows)
+        if total <= self.budget:
+            return 0
+
+        target = total - self.budget * RECLAIM_TO
+        freed = 0
+        caches = dict(self.caches)
+        order = {name: i for i, (name, _) in enumerate(self.caches)}
+        for name, _, key, size, _ in sorted(rows, key=lambda r: (order[r[0]], r[4])):
+            if freed >= target:
+                break
+            cache = caches[name]
+            if hasattr(cache, "spill"):
+                cache.spill(key, self.spill_dir)
+                kind = "spilled"
+            else:
+                cache.evict(key)
+                kind = "evicted"
+            freed += size
+            with self._lock:
+                self._reclaimed[kind] += 1
+                self._reclaimed["bytes"] += size
+
+        self.measure()
+        return freed
+
+    def sessions(self, limit=20):
+        with self._lock:
+            rows = [
+                {
+                    "session": key[:8],
+                    "hospital_id": s["hospital_id"],
+                    "user": s["username"],
+                    "mb": round(s["bytes"] / MB, 2),
+                    "largest": max(s["objects"], key=s["objects"].get) if s["objects"] else "",
+                    "idle_s": int(time.monotonic() - s["seen"]),
+                }
+                for key, s in self._sessions.items()
+            ]
+        return pd.DataFrame(rows, columns=["session", "hospital_id", "user", "mb", "largest", "idle_s"]) \
+            .sort_values("mb", ascending=False).head(limit)
+
+    def tenants(self, limit=20):
+        with self._lock:
+            sessions = list(self._sessions.values())
+            cache_rows = list(self._cache_rows)
+
+        totals = {}
+        for s in sessions:
+            t = totals.setdefault(s["hospital_id"], {"sessions": 0, "session_mb": 0.0, "cache_mb": 0.0})
+            t["sessions"] += 1
+            t["session_mb"] += s["bytes"] / MB
+        for _, hospital_id, _, size, _ in cache_rows:
+            t = totals.setdefault(hospital_id, {"sessions": 0, "session_mb": 0.0, "cache_mb": 0.0})
+            t["cache_mb"] += size / MB
+
+        df = pd.DataFrame(
+            [{"hospital_id": hid, **t} for hid, t in totals.items()],
+            columns=["hospital_id", "sessions", "session_mb", "cache_mb"]
+        )
+        df["total_mb"] = df["session_mb"] + df["cache_mb"]
+        return df.round(2).sort_values("total_mb", ascending=False).head(limit)
+
+    def summary(self):
+        with self._lock:
+            cached = sum(r[3] for r in self._cache_rows)
+            held = sum(s["bytes"] for s in self._sessions.values())
+            return {
+                "rss_mb": round(process_rss() / MB, 1),
+                "cache_mb": round(cached / MB, 1),
+                "session_mb": round(held / MB, 1),
+                "budget_mb": round(self.budget / MB),
+                "sessions": len(self._sessions),
+                **self._reclaimed,
+            }
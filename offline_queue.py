@@ -0,0 +1,262 @@
+import argparse
+import fcntl
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+import psycopg2
+from dotenv import load_dotenv
+
+import db
+
+log = logging.getLogger("offline_queue")
+
+# Local durable queue for clinics on unreliable links. With OFFLINE_QUEUE
+# enabled, Save Patient and Convert are appended to a SQLite file (a local
+# fsync instead of a WAN round trip) and a background thread replays them
+# to Postgres in order, in batches, whenever the database is reachable.
+#
+# Replays are idempotent: a patient_id that already exists is treated as
+# delivered, converting an already-converted patient is a no-op. Anything
+# else that cannot be applied, including a likely duplicate patient, is
+# parked as a conflict for review, where it can be retried (a duplicate is
+# then saved anyway) or discarded.
+
+QUEUE_PATH = os.environ.get("OFFLINE_QUEUE_PATH", "offline_queue.db")
+SYNC_BATCH = int(os.environ.get("OFFLINE_SYNC_BATCH", "200"))
+SYNC_INTERVAL = float(os.environ.get("OFFLINE_SYNC_INTERVAL", "3"))
+
+OPS = ("save_patient", "convert")
+
+
+class OfflineQueue:
+
+    def __init__(self, path=QUEUE_PATH):
+        self.path = path
+        with self._connect() as lite:
+            lite.execute("PRAGMA journal_mode=WAL")
+            lite.execute("""
+                CREATE TABLE IF NOT EXISTS ops (
+                    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                    op TEXT NOT NULL,
+                    hospital_id INTEGER,
+                    user_id INTEGER,
+                    payload TEXT NOT NULL,
+                    created_at TEXT NOT NULL,
+                    status TEXT NOT NULL DEFAULT 'pending',
+                    error TEXT,
+                    synced_at TEXT
+                )
+            """)
+            lite.execute("CREATE INDEX IF NOT EXISTS ops_status_seq ON ops (status, seq)")
+
+    def _connect(self):
+        # One short-lived connection per call keeps it safe across threads.
+        lite = sqlite3.connect(self.path, timeout=30)
+        lite.execute("PRAGMA synchronous=FULL")
+        return lite
+
+    def enqueue(self, op, hospital_id, user_id, payload):
+        if op not in OPS:
+            raise ValueError(op)
+        with self._connect() as lite:
+            lite.execute(
+                "INSERT INTO ops (op, hospital_id, user_id, payload, created_at) VALUES (?,?,?,?,?)",
+                (op, hospital_id, user_id, json.dumps(payload, default=str),
+                 datetime.now().isoformat())
+            )
+
+    def pending(self, limit):
+        with self._connect() as lite:
+            return lite.execute("""
+                SELECT seq, op, hospital_id, user_id, payload
+                FROM ops WHERE status='pending'
+                ORDER BY seq LIMIT ?
+            """, (limit,)).fetchall()
+
+    def mark(self, results):
+        # results: (seq, status, error)
+        now = datetime.now().isoformat()
+        with self._connect() as lite:
+            lite.executemany(
+                "UPDATE ops SET status=?, error=?, synced_at=? WHERE seq=?",
+                [(status, error, now, seq) for seq, status, error in results]
+            )
+
+    def backlog(self, hospital_id=None):
+        where, params = ("WHERE hospital_id=?", (hospital_id,)) if hospital_id is not None else ("", ())
+        with self._connect() as lite:
+            rows = lite.execute(
+                f"SELECT status, COUNT(*) FROM ops {where} GROUP BY status", params
+            ).fetchall()
+        return dict(rows)
+
+    def conflicts(self, hospital_id, limit=50):
+        with self._connect() as lite:
+            return lite.execute("""
+                SELECT seq, op, payload, error, created_at
+                FROM ops WHERE status='conflict' AND hospital_id=?
+                ORDER BY seq DESC LIMIT ?
+            """, (hospital_id, limit)).fetchall()
+
+    def retry(self, hospital_id, seq):
+        # Back into the queue at its old position. A save parked as a likely
+        # duplicate is confirmed, so it is stored this time.
+        with self._connect() as lite:
+            row = lite.execute(
+                "SELECT op, payload FROM ops WHERE seq=? AND hospital_id=? AND status='conflict'",
+                (seq, hospital_id)
+            ).fetchone()
+            if row is None:
+                return
+            payload = json.loads(row[1])
+            if row[0] == "save_patient":
+                payload["confirmed"] = True
+            lite.execute(
+                "UPDATE ops SET status='pending', error=NULL, payload=? WHERE seq=?",
+                (json.dumps(payload, default=str), seq)
+            )
+
+    def discard(self, hospital_id, seq):
+        with self._connect() as lite:
+            lite.execute(
+                "UPDATE ops SET status='discarded' WHERE seq=? AND hospital_id=? AND status='conflict'",
+                (seq, hospital_id)
+            )
+
+    @contextmanager
+    def sync_lock(self):
+        # App processes on one host share the queue file; only one of them
+        # replays at a time, so no op is applied twice. Yields False when
+        # another process holds it.
+        with open(self.path + ".lock", "a") as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                yield False
+                return
+            try:
+                yield True
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+# ================== REPLAY ================== #
+
+def apply_op(cur, op, hospital_id, user_id, payload):
+    # The status-event trigger reads app.user_id; reset it for every op
+    # since the sync batch shares one transaction.
+    cur.execute(
+        "SELECT set_config('app.user_id', %s, true)",
+        ("" if user_id is None else str(user_id),)
+    )
+    if op == "save_patient":
+        record = dict(payload)
+        record["created_on"] = datetime.fromisoformat(record["created_on"])
+        if not record.get("confirmed"):
+            dups = db.find_duplicates(cur, hospital_id, record)
+            if not dups.empty:
+                return "conflict", f"possible duplicate of {', '.join(dups['patient_id'])}"
+        if not db.insert_patient(cur, hospital_id, record):
+            return "synced", "already present"
+        return "synced", None
+
+    if op == "convert":
+        missing = db.missing_patients(cur, hospital_id, payload["patient_ids"])
+        db.update_status(cur, hospital_id, payload["patient_ids"], "Converted")
+        if missing:
+            return "conflict", f"unknown patient(s): {', '.join(missing)}"
+        return "synced", None
+
+    return "conflict", f"unknown op {op}"
+
+
+def sync_batch(queue, conn, limit=SYNC_BATCH):
+    ops = queue.pending(limit)
+    if not ops:
+        return 0
+
+    results = []
+    with conn.cursor() as cur:
+        for seq, op, hospital_id, user_id, payload in ops:
+            # A failing op is rolled back alone and parked; the rest of the
+            # batch still commits in order.
+            cur.execute("SAVEPOINT op")
+            try:
+                status, error = apply_op(cur, op, hospital_id, user_id, json.loads(payload))
+            except psycopg2.DatabaseError as e:
+                cur.execute("ROLLBACK TO SAVEPOINT op")
+                status, error = "conflict", str(e).strip()[:500]
+            else:
+                cur.execute("RELEASE SAVEPOINT op")
+            results.append((seq, status, error))
+    conn.commit()
+
+    queue.mark(results)
+    return len(results)
+
+
+def sync_all(queue, conn):
+    total = 0
+    with queue.sync_lock() as held:
+        while held:
+            n = sync_batch(queue, conn)
+            total += n
+            if n < SYNC_BATCH:
+                break
+    return total
+
+
+class SyncThread(threading.Thread):
+
+    def __init__(self, queue, db_url, interval=SYNC_INTERVAL):
+        super().__init__(name="offline-sync", daemon=True)
+        self.queue = queue
+        self.db_url = db_url
+        self.interval = interval
+        self.conn = None
+
+    def run(self):
+        while True:
+            try:
+                if self.conn is None or self.conn.closed:
+                    self.conn = db.connect(self.db_url)
+                synced = sync_all(self.queue, self.conn)
+                if synced:
+                    log.info("synced %s queued ops", synced)
+            except psycopg2.OperationalError as e:
+                log.warning("sync deferred, database unreachable: %s", e)
+                self.conn = None
+            except Exception:
+                log.exception("sync failed")
+                if self.conn is not None and not self.conn.closed:
+                    self.conn.rollback()
+            time.sleep(self.interval)
+
+# ================== CLI ================== #
+
+def main():
+    load_dotenv()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(name)s %(message)s")
+
+    parser = argparse.ArgumentParser(description="Offline write queue")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    sub.add_parser("sync", help="replay everything pending and exit")
+    sub.add_parser("status")
+    args = parser.parse_args()
+
+    queue = OfflineQueue()
+    if args.cmd == "status":
+        print(queue.backlog())
+        return
+
+    conn = db.connect()
+    print(f"synced {sync_all(queue, conn)} ops")
+
+
+if __name__ == "__main__":
+    main()
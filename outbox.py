@@ -0,0 +1,317 @@
+import argparse
+import asyncio
+import logging
+import os
+import random
+import time
+
+import aiohttp
+from dotenv import load_dotenv
+from psycopg2.extras import execute_values
+
+import db
+
+log = logging.getLogger("outbox")
+
+# ================== CONFIG ================== #
+
+GATEWAY_URL = os.environ.get("WA_GATEWAY_URL", "http://127.0.0.1:8765/send")
+GATEWAY_TOKEN = os.environ.get("WA_GATEWAY_TOKEN", "")
+
+CONCURRENCY = int(os.environ.get("OUTBOX_CONCURRENCY", "50"))
+HOSPITAL_RATE = float(os.environ.get("OUTBOX_HOSPITAL_RATE", "20"))   # msgs/sec
+CLAIM_BATCH = int(os.environ.get("OUTBOX_CLAIM_BATCH", "500"))
+FLUSH_BATCH = int(os.environ.get("OUTBOX_FLUSH_BATCH", "200"))
+FLUSH_INTERVAL = float(os.environ.get("OUTBOX_FLUSH_INTERVAL", "1.0"))
+MAX_ATTEMPTS = int(os.environ.get("OUTBOX_MAX_ATTEMPTS", "5"))
+BACKOFF_BASE = float(os.environ.get("OUTBOX_BACKOFF_BASE", "30"))     # seconds
+REQUEST_TIMEOUT = float(os.environ.get("OUTBOX_REQUEST_TIMEOUT", "10"))
+IDLE_SLEEP = 2.0
+
+# Rows left in 'sending' by a crashed worker are handed out again after this.
+CLAIM_TIMEOUT = "5 minutes"
+
+# ================== ENQUEUE ================== #
+
+def reminder_message(name, procedure):
+    return f"Dear {name}, this is a reminder for your {procedure} treatment. Please contact us."
+
+
+def enqueue_reminders(conn, hospital_id, patients):
+    # patients: iterable of (patient_id, name, phone, procedure). A patient is
+    # queued at most once per day, so repeated clicks are harmless.
+    rows = [
+        (hospital_id, patient_id, phone, reminder_message(name, procedure))
+        for patient_id, name, phone, procedure in patients
+        if phone
+    ]
+    if not rows:
+        return 0
+
+    with conn.cursor() as cur:
+        inserted = execute_values(cur, """
+            INSERT INTO reminder_outbox (hospital_id, patient_id, phone, message)
+            VALUES %s
+            ON CONFLICT (hospital_id, patient_id, queued_on) DO NOTHING
+            RETURNING id
+        """, rows, page_size=1000, fetch=True)
+    conn.commit()
+    return len(inserted)
+
+
+def outbox_summary(cur, hospital_id):
+    cur.execute("""
+        SELECT status, COUNT(*)
+        FROM reminder_outbox
+        WHERE hospital_id=%s AND queued_on = current_date
+        GROUP BY status
+    """, (hospital_id,))
+    return dict(cur.fetchall())
+
+# ================== CLAIM / WRITE BACK ================== #
+
+def release_stale_claims(conn):
+    with conn.cursor() as cur:
+        cur.execute(f"""
+            UPDATE reminder_outbox
+            SET status='queued', claimed_at=NULL
+            WHERE status='sending'
+            AND claimed_at < now() - interval '{CLAIM_TIMEOUT}'
+        """)
+    conn.commit()
+
+
+def claim_batch(conn, limit):
+    with conn.cursor() as cur:
+        cur.execute("""
+            UPDATE reminder_outbox
+            SET status='sending', claimed_at=now()
+            WHERE id IN (
+                SELECT id FROM reminder_outbox
+                WHERE status='queued' AND next_attempt_at <= now()
+                ORDER BY next_attempt_at
+                LIMIT %s
+                FOR UPDATE SKIP LOCKED
+            )
+            RETURNING id, hospital_id, phone, message, attempts
+        """, (limit,))
+        rows = cur.fetchall()
+    conn.commit()
+    return rows
+
+
+def write_results(conn, results):
+    # results: (id, status, attempts, retry_in_seconds, error)
+    if not results:
+        return
+    with conn.cursor() as cur:
+        execute_values(cur, """
+            UPDATE reminder_outbox AS o
+            SET status = r.status,
+                attempts = r.attempts,
+                last_error = r.error,
+                claimed_at = NULL,
+                next_attempt_at = now() + make_interval(secs => r.retry_in),
+                sent_at = CASE WHEN r.status='sent' THEN now() ELSE o.sent_at END
+            FROM (VALUES %s) AS r (id, status, attempts, retry_in, error)
+            WHERE o.id = r.id
+        """, results, template="(%s::bigint, %s, %s::int, %s::float8, %s)", page_size=1000)
+    conn.commit()
+
+# ================== RATE LIMIT ================== #
+
+class TokenBucket:
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.capacity = burst or max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+# ================== WORKER ================== #
+
+def backoff(attempts):
+    return BACKOFF_BASE * (2 ** (attempts - 1)) * random.uniform(0.8, 1.2)
+
+
+class OutboxWorker:
+
+    def __init__(self, conn, gateway_url=GATEWAY_URL, concurrency=CONCURRENCY,
+                 hospital_rate=HOSPITAL_RATE):
+        self.conn = conn
+        self.gateway_url = gateway_url
+        self.concurrency = concurrency
+        self.hospital_rate = hospital_rate
+        self.db_lock = asyncio.Lock()
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.buckets = {}
+        self.results = []
+        self.stats = {"sent": 0, "retry": 0, "failed": 0}
+
+    def bucket(self, hospital_id):
+        if hospital_id not in self.buckets:
+            self.buckets[hospital_id] = TokenBucket(self.hospital_rate)
+        return self.buckets[hospital_id]
+
+    async def db_call(self, fn, *args):
+        # Claims and write-backs share one connection; keep them serialised.
+        async with self.db_lock:
+            return await asyncio.to_thread(fn, self.conn, *args)
+
+    async def deliver(self, session, row):
+        msg_id, hospital_id, phone, message, attempts = row
+        attempts += 1
+
+        await self.bucket(hospital_id).acquire()
+        async with self.semaphore:
+            try:
+                async with session.post(self.gateway_url, json={
+                    "to": phone,
+                    "message": message,
+                    "reference": str(msg_id),
+                }) as resp:
+                    status = resp.status
+                    error = None if status < 300 else (await resp.text())[:500]
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                status, error = None, repr(e)[:500]
+
+        if status is not None and status < 300:
+            result = (msg_id, "sent", attempts, 0.0, None)
+        elif (status is None or status == 429 or status >= 500) and attempts < MAX_ATTEMPTS:
+            result = (msg_id, "queued", attempts, backoff(attempts), error)
+        else:
+            result = (msg_id, "failed", attempts, 0.0, error or f"HTTP {status}")
+
+        self.stats["retry" if result[1] == "queued" else result[1]] += 1
+        self.results.append(result)
+
+    async def flush(self):
+        results, self.results = self.results, []
+        await self.db_call(write_results, results)
+
+    async def flusher(self):
+        while True:
+            await asyncio.sleep(FLUSH_INTERVAL)
+            if self.results:
+                await self.flush()
+
+    async def run(self, once=False):
+        await self.db_call(release_stale_claims)
+
+        headers = {"Authorization": f"Bearer {GATEWAY_TOKEN}"} if GATEWAY_TOKEN else {}
+        timeout = aiohttp.ClientTimeout(total=REQUEST_TIMEOUT)
+        connector = aiohttp.TCPConnector(limit=self.concurrency)
+
+        async with aiohttp.ClientSession(headers=headers, timeout=timeout,
+                                         connector=connector) as session:
+            flusher = asyncio.create_task(self.flusher())
+            pending = set()
+            try:
+                while True:
+                    # Keep roughly one claim batch in flight at a time.
+                    if len(pending) < CLAIM_BATCH:
+                        rows = await self.db_call(claim_batch, CLAIM_BATCH)
+                    else:
+                        rows = []
+
+                    for row in rows:
+                        pending.add(asyncio.create_task(self.deliver(session, row)))
+
+                    if pending:
+                        _, pending = await asyncio.wait(
+                            pending, timeout=FLUSH_INTERVAL,
+                            return_when=asyncio.FIRST_COMPLETED
+                        )
+                        if len(self.results) >= FLUSH_BATCH:
+                            await self.flush()
+                    elif once:
+                        break
+                    else:
+                        await asyncio.sleep(IDLE_SLEEP)
+            finally:
+                if pending:
+                    await asyncio.gather(*pending, return_exceptions=True)
+                flusher.cancel()
+                await self.flush()
+
+# ================== MOCK GATEWAY ================== #
+
+async def run_mock_gateway(host, port, failure_rate, latency):
+    from aiohttp import web
+
+    counts = {"ok": 0, "fail": 0}
+
+    async def send(request):
+        await request.json()
+        if latency:
+            await asyncio.sleep(latency)
+        if random.random() < failure_rate:
+            counts["fail"] += 1
+            return web.Response(status=503, text="mock failure")
+        counts["ok"] += 1
+        return web.json_response({"status": "accepted"})
+
+    async def stats(request):
+        return web.json_response(counts)
+
+    app = web.Application()
+    app.router.add_post("/send", send)
+    app.router.add_get("/stats", stats)
+
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    log.info("mock gateway listening on http://%s:%s/send", host, port)
+    await asyncio.Event().wait()
+
+# ================== CLI ================== #
+
+def main():
+    load_dotenv()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(name)s %(message)s")
+
+    parser = argparse.ArgumentParser(description="WhatsApp reminder outbox")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+
+    work = sub.add_parser("work", help="deliver queued reminders")
+    work.add_argument("--once", action="store_true", help="exit when the outbox is drained")
+
+    mock = sub.add_parser("mock-gateway", help="run a local gateway for testing")
+    mock.add_argument("--host", default="127.0.0.1")
+    mock.add_argument("--port", type=int, default=8765)
+    mock.add_argument("--failure-rate", type=float, default=0.0)
+    mock.add_argument("--latency", type=float, default=0.05)
+
+    args = parser.parse_args()
+
+    if args.cmd == "mock-gateway":
+        asyncio.run(run_mock_gateway(args.host, args.port, args.failure_rate, args.latency))
+        return
+
+    conn = db.connect()
+    db.ensure_schema(conn)
+    worker = OutboxWorker(conn)
+    started = time.monotonic()
+    try:
+        asyncio.run(worker.run(once=args.once))
+    except KeyboardInterrupt:
+        pass
+    elapsed = time.monotonic() - started
+    log.info("sent=%(sent)s retry=%(retry)s failed=%(failed)s", worker.stats)
+    log.info("%.0f msgs/min", worker.stats["sent"] / elapsed * 60 if elapsed else 0)
+
+
+if __name__ == "__main__":
+    main()
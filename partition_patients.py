@@ -0,0 +1,330 @@
+import argparse
+import json
+import logging
+import time
+from datetime import date
+
+from dotenv import load_dotenv
+
+import db
+
+log = logging.getLogger("partition")
+
+# Online conversion of `patients` into monthly range partitions on
+# created_on. Steps, each safe to re-run:
+#
+#   python partition_patients.py prepare    # partitioned shadow table + mirror trigger
+#   python partition_patients.py backfill   # copy existing rows in id batches
+#   python partition_patients.py reconcile  # fix rows that raced the backfill
+#   python partition_patients.py cutover    # short exclusive lock, swap names
+#
+# The app keeps writing to `patients` throughout; the mirror trigger
+# replays every insert/update/delete into the shadow table. A delete or
+# update that commits while backfill holds the old copy of the row still
+# lets that copy land, so reconcile runs before cutover. After cutover the
+# old heap stays as patients_unpartitioned for rollback.
+#
+# Future partitions are created by db.ensure_schema (app start and the
+# nightly worklists job), PARTITION_MONTHS_AHEAD months ahead.
+
+SHADOW = "patients_new"
+RETIRED = "patients_unpartitioned"
+BACKFILL_BATCH = 50000
+
+# ================== PREPARE ================== #
+
+def prepare(conn):
+    with conn.cursor() as cur:
+        if db.is_partitioned(cur, "patients"):
+            log.info("patients is already partitioned")
+            conn.rollback()
+            return
+
+        cur.execute("SELECT MIN(created_on), MAX(created_on) FROM patients")
+        first, last = cur.fetchone()
+
+        cur.execute(f"""
+            CREATE TABLE IF NOT EXISTS {SHADOW}
+            (LIKE patients INCLUDING DEFAULTS INCLUDING GENERATED)
+            PARTITION BY RANGE (created_on)
+        """)
+        cur.execute(f"""
+            DO $$ BEGIN
+                ALTER TABLE {SHADOW} ADD PRIMARY KEY (id, created_on);
+            EXCEPTION WHEN invalid_table_definition THEN NULL;
+            END $$
+        """)
+        cur.execute(f"CREATE TABLE IF NOT EXISTS {SHADOW}_default PARTITION OF {SHADOW} DEFAULT")
+
+        newest = max(last.date() if last else date.today(), date.today())
+        parts = db.ensure_partitions(
+            cur, SHADOW,
+            start=first.date() if first else None,
+            end=db.add_months(newest, db.PARTITION_MONTHS_AHEAD + 1)
+        )
+
+        cur.execute(f"""
+            CREATE OR REPLACE FUNCTION mirror_patients() RETURNS trigger AS $$
+            BEGIN
+                IF TG_OP IN ('UPDATE', 'DELETE') THEN
+                    DELETE FROM {SHADOW} WHERE id = OLD.id AND created_on = OLD.created_on;
+                END IF;
+                IF TG_OP IN ('INSERT', 'UPDATE') THEN
+                    INSERT INTO {SHADOW} SELECT NEW.* ON CONFLICT DO NOTHING;
+                END IF;
+                RETURN NULL;
+            END
+            $$ LANGUAGE plpgsql
+        """)
+        cur.execute("DROP TRIGGER IF EXISTS patients_mirror ON patients")
+        cur.execute("""
+            CREATE TRIGGER patients_mirror
+            AFTER INSERT OR UPDATE OR DELETE ON patients
+            FOR EACH ROW EXECUTE FUNCTION mirror_patients()
+        """)
+    conn.commit()
+    log.info("shadow table ready with %s monthly partitions", len(parts))
+
+# ================== BACKFILL ================== #
+
+def backfill(conn, batch=BACKFILL_BATCH):
+    # Rows the mirror trigger already wrote win on conflict, so racing
+    # updates are never overwritten by the older copy read here.
+    with conn.cursor() as cur:
+        cur.execute("SELECT COALESCE(MIN(id), 0), COALESCE(MAX(id), 0) FROM patients")
+        low, high = cur.fetchone()
+    conn.rollback()
+
+    copied = 0
+    started = time.monotonic()
+    for lo in range(low - 1, high, batch):
+        with conn.cursor() as cur:
+            cur.execute(f"""
+                INSERT INTO {SHADOW}
+                SELECT * FROM patients WHERE id > %s AND id <= %s
+                ON CONFLICT DO NOTHING
+            """, (lo, lo + batch))
+            copied += cur.rowcount
+        conn.commit()
+        log.info("copied through id %s (%s rows, %.0f rows/s)",
+                 lo + batch, copied, copied / max(time.monotonic() - started, 1e-6))
+    return copied
+
+
+def reconcile(conn, batch=BACKFILL_BATCH):
+    # Shadow rows whose (id, created_on) no longer exists in patients were
+    # deleted or moved; rows that differ are replaced and missing ones
+    # copied. Only rows that raced backfill or an earlier pass change.
+    with conn.cursor() as cur:
+        cur.execute(f"""
+            SELECT COALESCE(MIN(id), 0), COALESCE(MAX(id), 0) FROM (
+                SELECT MIN(id) AS id FROM patients UNION ALL SELECT MAX(id) FROM patients
+                UNION ALL SELECT MIN(id) FROM {SHADOW} UNION ALL SELECT MAX(id) FROM {SHADOW}
+            ) t
+        """)
+        low, high = cur.fetchone()
+    conn.rollback()
+
+    removed = replaced = added = 0
+    for lo in range(low - 1, high, batch):
+        hi = lo + batch
+        with conn.cursor() as cur:
+            cur.execute(f"""
+                DELETE FROM {SHADOW} s
+                WHERE s.id > %s AND s.id <= %s
+                AND NOT EXISTS (
+                    SELECT 1 FROM patients p WHERE p.id = s.id AND p.created_on = s.created_on
+                )
+            """, (lo, hi))
+            removed += cur.rowcount
+            cur.execute(f"""
+                DELETE FROM {SHADOW} s USING patients p
+                WHERE s.id > %s AND s.id <= %s
+                AND p.id = s.id AND p.created_on = s.created_on
+                AND ROW(s.*) IS DISTINCT FROM ROW(p.*)
+            """, (lo, hi))
+            replaced += cur.rowcount
+            cur.execute(f"""
+                INSERT INTO {SHADOW}
+                SELECT * FROM patients WHERE id > %s AND id <= %s
+                ON CONFLICT DO NOTHING
+            """, (lo, hi))
+            added += cur.rowcount
+        conn.commit()
+
+    added -= replaced
+    log.info("reconciled: %s removed, %s replaced, %s added", removed, replaced, added)
+    return removed, replaced, added
+
+# ================== CUTOVER ================== #
+
+def cutover(conn):
+    with conn.cursor() as cur:
+        cur.execute("SET LOCAL lock_timeout = '5s'")
+        cur.execute("LOCK TABLE patients IN ACCESS EXCLUSIVE MODE")
+
+        cur.execute("SELECT COUNT(*) FROM patients")
+        old_count = cur.fetchone()[0]
+        cur.execute(f"SELECT COUNT(*) FROM {SHADOW}")
+        new_count = cur.fetchone()[0]
+        if old_count != new_count:
+            conn.rollback()
+            raise RuntimeError(f"row counts differ: patients={old_count} {SHADOW}={new_count}; run reconcile")
+
+        cur.execute("SELECT pg_get_serial_sequence('patients', 'id')")
+        seq = cur.fetchone()[0]
+
+        # Free the index names so ensure_schema recreates them on the new table.
+        cur.execute("""
+            SELECT indexrelid::regclass::text
+            FROM pg_index WHERE indrelid = 'patients'::regclass AND NOT indisprimary
+        """)
+        for (index,) in cur.fetchall():
+            cur.execute(f"ALTER INDEX {index} RENAME TO {index[:40]}_unpartitioned")
+
+        cur.execute("DROP TRIGGER IF EXISTS patients_mirror ON patients")
+        cur.execute(f"ALTER TABLE patients RENAME TO {RETIRED}")
+        cur.execute(f"ALTER TABLE {SHADOW} RENAME TO patients")
+        cur.execute(f"ALTER TABLE {SHADOW}_default RENAME TO patients_default")
+        cur.execute(f"""
+            SELECT c.relname FROM pg_inherits i
+            JOIN pg_class c ON c.oid = i.inhrelid
+            WHERE i.inhparent = 'patients'::regclass AND c.relname LIKE '{SHADOW}_p%'
+        """)
+        for (part,) in cur.fetchall():
+            cur.execute(f"ALTER TABLE {part} RENAME TO {part.replace(SHADOW, 'patients', 1)}")
+        if seq:
+            cur.execute(f"ALTER SEQUENCE {seq} OWNED BY patients.id")
+        cur.execute("DROP FUNCTION IF EXISTS mirror_patients()")
+    conn.commit()
+
+    # Triggers and indexes from SCHEMA_SQL now attach to the partitioned table.
+    db.ensure_schema(conn, replay=True)
+    log.info("cutover done: %s rows, old table kept as %s", new_count, RETIRED)
+
+# ================== SEED / BENCH ================== #
+
+def seed(conn, rows, hospitals, months):
+    # Synthetic multi-tenant data for benchmarking. Only for scratch databases.
+    with conn.cursor() as cur:
+        cur.execute("""
+            INSERT INTO patients
+            (patient_id,name,phone,city,age,gender,vision_od,vision_os,
+             procedure,iol,doctor,counsellor,cost,status,created_on,hospital_id)
+            SELECT 'SYN' || g,
+                   'Patient ' || g,
+                   '9' || lpad((g %% 1000000000)::text, 9, '0'),
+                   (ARRAY['Pune','Mumbai','Nashik','Nagpur','Satara'])[1 + g %% 5],
+                   20 + g %% 70,
+                   (ARRAY['Male','Female'])[1 + g %% 2],
+                   '6/9', '6/12',
+                   (ARRAY['Cataract','LASIK','Glaucoma','Retina','Cornea'])[1 + g %% 5],
+                   CASE WHEN g %% 5 = 0 THEN 'Monofocal' END,
+                   'Dr ' || (g %% 40),
+                   'Counsellor ' || (g %% 15),
+                   10000 + (g %% 90) * 1000,
+                   CASE WHEN random() < 0.55 THEN 'Converted' ELSE 'Pending' END,
+                   localtimestamp - (random() * %s * interval '30 days'),
+                   1 + g %% %s
+            FROM generate_series(1, %s) g
+        """, (months, hospitals, rows))
+    conn.commit()
+    with conn.cursor() as cur:
+        cur.execute("ANALYZE patients")
+    conn.commit()
+
+
+BENCH_QUERIES = {
+    # GLOBAL FILTERED DATA: last 30 days for one tenant.
+    "date_range_30d": """
+        SELECT * FROM patients
+        WHERE hospital_id=%s
+        AND created_on BETWEEN localtimestamp - interval '30 days' AND localtimestamp
+        ORDER BY created_on DESC
+    """,
+    # Pending / Daily Reminders ageing list.
+    "pending_ageing": """
+        SELECT patient_id, name, phone, procedure, cost, created_on
+        FROM patients
+        WHERE hospital_id=%s AND status='Pending'
+        ORDER BY created_on DESC
+    """,
+    # Conversion page group-by.
+    "conversion_by_procedure": """
+        SELECT procedure, COUNT(*),
+               SUM(CASE WHEN status='Converted' THEN 1 ELSE 0 END)
+        FROM patients WHERE hospital_id=%s GROUP BY procedure
+    """,
+}
+
+
+def count_scans(plan):
+    scans = 0
+    if "Relation Name" in plan:
+        scans += 1
+    for child in plan.get("Plans", []):
+        scans += count_scans(child)
+    return scans
+
+
+def bench(conn, hospital_id, repeat):
+    with conn.cursor() as cur:
+        for label, sql in BENCH_QUERIES.items():
+            timings = []
+            for _ in range(repeat):
+                cur.execute("EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) " + sql, (hospital_id,))
+                result = cur.fetchone()[0]
+                result = json.loads(result) if isinstance(result, str) else result
+                timings.append(result[0]["Execution Time"])
+            plan = result[0]["Plan"]
+            timings.sort()
+            print(f"{label:26s} median {timings[len(timings) // 2]:8.1f} ms   "
+                  f"relations scanned {count_scans(plan)}")
+    conn.rollback()
+
+# ================== CLI ================== #
+
+def main():
+    load_dotenv()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(name)s %(message)s")
+
+    parser = argparse.ArgumentParser(description="Partition patients by month")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    sub.add_parser("prepare")
+    bf = sub.add_parser("backfill")
+    bf.add_argument("--batch", type=int, default=BACKFILL_BATCH)
+    rc = sub.add_parser("reconcile")
+    rc.add_argument("--batch", type=int, default=BACKFILL_BATCH)
+    sub.add_parser("cutover")
+    sub.add_parser("ensure", help="create upcoming monthly partitions")
+
+    sd = sub.add_parser("seed", help="insert synthetic rows (scratch databases only)")
+    sd.add_argument("--rows", type=int, default=10_000_000)
+    sd.add_argument("--hospitals", type=int, default=300)
+    sd.add_argument("--months", type=int, default=60)
+
+    bn = sub.add_parser("bench", help="time the app's hot queries")
+    bn.add_argument("--hospital", type=int, default=1)
+    bn.add_argument("--repeat", type=int, default=5)
+
+    args = parser.parse_args()
+    conn = db.connect()
+
+    if args.cmd == "prepare":
+        prepare(conn)
+    elif args.cmd == "backfill":
+        backfill(conn, args.batch)
+    elif args.cmd == "reconcile":
+        reconcile(conn, args.batch)
+    elif args.cmd == "cutover":
+        cutover(conn)
+    elif args.cmd == "ensure":
+        db.ensure_schema(conn)
+    elif args.cmd == "seed":
+        seed(conn, args.rows, args.hospitals, args.months)
+    elif args.cmd == "bench":
+        bench(conn, args.hospital, args.repeat)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,268 @@
+import json
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+import db
+
+# Any 1-3 of these dimensions compile into a single grouped query over the
+# tenant's patients in the selected date range.
+#
+# Fast approximate mode runs the same grouping over a TABLESAMPLE SYSTEM
+# block sample and scales it back up. Blocks are sampled independently with
+# probability p, so each estimate is the sampled sum / p with variance
+# (1-p)/p^2 * sum over sampled blocks of (block sum)^2; conversion rates use
+# the linearised ratio estimator. Ranges the planner expects to hold fewer
+# than APPROX_MIN_ROWS rows always run exactly.
+
+DIMENSIONS = {
+    "procedure": "COALESCE(procedure, '-')",
+    "iol": "COALESCE(iol, '-')",
+    "doctor": "COALESCE(doctor, '-')",
+    "counsellor": "COALESCE(counsellor, '-')",
+    "city": "COALESCE(city, '-')",
+    "gender": "COALESCE(gender, '-')",
+    "age_band": """CASE
+        WHEN age IS NULL THEN '-'
+        WHEN age <= 20 THEN '0-20'
+        WHEN age <= 40 THEN '21-40'
+        WHEN age <= 60 THEN '41-60'
+        WHEN age <= 80 THEN '61-80'
+        ELSE '80+'
+    END""",
+    "status": "status",
+    "month": "to_char(created_on, 'YYYY-MM')",
+}
+
+LABELS = {
+    "procedure": "Procedure",
+    "iol": "IOL Type",
+    "doctor": "Doctor",
+    "counsellor": "Counsellor",
+    "city": "City",
+    "gender": "Gender",
+    "age_band": "Age Band",
+    "status": "Status",
+    "month": "Month",
+}
+
+MEASURES = ["total", "converted", "conversion_rate", "revenue"]
+
+MAX_DIMENSIONS = 3
+CACHE_ENTRIES = 256
+
+APPROX_MIN_ROWS = int(os.environ.get("APPROX_MIN_ROWS", "2000000"))
+# Rows the sample should hold; the percentage follows from the estimate.
+APPROX_SAMPLE_ROWS = int(os.environ.get("APPROX_SAMPLE_ROWS", "200000"))
+# Fixed so reruns and cache entries see the same blocks.
+SAMPLE_SEED = 7
+# z for the 95% intervals shown next to estimates.
+Z95 = 1.96
+
+# ================== COMPILE ================== #
+
+def check_dims(dims):
+    if not 1 <= len(dims) <= MAX_DIMENSIONS:
+        raise ValueError(f"pick 1 to {MAX_DIMENSIONS} dimensions")
+    unknown = [d for d in dims if d not in DIMENSIONS]
+    if unknown:
+        raise ValueError(f"unknown dimension: {', '.join(unknown)}")
+
+
+def compile_pivot(dims):
+    check_dims(dims)
+    select = ",\n".join(f"{DIMENSIONS[d]} AS {d}" for d in dims)
+    group = ", ".join(str(i + 1) for i in range(len(dims)))
+
+    return f"""
+        SELECT {select},
+               COUNT(*) AS total,
+               COUNT(*) FILTER (WHERE status='Converted') AS converted,
+               COALESCE(SUM(cost) FILTER (WHERE status='Converted'), 0) AS revenue
+        FROM patients
+        WHERE hospital_id=%s
+        AND created_on BETWEEN %s AND %s
+        GROUP BY {group}
+    """
+
+
+def run_pivot(cur, hospital_id, dims, start, end, percent=None):
+    if percent is not None:
+        return run_sampled_pivot(cur, hospital_id, dims, start, end, percent)
+    cur.execute(compile_pivot(dims), (hospital_id, start, end))
+    df = pd.DataFrame(cur.fetchall(), columns=list(dims) + ["total", "converted", "revenue"])
+    df["revenue"] = df["revenue"].astype(float)
+    df["conversion_rate"] = (df["converted"] / df["total"] * 100).round(1) if not df.empty else 0.0
+    return df
+
+# ================== APPROXIMATE ================== #
+
+def estimate_rows(cur, hospital_id, start, end):
+    # The planner's row estimate for the range; planning only, no scan.
+    cur.execute("""
+        EXPLAIN (FORMAT JSON)
+        SELECT 1 FROM patients
+        WHERE hospital_id=%s AND created_on BETWEEN %s AND %s
+    """, (hospital_id, start, end))
+    plan = cur.fetchone()[0]
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return int(plan[0]["Plan"]["Plan Rows"])
+
+
+def sample_percent(cur, hospital_id, start, end):
+    # None means run exactly.
+    rows = estimate_rows(cur, hospital_id, start, end)
+    if rows < APPROX_MIN_ROWS:
+        return None
+    percent = round(100.0 * APPROX_SAMPLE_ROWS / rows, 3)
+    return percent if percent < 50 else None
+
+
+def compile_sampled_pivot(dims):
+    check_dims(dims)
+    select = ",\n".join(f"{DIMENSIONS[d]} AS {d}" for d in dims)
+    names = ", ".join(dims)
+
+    # Block sums per group first (tableoid keeps partitions' blocks apart),
+    # then the sums and squares the estimators need.
+    return f"""
+        WITH blocks AS (
+            SELECT {select},
+                   COUNT(*) AS t,
+                   COUNT(*) FILTER (WHERE status='Converted') AS c,
+                   COALESCE(SUM(cost) FILTER (WHERE status='Converted'), 0) AS r
+            FROM patients TABLESAMPLE SYSTEM (%s) REPEATABLE ({SAMPLE_SEED})
+            WHERE hospital_id=%s
+            AND created_on BETWEEN %s AND %s
+            GROUP BY {", ".join(str(i + 1) for i in range(len(dims)))},
+                     tableoid, (ctid::text::point)[0]
+        )
+        SELECT {names},
+               SUM(t), SUM(c), SUM(r),
+               SUM(t * t), SUM(c * c), SUM(r * r), SUM(t * c),
+               COUNT(*)
+        FROM blocks
+        GROUP BY {names}
+    """
+
+
+def run_sampled_pivot(cur, hospital_id, dims, start, end, percent):
+    cur.execute(compile_sampled_pivot(dims), (percent, hospital_id, start, end))
+    raw = pd.DataFrame(cur.fetchall(), columns=list(dims) + [
+        "t", "c", "r", "tt", "cc", "rr", "tc", "blocks"
+    ])
+
+    p = percent / 100.0
+    scale = (1 - p) / (p * p)
+    sums = raw[["t", "c", "r", "tt", "cc", "rr", "tc"]].astype(float)
+
+    df = raw[list(dims)].copy()
+    df["total"] = (sums["t"] / p).round().astype("int64")
+    df["converted"] = (sums["c"] / p).round().astype("int64")
+    df["revenue"] = sums["r"] / p
+    df["total_ci"] = (Z95 * np.sqrt(scale * sums["tt"])).round()
+    df["converted_ci"] = (Z95 * np.sqrt(scale * sums["cc"])).round()
+    df["revenue_ci"] = Z95 * np.sqrt(scale * sums["rr"])
+
+    rate = sums["c"] / sums["t"]
+    var = scale * (sums["cc"] - 2 * rate * sums["tc"] + rate * rate * sums["tt"]) / (sums["t"] / p) ** 2
+    df["conversion_rate"] = (rate * 100).round(1)
+    df["conversion_rate_ci"] = (Z95 * np.sqrt(var.clip(lower=0)) * 100).round(1)
+    df["sampled_rows"] = raw["t"].astype("int64")
+    return df
+
+# ================== ARCHIVE ================== #
+
+# Parquet column each dimension is bucketed from.
+ARCHIVE_SOURCE = {"age_band": "age", "month": "created_on"}
+
+
+def archived_columns(dims):
+    return sorted({ARCHIVE_SOURCE.get(d, d) for d in dims} | {"status", "cost"})
+
+
+def archived_keys(archived, dim):
+    # pandas equivalent of DIMENSIONS for rows read from the archive.
+    if dim == "age_band":
+        age = pd.to_numeric(archived["age"], errors="coerce")
+        return pd.cut(
+            age, [-np.inf, 20, 40, 60, 80, np.inf],
+            labels=["0-20", "21-40", "41-60", "61-80", "80+"]
+        ).astype(object).where(age.notna(), "-")
+    if dim == "month":
+        return pd.to_datetime(archived["created_on"]).dt.strftime("%Y-%m")
+    if dim == "status":
+        return archived["status"].astype(object)
+    return archived[dim].astype(object).fillna("-")
+
+
+def add_archived(df, dims, archived):
+    # Adds exact counts of archived rows (archived_columns(dims) read for the
+    # same range) to a pivot frame. Sampled frames keep their intervals:
+    # archived rows carry no sampling error.
+    if archived.empty:
+        return df
+    converted = archived["status"] == "Converted"
+    rows = pd.DataFrame({d: archived_keys(archived, d) for d in dims})
+    rows["total"] = 1
+    rows["converted"] = converted.astype("int64")
+    rows["revenue"] = pd.to_numeric(archived["cost"], errors="coerce").fillna(0.0).where(converted, 0.0)
+    counts = rows.groupby(list(dims)).sum().add_prefix("archived_")
+
+    df = df.set_index(list(dims)).join(counts, how="outer")
+    for m in ("total", "converted"):
+        df[m] = df[m].fillna(0).astype("int64") + df[f"archived_{m}"].fillna(0).astype("int64")
+    df["revenue"] = df["revenue"].fillna(0.0).astype(float) + df["archived_revenue"].fillna(0.0)
+    df["conversion_rate"] = (df["converted"] / df["total"] * 100).round(1)
+    for ci in ("total_ci", "converted_ci", "revenue_ci", "conversion_rate_ci", "sampled_rows"):
+        if ci in df.columns:
+            df[ci] = df[ci].fillna(0)
+    return df.drop(columns=list(counts.columns)).reset_index()
+
+# ================== CACHE ================== #
+
+class PivotCache:
+    # LRU of pivot results keyed by tenant, dimensions and date range. Each
+    # hit is revalidated against db.data_version, so a write to the tenant
+    # invalidates its pivots without any explicit hook.
+
+    def __init__(self, max_entries=CACHE_ENTRIES):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def get(self, conn, hospital_id, dims, start, end, percent=None):
+        key = (hospital_id, tuple(dims), start, end, percent)
+
+        with conn.cursor() as cur:
+            version = db.data_version(cur, hospital_id)
+
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry is not None and entry[0] == version:
+                    self._entries.move_to_end(key)
+                    conn.rollback()
+                    return entry[1]
+
+            df = run_pivot(cur, hospital_id, dims, start, end, percent)
+        conn.rollback()
+
+        with self._lock:
+            self._entries[key] = (version, df)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return df
+
+    def entries(self):
+        # Oldest first; the LRU position stands in for a last-used time.
+        with self._lock:
+            return [(key[0], key, e[1], i) for i, (key, e) in enumerate(self._entries.items())]
+
+    def evict(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
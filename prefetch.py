@@ -0,0 +1,326 @@
+import logging
+import os
+import queue
+import threading
+import time
+from collections import defaultdict, deque
+
+import pandas as pd
+import psycopg2
+from psycopg2 import errors
+
+import budgets
+import db
+import scoring
+import worklists
+
+log = logging.getLogger("prefetch")
+
+# Speculative prefetch. After a page renders, the pages a user of that role
+# is most likely to open next are loaded on background connections into
+# PageCache, so the menu switch only has to revalidate (one data_version
+# probe) instead of running the page's queries.
+#
+# The next-page guess comes from NavigationModel: per-role transition counts
+# in this process, seeded with the usual paths. Prefetching is bounded per
+# tenant: one prefetch at a time across all app processes (an advisory lock
+# next to budgets' slots, taken without waiting), PREFETCH_PER_MINUTE runs
+# per tenant and PREFETCH_TIMEOUT_MS per statement. Navigating away cancels
+# the session's queued prefetches and the running query of any that is not
+# for the page just opened.
+
+PREFETCH_WORKERS = int(os.environ.get("PREFETCH_WORKERS", "2"))
+PREFETCH_PAGES = int(os.environ.get("PREFETCH_PAGES", "2"))
+PREFETCH_PER_MINUTE = int(os.environ.get("PREFETCH_PER_MINUTE", "12"))
+PREFETCH_TIMEOUT_MS = int(os.environ.get("PREFETCH_TIMEOUT_MS", "5000"))
+PREFETCH_TTL = int(os.environ.get("PREFETCH_TTL_S", "300"))
+
+# Longest a page waits for an in-flight prefetch of itself before loading.
+INFLIGHT_WAIT = 5
+
+# Next to budgets' TENANT_LOCK_NS/GLOBAL_LOCK_NS and jobs' JOB_LOCK_ID. Each
+# namespace owns the hundred keys above it, since try_slot adds the slot
+# number to it.
+PREFETCH_LOCK_NS = 72410400
+
+# Prior transition counts, so a fresh process already follows the usual
+# paths. Learned counts outweigh them after a handful of clicks.
+DEFAULT_PATHS = {
+    "Dashboard": {"Daily Reminders": 3, "Conversion": 3, "Patients": 2},
+    "Daily Reminders": {"Patients": 3, "Pending": 1},
+    "Conversion": {"Doctors": 3, "Revenue": 1},
+    "Pending": {"Daily Reminders": 2},
+}
+
+PENDING_COLUMNS = [
+    "patient_id","name","phone","procedure","doctor","cost","status","created_on"
+]
+
+DEFAULT_PIVOT = ["doctor", "procedure"]
+
+# ================== PAGE LOADERS ================== #
+
+# Each loader runs the queries behind one page and returns its frames. ctx
+# carries the session's page state (date range, sort order).
+
+def load_conversion(conn, hospital_id, ctx, caches):
+    with conn.cursor() as cur:
+        data = {
+            "conv": db.conversion_by_procedure(cur, hospital_id),
+            "lag_proc": db.conversion_lag(cur, hospital_id, "procedure"),
+            "lag_doc": db.conversion_lag(cur, hospital_id, "doctor"),
+        }
+    conn.rollback()
+    # The pivot has its own cache; warming it is enough.
+    if "start" in ctx and "pivot" in caches:
+        caches["pivot"].get(conn, hospital_id, DEFAULT_PIVOT, ctx["start"], ctx["end"])
+    return data
+
+
+def load_doctors(conn, hospital_id, ctx, caches):
+    with conn.cursor() as cur:
+        data = {"doc": db.doctor_performance(cur, hospital_id)}
+    conn.rollback()
+    return data
+
+
+def load_pending(conn, hospital_id, ctx, caches):
+    return {"pending": db.read_frame(conn, """
+        SELECT patient_id,name,phone,procedure,doctor,cost,status,created_on
+        FROM patients
+        WHERE hospital_id=%s AND status='Pending'
+        ORDER BY created_on DESC
+    """, (hospital_id,), PENDING_COLUMNS)}
+
+
+def load_reminders(conn, hospital_id, ctx, caches):
+    if "models" in caches:
+        scoring.refresh_scores(conn, hospital_id, caches["models"])
+    order = ctx.get("order", "score")
+    return {"order": order, "pending": worklists.load_pending(conn, hospital_id, order)}
+
+
+LOADERS = {
+    "Conversion": load_conversion,
+    "Doctors": load_doctors,
+    "Pending": load_pending,
+    "Daily Reminders": load_reminders,
+}
+
+# ctx entries that change what a loader returns, and so are part of its key.
+VARIANTS = {
+    "Daily Reminders": ("order",),
+}
+
+
+def cache_key(hospital_id, page, ctx):
+    return (hospital_id, page) + tuple(ctx.get(k) for k in VARIANTS.get(page, ()))
+
+
+def copy_frames(data):
+    return {k: v.copy() if isinstance(v, pd.DataFrame) else v for k, v in data.items()}
+
+# ================== NAVIGATION ================== #
+
+class NavigationModel:
+
+    def __init__(self, priors=DEFAULT_PATHS):
+        self._lock = threading.Lock()
+        self._counts = defaultdict(lambda: defaultdict(lambda: defaultdict(int)))
+        self.priors = priors
+
+    def record(self, role, from_page, to_page):
+        if from_page and from_page != to_page:
+            with self._lock:
+                self._counts[role][from_page][to_page] += 1
+
+    def next_pages(self, role, page, allowed, k=PREFETCH_PAGES):
+        with self._lock:
+            learned = dict(self._counts[role][page])
+        scores = dict(self.priors.get(page, {}))
+        for target, n in learned.items():
+            scores[target] = scores.get(target, 0) + n
+        ranked = sorted(scores, key=scores.get, reverse=True)
+        return [p for p in ranked if p != page and p in allowed and p in LOADERS][:k]
+
+# ================== CACHE ================== #
+
+class Task:
+
+    def __init__(self, session_key, key, page, ctx):
+        self.session_key = session_key
+        self.key = key
+        self.hospital_id = key[0]
+        self.page = page
+        self.ctx = ctx
+        self.cancelled = False
+        self.conn = None
+        self.done = threading.Event()
+
+
+class PageCache:
+    # Page frames keyed by tenant and page, revalidated against
+    # db.data_version on every read like pivot.PivotCache. Frames are
+    # copied on the way out because pages add columns to them.
+
+    def __init__(self, db_url, caches=None, workers=PREFETCH_WORKERS):
+        self.db_url = db_url
+        self.caches = caches or {}
+        self.navigation = NavigationModel()
+        self.queue = queue.Queue()
+
+        self._lock = threading.Lock()
+        self._entries = {}                  # cache_key -> (version, loaded_at, data)
+        self._inflight = {}                 # cache_key -> Task
+        self._sessions = defaultdict(list)  # session key -> [Task]
+        self._runs = defaultdict(deque)     # hid -> prefetch starts in the last minute
+        self._stats = defaultdict(int)
+
+        for n in range(workers):
+            threading.Thread(target=self.work, name=f"prefetch-{n}", daemon=True).start()
+
+    def navigate(self, session_key, role, from_page, page):
+        # A menu switch: learn it and drop whatever this session had queued
+        # for other pages.
+        self.navigation.record(role, from_page, page)
+        with self._lock:
+            tasks = self._sessions.pop(session_key, [])
+        for task in tasks:
+            if task.page == page or task.done.is_set():
+                continue
+            task.cancelled = True
+            self.count("cancelled")
+            if task.conn is not None:
+                try:
+                    task.conn.cancel()
+                except psycopg2.Error:
+                    pass
+
+    def get(self, conn, hospital_id, page, ctx, guard):
+        # guard wraps the page's own load (the tenant query budget); a hit
+        # never needs it.
+        key = cache_key(hospital_id, page, ctx)
+        with self._lock:
+            task = self._inflight.get(key)
+        if task is not None and not task.cancelled:
+            task.done.wait(INFLIGHT_WAIT)
+
+        with conn.cursor() as cur:
+            version = db.data_version(cur, hospital_id)
+        conn.rollback()
+
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is not None and entry[0] == version and time.monotonic() - entry[1] < PREFETCH_TTL:
+            self.count("hits")
+            return copy_frames(entry[2])
+
+        self.count("misses")
+        with guard():
+            data = LOADERS[page](conn, hospital_id, ctx, self.caches)
+        self.store(key, version, data)
+        return copy_frames(data)
+
+    def schedule(self, session_key, hospital_id, role, page, allowed, contexts):
+        # contexts: page -> ctx the session would open that page with.
+        for target in self.navigation.next_pages(role, page, allowed):
+            ctx = contexts.get(target, {})
+            key = cache_key(hospital_id, target, ctx)
+            with self._lock:
+                entry = self._entries.get(key)
+                if key in self._inflight:
+                    continue
+                # Recent entries are left for get() to revalidate.
+                if entry is not None and time.monotonic() - entry[1] < PREFETCH_TTL / 2:
+                    continue
+                task = self._inflight[key] = Task(session_key, key, target, ctx)
+                pending = [t for t in self._sessions[session_key] if not t.done.is_set()]
+                self._sessions[session_key] = pending + [task]
+            self.queue.put(task)
+
+    def store(self, key, version, data):
+        now = time.monotonic()
+        with self._lock:
+            self._entries[key] = (version, now, data)
+            for k in [k for k, e in self._entries.items() if now - e[1] >= PREFETCH_TTL]:
+                del self._entries[k]
+
+    def entries(self):
+        with self._lock:
+            return [(key[0], key, e[2], e[1]) for key, e in self._entries.items()]
+
+    def evict(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def count(self, name):
+        with self._lock:
+            self._stats[name] += 1
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats, cached=len(self._entries), queued=self.queue.qsize())
+
+    def allow(self, hospital_id):
+        now = time.monotonic()
+        with self._lock:
+            runs = self._runs[hospital_id]
+            while runs and now - runs[0] > 60:
+                runs.popleft()
+            if len(runs) >= PREFETCH_PER_MINUTE:
+                return False
+            runs.append(now)
+            return True
+
+    def work(self):
+        conn = None
+        while True:
+            task = self.queue.get()
+            try:
+                if task.cancelled or not self.allow(task.hospital_id):
+                    self.count("skipped")
+                    continue
+                if conn is None or conn.closed:
+                    conn = db.connect(self.db_url, PREFETCH_TIMEOUT_MS)
+                self.run(conn, task)
+            except Exception as e:
+                # Cancelled on navigation, over PREFETCH_TIMEOUT_MS, or lost.
+                # Closing also drops the advisory lock if the cancel landed
+                # on its unlock.
+                if not isinstance(e, errors.QueryCanceled):
+                    log.exception("prefetch of %s failed", task.page)
+                if conn is not None:
+                    conn.close()
+                conn = None
+            finally:
+                task.conn = None
+                with self._lock:
+                    if self._inflight.get(task.key) is task:
+                        del self._inflight[task.key]
+                task.done.set()
+
+    def run(self, conn, task):
+        hid = task.hospital_id
+        with conn.cursor() as cur:
+            slot = budgets.try_slot(cur, PREFETCH_LOCK_NS, hid, 1)
+        if slot is None:
+            conn.rollback()
+            self.count("skipped")
+            return
+
+        try:
+            with conn.cursor() as cur:
+                version = db.data_version(cur, hid)
+            conn.rollback()
+            if task.cancelled:
+                return
+            task.conn = conn
+            data = LOADERS[task.page](conn, hid, task.ctx, self.caches)
+            if not task.cancelled:
+                self.store(task.key, version, data)
+                self.count("prefetched")
+        finally:
+            task.conn = None
+            conn.rollback()
+            budgets.release_slots(conn, [(slot, hid)])
+            conn.commit()
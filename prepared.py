@@ -0,0 +1,235 @@
+import argparse
+import re
+import threading
+import time
+import weakref
+
+import psycopg2
+from psycopg2 import errors, extensions
+from dotenv import load_dotenv
+
+# Named server-side prepared statements for the hot per-rerun queries.
+# Modules register their SQL once at import (written with %s placeholders,
+# as for cur.execute) and run it with execute(cur, name, params). Each
+# statement is PREPAREd the first time it runs on a given connection, then
+# reused by name; a replaced connection is a new object and simply prepares
+# again.
+#
+# Postgres switches a prepared statement to a cached generic plan after five
+# executions when that plan is no worse, so planning time stops being paid
+# from then on. "saved_ms" below estimates that from the planning time
+# measured once per statement and backend.
+
+STATEMENTS = {}
+
+PLACEHOLDER = re.compile(r"%s|%%")
+PLANNING = re.compile(r"Planning Time: ([\d.]+) ms")
+
+_lock = threading.Lock()
+_prepared = weakref.WeakKeyDictionary()   # conn -> {name}, gone with the conn
+_stats = {}              # name -> [prepares, executions, planning_ms_total]
+
+
+def register(name, sql):
+    # Returns the name so callers can keep it as a constant.
+    n = 0
+
+    def number(match):
+        nonlocal n
+        if match.group(0) == "%%":
+            return "%"
+        n += 1
+        return f"${n}"
+
+    STATEMENTS[name] = (PLACEHOLDER.sub(number, sql), n)
+    return name
+
+
+def _prepare(cur, name, params, known):
+    sql, _ = STATEMENTS[name]
+    cur.execute(f"PREPARE {name} AS {sql}")
+    # Prepared statements outlive a rollback, so it counts as prepared even
+    # if the EXPLAIN below fails.
+    known.add(name)
+
+    # One EXPLAIN per statement and backend to measure what planning costs.
+    cur.execute(f"EXPLAIN (SUMMARY) EXECUTE {name}({placeholders(name)})", params)
+    plan = "\n".join(row[0] for row in cur.fetchall())
+    match = PLANNING.search(plan)
+
+    with _lock:
+        stat = _stats.setdefault(name, [0, 0, 0.0])
+        stat[0] += 1
+        stat[2] += float(match.group(1)) if match else 0.0
+
+
+def placeholders(name):
+    return ", ".join(["%s"] * STATEMENTS[name][1])
+
+
+def execute(cur, name, params=()):
+    conn = cur.connection
+    with _lock:
+        known = _prepared.setdefault(conn, set())
+
+    was_idle = conn.info.transaction_status == extensions.TRANSACTION_STATUS_IDLE
+
+    if name not in known:
+        _prepare(cur, name, params, known)
+
+    try:
+        cur.execute(f"EXECUTE {name}({placeholders(name)})", params)
+    except errors.InvalidSqlStatementName:
+        # The server dropped it (DISCARD ALL, pooler reset). Retrying is only
+        # safe when nothing else ran in this transaction yet.
+        known.discard(name)
+        if not was_idle:
+            raise
+        conn.rollback()
+        _prepare(cur, name, params, known)
+        cur.execute(f"EXECUTE {name}({placeholders(name)})", params)
+
+    with _lock:
+        _stats.setdefault(name, [0, 0, 0.0])[1] += 1
+
+
+def stats():
+    # One row per statement: prepares, executions, planning ms and an
+    # estimate of planning ms saved by reuse.
+    with _lock:
+        rows = []
+        for name, (prepares, executions, planning) in sorted(_stats.items()):
+            avg = planning / prepares if prepares else 0.0
+            rows.append({
+                "statement": name,
+                "prepares": prepares,
+                "executions": executions,
+                "planning_ms": round(avg, 3),
+                "saved_ms": round(max(executions - prepares, 0) * avg, 1),
+            })
+        return rows
+
+# ================== SESSION CONNECTIONS ================== #
+
+class SessionPool:
+    # Long-lived connections leased to app sessions, so prepared statements
+    # (and the TLS handshake) outlive a single rerun. A lease idle for
+    # longer than idle_seconds goes back to the free list; a session that
+    # returns after that just leases another connection.
+
+    def __init__(self, connect, idle_seconds=300, max_free=4):
+        self.connect = connect
+        self.idle_seconds = idle_seconds
+        self.max_free = max_free
+        self._lock = threading.Lock()
+        self._leases = {}       # session key -> [conn, last_used]
+        self._free = []
+
+    def get(self, session_key, fresh=False):
+        # fresh skips the lease and the free list, for a retry after the
+        # server dropped the previous connection.
+        with self._lock:
+            self._reclaim()
+            lease = self._leases.get(session_key)
+            if not fresh and lease is not None and not lease[0].closed:
+                lease[1] = time.monotonic()
+                return lease[0]
+
+            conn = None
+            while not fresh and self._free and conn is None:
+                candidate = self._free.pop()
+                if not candidate.closed:
+                    conn = candidate
+
+        if conn is None:
+            conn = self.connect()
+
+        with self._lock:
+            self._leases[session_key] = [conn, time.monotonic()]
+        return conn
+
+    def _reclaim(self):
+        now = time.monotonic()
+        for key, (conn, last_used) in list(self._leases.items()):
+            if now - last_used < self.idle_seconds:
+                continue
+            # Never take a connection from under a running query.
+            if conn.info.transaction_status == extensions.TRANSACTION_STATUS_ACTIVE:
+                continue
+            del self._leases[key]
+            if conn.closed:
+                continue
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                conn.close()
+                continue
+            if len(self._free) < self.max_free:
+                self._free.append(conn)
+            else:
+                conn.close()
+
+    def discard(self, session_key):
+        with self._lock:
+            lease = self._leases.pop(session_key, None)
+        if lease is not None and not lease[0].closed:
+            lease[0].close()
+
+    def size(self):
+        with self._lock:
+            return len(self._leases), len(self._free)
+
+# ================== BENCH ================== #
+
+def bench(conn, hospital_id, runs):
+    import worklists
+
+    cases = [
+        ("conversion_by_procedure", (hospital_id, hospital_id)),
+        ("doctor_performance", (hospital_id, hospital_id)),
+        (worklists.PENDING_STATEMENTS["score"], (hospital_id,)),
+    ]
+    for name, params in cases:
+        sql, _ = STATEMENTS[name]
+        plain = sql
+        for i in range(STATEMENTS[name][1], 0, -1):
+            plain = plain.replace(f"${i}", "%s")
+
+        with conn.cursor() as cur:
+            started = time.perf_counter()
+            for _ in range(runs):
+                cur.execute(plain, params)
+                cur.fetchall()
+            plain_ms = (time.perf_counter() - started) / runs * 1000
+
+            started = time.perf_counter()
+            for _ in range(runs):
+                execute(cur, name, params)
+                cur.fetchall()
+            prepared_ms = (time.perf_counter() - started) / runs * 1000
+        conn.rollback()
+
+        print(f"{name:<28} plain {plain_ms:7.2f} ms   prepared {prepared_ms:7.2f} ms")
+
+    for row in stats():
+        print(row)
+
+
+def main():
+    load_dotenv()
+
+    parser = argparse.ArgumentParser(description="Prepared statement registry")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    b = sub.add_parser("bench")
+    b.add_argument("--hospital", type=int, required=True)
+    b.add_argument("--runs", type=int, default=200)
+    args = parser.parse_args()
+
+    import db
+    conn = db.connect()
+    db.ensure_schema(conn)
+    bench(conn, args.hospital, args.runs)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,224 @@
+import argparse
+import csv
+import logging
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import date, datetime
+
+from dotenv import load_dotenv
+from openpyxl import Workbook
+
+import archive
+import db
+
+log = logging.getLogger("reports")
+
+# Daily Patient / Pending / Doctor reports for every hospital, as CSV and
+# XLSX, written under REPORTS_DIR/<date>/hospital_<id>/ with a manifest.
+# Hospitals are spread over a process pool; each worker holds exactly one
+# database connection, so --workers is also the connection budget.
+#
+#   python reports.py run --workers 4
+#   python reports.py run --hospital 3 --date 2026-10-19
+
+REPORTS_DIR = os.environ.get("REPORTS_DIR", "reports")
+REPORT_WORKERS = int(os.environ.get("REPORT_WORKERS", "4"))
+
+# One sheet cannot hold more rows than this; larger reports are CSV only.
+XLSX_MAX_ROWS = 1_048_575
+
+REPORTS = {
+    "patients": (
+        f"""
+        SELECT {db.PATIENT_SELECT}
+        FROM patients
+        WHERE hospital_id=%s
+        ORDER BY created_on DESC
+        """,
+        db.PATIENT_COLUMNS,
+    ),
+    "pending": (
+        """
+        SELECT patient_id, name, phone, procedure, doctor, cost, created_on,
+               current_date - created_on::date AS days
+        FROM patients
+        WHERE hospital_id=%s AND status='Pending'
+        ORDER BY created_on
+        """,
+        ["patient_id","name","phone","procedure","doctor","cost","created_on","days"],
+    ),
+}
+
+# ================== WRITE ================== #
+
+def xlsx_value(value):
+    # openpyxl rejects tz-aware datetimes and pandas missing values.
+    if value is None or (isinstance(value, float) and value != value):
+        return None
+    if hasattr(value, "to_pydatetime"):
+        value = value.to_pydatetime()
+    if isinstance(value, datetime) and value.tzinfo is not None:
+        value = value.replace(tzinfo=None)
+    return value
+
+
+def write_report(chunks, columns, folder, name):
+    # Streams chunks into CSV and a write-only workbook in a single pass.
+    csv_path = os.path.join(folder, f"{name}.csv")
+    xlsx_path = os.path.join(folder, f"{name}.xlsx")
+
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet(name)
+    sheet.append(list(columns))
+
+    rows = 0
+    with open(csv_path, "w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f)
+        writer.writerow(columns)
+        for chunk in chunks:
+            records = chunk.itertuples(index=False, name=None)
+            for record in records:
+                writer.writerow(record)
+                if rows < XLSX_MAX_ROWS:
+                    sheet.append([xlsx_value(v) for v in record])
+                rows += 1
+
+    files = [csv_path]
+    if rows <= XLSX_MAX_ROWS:
+        workbook.save(xlsx_path)
+        files.append(xlsx_path)
+    else:
+        log.warning("%s: %s rows, too many for XLSX; CSV only", csv_path, rows)
+
+    return rows, files
+
+# ================== WORKER ================== #
+
+worker_conn = None
+
+
+def init_worker(db_url):
+    global worker_conn
+    worker_conn = db.connect(db_url)
+
+
+def hospital_reports(hospital_id, report_date, root):
+    started = time.monotonic()
+    folder = os.path.join(root, str(report_date), f"hospital_{hospital_id}")
+    os.makedirs(folder, exist_ok=True)
+
+    entries = []
+    total_rows = 0
+
+    for name, (sql, columns) in REPORTS.items():
+        rows, files = write_report(
+            db.stream_frames(worker_conn, sql, (hospital_id,), columns),
+            columns, folder, name
+        )
+        total_rows += rows
+        entries.extend((name, path, rows) for path in files)
+
+    with worker_conn.cursor() as cur:
+        df_doc = db.doctor_performance(cur, hospital_id)
+    worker_conn.rollback()
+    rows, files = write_report(
+        db.frame_chunks(df_doc), list(df_doc.columns), folder, "doctors"
+    )
+    total_rows += rows
+    entries.extend(("doctors", path, rows) for path in files)
+
+    return {
+        "hospital_id": hospital_id,
+        "rows": total_rows,
+        "seconds": round(time.monotonic() - started, 3),
+        "files": [
+            {
+                "report": name,
+                "file": os.path.relpath(path, os.path.join(root, str(report_date))),
+                "rows": rows,
+                "bytes": os.path.getsize(path),
+                "sha256": archive.sha256_file(path),
+            }
+            for name, path, rows in entries
+        ],
+    }
+
+# ================== RUN ================== #
+
+def run_reports(db_url, hospital_ids=None, report_date=None, workers=REPORT_WORKERS, root=REPORTS_DIR):
+    report_date = report_date or date.today()
+
+    conn = db.connect(db_url)
+    db.ensure_schema(conn)
+    if hospital_ids is None:
+        with conn.cursor() as cur:
+            cur.execute("SELECT id FROM hospitals ORDER BY id")
+            hospital_ids = [x[0] for x in cur.fetchall()]
+    conn.close()
+
+    started = time.monotonic()
+    results = []
+    failed = []
+
+    with ProcessPoolExecutor(
+        max_workers=max(1, min(workers, len(hospital_ids))),
+        initializer=init_worker,
+        initargs=(db_url,)
+    ) as pool:
+        futures = {
+            pool.submit(hospital_reports, hid, report_date, root): hid
+            for hid in hospital_ids
+        }
+        for future in as_completed(futures):
+            hid = futures[future]
+            try:
+                result = future.result()
+            except Exception:
+                log.exception("hospital %s: report failed", hid)
+                failed.append(hid)
+                continue
+            results.append(result)
+            log.info("hospital %s: %s rows in %.2fs (%.0f rows/s)",
+                     hid, result["rows"], result["seconds"],
+                     result["rows"] / result["seconds"] if result["seconds"] else 0)
+
+    elapsed = time.monotonic() - started
+    results.sort(key=lambda r: r["hospital_id"])
+
+    archive.write_manifest({
+        "date": str(report_date),
+        "generated_at": datetime.now().isoformat(timespec="seconds"),
+        "workers": workers,
+        "seconds": round(elapsed, 3),
+        "failed": sorted(failed),
+        "hospitals": results,
+    }, os.path.join(root, str(report_date)))
+
+    rows = sum(r["rows"] for r in results)
+    log.info("%s hospitals, %s rows in %.1fs (%.0f rows/s, %s failed)",
+             len(results), rows, elapsed, rows / elapsed if elapsed else 0, len(failed))
+    return results, failed
+
+# ================== CLI ================== #
+
+def main():
+    load_dotenv()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(name)s %(message)s")
+
+    parser = argparse.ArgumentParser(description="Generate daily hospital reports")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    run = sub.add_parser("run")
+    run.add_argument("--workers", type=int, default=REPORT_WORKERS,
+                     help="worker processes, one DB connection each")
+    run.add_argument("--hospital", type=int, action="append")
+    run.add_argument("--date", type=date.fromisoformat)
+    args = parser.parse_args()
+
+    _, failed = run_reports(os.environ["DB_URL"], args.hospital, args.date, args.workers)
+    if failed:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,374 @@
+import argparse
+import hashlib
+import json
+import logging
+import threading
+import time
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+from dotenv import load_dotenv
+from psycopg2.extras import execute_values
+
+import db
+
+log = logging.getLogger("scoring")
+
+# Conversion likelihood for pending patients, from a per-hospital logistic
+# regression over its own history. Training and scoring are whole-matrix
+# numpy operations; scores are stored in patient_scores with the model
+# version so the Daily Reminders list can be ordered by score in SQL.
+#
+#   python scoring.py train              # nightly: retrain + full rescore
+#   python scoring.py score --hospital 3 # new/changed pending rows only
+#   python scoring.py bench --rows 200000
+
+CATEGORICAL = ["procedure","iol","doctor","counsellor","city"]
+NUMERIC = ["cost","age","days"]
+FEATURE_COLUMNS = CATEGORICAL + NUMERIC
+
+MAX_LEVELS = 30          # most frequent values per category; the rest share a zero column
+MIN_TRAIN_ROWS = 50
+L2 = 1.0
+MAX_ITER = 25
+TOLERANCE = 1e-6
+
+HIGH_SCORE = 0.6
+MEDIUM_SCORE = 0.3
+
+# Days a lead has been open: until conversion for converted rows, until now
+# for pending ones.
+TRAIN_SQL = """
+    SELECT procedure, iol, doctor, counsellor, city, cost, age,
+           date_part('day', COALESCE(converted_on::timestamp, localtimestamp) - created_on) AS days,
+           status = 'Converted' AS converted
+    FROM patients
+    WHERE hospital_id=%s AND status IN ('Pending','Converted')
+"""
+
+# ================== FEATURES ================== #
+
+def numeric_block(df):
+    return np.column_stack([
+        np.log1p(pd.to_numeric(df["cost"], errors="coerce").fillna(0).clip(lower=0).to_numpy(float)),
+        pd.to_numeric(df["age"], errors="coerce").fillna(0).to_numpy(float),
+        np.log1p(pd.to_numeric(df["days"], errors="coerce").fillna(0).clip(lower=0).to_numpy(float)),
+    ])
+
+
+def design_matrix(df, model):
+    n = len(df)
+    width = 1 + len(NUMERIC) + sum(len(v) for v in model["categories"].values())
+    X = np.zeros((n, width))
+    X[:, 0] = 1.0
+
+    num = numeric_block(df)
+    X[:, 1:1 + len(NUMERIC)] = (num - model["mean"]) / model["std"]
+
+    offset = 1 + len(NUMERIC)
+    rows = np.arange(n)
+    for col in CATEGORICAL:
+        levels = model["categories"][col]
+        codes = pd.Categorical(df[col].fillna("-").astype(str), categories=levels).codes
+        known = codes >= 0
+        X[rows[known], offset + codes[known]] = 1.0
+        offset += len(levels)
+    return X
+
+# ================== MODEL ================== #
+
+def fit(df, y, l2=L2, max_iter=MAX_ITER):
+    categories = {
+        col: df[col].fillna("-").astype(str).value_counts().index[:MAX_LEVELS].tolist()
+        for col in CATEGORICAL
+    }
+    num = numeric_block(df)
+    std = num.std(axis=0)
+    model = {
+        "categories": categories,
+        "mean": num.mean(axis=0),
+        "std": np.where(std > 0, std, 1.0),
+    }
+
+    X = design_matrix(df, model)
+    y = np.asarray(y, dtype=float)
+    penalty = np.full(X.shape[1], l2)
+    penalty[0] = 0.0
+
+    # Newton / IRLS with a ridge penalty; converges in a handful of steps.
+    w = np.zeros(X.shape[1])
+    for _ in range(max_iter):
+        p = 1.0 / (1.0 + np.exp(-(X @ w)))
+        grad = X.T @ (p - y) + penalty * w
+        hess = (X * (p * (1 - p))[:, None]).T @ X + np.diag(penalty)
+        step = np.linalg.solve(hess, grad)
+        w -= step
+        if np.abs(step).max() < TOLERANCE:
+            break
+
+    model["coef"] = w
+    return model
+
+
+def predict(model, df):
+    if df.empty:
+        return np.zeros(0)
+    return 1.0 / (1.0 + np.exp(-(design_matrix(df, model) @ model["coef"])))
+
+
+def to_json(model):
+    return {
+        "categories": model["categories"],
+        "mean": model["mean"].tolist(),
+        "std": model["std"].tolist(),
+        "coef": model["coef"].tolist(),
+    }
+
+
+def from_json(data, version):
+    return {
+        "version": version,
+        "categories": data["categories"],
+        "mean": np.array(data["mean"]),
+        "std": np.array(data["std"]),
+        "coef": np.array(data["coef"]),
+    }
+
+
+def auc(y, p):
+    # Rank-based ROC AUC.
+    y = np.asarray(y, dtype=bool)
+    pos, neg = y.sum(), (~y).sum()
+    if not pos or not neg:
+        return float("nan")
+    ranks = pd.Series(p).rank().to_numpy()
+    return (ranks[y].sum() - pos * (pos + 1) / 2) / (pos * neg)
+
+# ================== TRAIN / STORE ================== #
+
+def train(conn, hospital_id):
+    df = db.read_frame(conn, TRAIN_SQL, (hospital_id,), FEATURE_COLUMNS + ["converted"])
+    y = df["converted"].astype(bool).to_numpy()
+    if len(df) < MIN_TRAIN_ROWS or y.all() or not y.any():
+        return None
+
+    started = time.monotonic()
+    model = fit(df, y)
+    train_auc = auc(y, predict(model, df))
+
+    trained_at = datetime.now()
+    digest = hashlib.sha1(model["coef"].tobytes()).hexdigest()[:8]
+    model["version"] = f"{hospital_id}-{trained_at:%Y%m%d%H%M%S}-{digest}"
+
+    with conn.cursor() as cur:
+        cur.execute("""
+            INSERT INTO conversion_models (version, hospital_id, trained_at, rows, auc, model)
+            VALUES (%s,%s,%s,%s,%s,%s)
+        """, (model["version"], hospital_id, trained_at, len(df),
+              None if np.isnan(train_auc) else float(train_auc), json.dumps(to_json(model))))
+        cur.execute("""
+            DELETE FROM conversion_models
+            WHERE hospital_id=%s AND version NOT IN (
+                SELECT version FROM conversion_models
+                WHERE hospital_id=%s ORDER BY trained_at DESC LIMIT 3
+            )
+        """, (hospital_id, hospital_id))
+    conn.commit()
+
+    log.info("hospital %s: trained %s on %s rows in %.2fs (auc %.3f)",
+             hospital_id, model["version"], len(df), time.monotonic() - started, train_auc)
+    return model
+
+
+class ModelCache:
+    # Latest model per hospital, reloaded only when its version changes.
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._models = {}
+
+    def get(self, conn, hospital_id):
+        with conn.cursor() as cur:
+            cur.execute("""
+                SELECT version FROM conversion_models
+                WHERE hospital_id=%s ORDER BY trained_at DESC LIMIT 1
+            """, (hospital_id,))
+            row = cur.fetchone()
+            if row is None:
+                conn.rollback()
+                return None
+
+            with self._lock:
+                model = self._models.get(hospital_id)
+            if model is None or model["version"] != row[0]:
+                cur.execute("SELECT model FROM conversion_models WHERE version=%s", (row[0],))
+                model = from_json(cur.fetchone()[0], row[0])
+                with self._lock:
+                    self._models[hospital_id] = model
+        conn.rollback()
+        return model
+
+# ================== SCORE ================== #
+
+def score_pending(conn, hospital_id, model, full=False):
+    # Scores pending rows that are new, changed since their last score, or
+    # scored by another model version; full=True rescores all of them.
+    where = "" if full else """
+        AND (s.patient_id IS NULL OR s.model_version <> %(version)s
+             OR s.row_updated_at < p.updated_at)
+    """
+    results = []
+    for chunk in db.stream_frames(conn, f"""
+        SELECT p.patient_id, p.updated_at,
+               p.procedure, p.iol, p.doctor, p.counsellor, p.city, p.cost, p.age,
+               date_part('day', localtimestamp - p.created_on) AS days
+        FROM patients p
+        LEFT JOIN patient_scores s
+          ON s.hospital_id = p.hospital_id AND s.patient_id = p.patient_id
+        WHERE p.hospital_id=%(hid)s AND p.status='Pending'
+        {where}
+    """, {"hid": hospital_id, "version": model["version"]},
+            ["patient_id","updated_at"] + FEATURE_COLUMNS):
+        scores = predict(model, chunk)
+        results.extend(zip(chunk["patient_id"], scores.round(4).tolist(), chunk["updated_at"]))
+
+    # Written once the read cursor is done; stream_frames ends its
+    # transaction with a rollback.
+    if results:
+        write_scores(conn, hospital_id, model["version"], results)
+        conn.commit()
+    return len(results)
+
+
+def write_scores(conn, hospital_id, version, rows):
+    with conn.cursor() as cur:
+        execute_values(cur, """
+            INSERT INTO patient_scores (hospital_id, patient_id, score, model_version, row_updated_at)
+            VALUES %s
+            ON CONFLICT (hospital_id, patient_id) DO UPDATE
+            SET score = EXCLUDED.score,
+                model_version = EXCLUDED.model_version,
+                row_updated_at = EXCLUDED.row_updated_at,
+                scored_at = now()
+        """, [(hospital_id, pid, s, version, upd) for pid, s, upd in rows],
+            template="(%s,%s,%s,%s,%s)", page_size=1000)
+
+
+def refresh_scores(conn, hospital_id, models):
+    # Cheap when nothing changed: one model-version lookup and one index probe.
+    model = models.get(conn, hospital_id)
+    if model is None:
+        return 0
+    return score_pending(conn, hospital_id, model)
+
+
+def train_and_score(conn, hospital_id):
+    model = train(conn, hospital_id)
+    if model is None:
+        return 0
+    scored = score_pending(conn, hospital_id, model, full=True)
+    with conn.cursor() as cur:
+        cur.execute("""
+            DELETE FROM patient_scores s
+            WHERE s.hospital_id=%s AND NOT EXISTS (
+                SELECT 1 FROM patients p
+                WHERE p.hospital_id = s.hospital_id AND p.patient_id = s.patient_id
+                AND p.status = 'Pending'
+            )
+        """, (hospital_id,))
+    conn.commit()
+    return scored
+
+
+def priority(score):
+    if score >= HIGH_SCORE:
+        return "High"
+    if score >= MEDIUM_SCORE:
+        return "Medium"
+    return "Low"
+
+# ================== BENCH ================== #
+
+def synthetic(rows, seed=7):
+    rng = np.random.default_rng(seed)
+    df = pd.DataFrame({
+        "procedure": rng.choice(["Cataract","LASIK","Glaucoma","Retina","Cornea","Squint"], rows),
+        "iol": rng.choice(["Monofocal","Multifocal","Toric","-"], rows),
+        "doctor": rng.choice([f"Dr {i}" for i in range(12)], rows),
+        "counsellor": rng.choice([f"C{i}" for i in range(8)], rows),
+        "city": rng.choice([f"City {i}" for i in range(60)], rows),
+        "cost": rng.lognormal(10, 0.6, rows).round(),
+        "age": rng.integers(18, 90, rows),
+        "days": rng.integers(0, 180, rows),
+    })
+    logit = (
+        -0.5
+        + 0.8 * (df["procedure"] == "Cataract")
+        - 0.6 * (df["procedure"] == "Retina")
+        + 0.05 * df["doctor"].str[3:].astype(int)
+        - 0.4 * (np.log1p(df["cost"]) - 10)
+        - 0.015 * df["days"]
+    )
+    y = rng.random(rows) < 1 / (1 + np.exp(-logit))
+    return df, y
+
+
+def bench(rows):
+    df, y = synthetic(rows)
+
+    started = time.perf_counter()
+    model = fit(df, y)
+    fit_s = time.perf_counter() - started
+
+    started = time.perf_counter()
+    p = predict(model, df)
+    score_s = time.perf_counter() - started
+
+    print(f"train: {rows:,} rows in {fit_s:.2f}s ({rows / fit_s:,.0f} rows/s)")
+    print(f"score: {rows:,} rows in {score_s * 1000:.0f} ms ({rows / score_s:,.0f} rows/s)")
+    print(f"auc: {auc(y, p):.3f}")
+
+# ================== CLI ================== #
+
+def main():
+    load_dotenv()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(name)s %(message)s")
+
+    parser = argparse.ArgumentParser(description="Conversion likelihood scoring")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    tr = sub.add_parser("train", help="retrain and rescore all pending")
+    tr.add_argument("--hospital", type=int, action="append")
+    sc = sub.add_parser("score", help="score new/changed pending rows")
+    sc.add_argument("--hospital", type=int, action="append")
+    b = sub.add_parser("bench")
+    b.add_argument("--rows", type=int, default=200_000)
+    args = parser.parse_args()
+
+    if args.cmd == "bench":
+        bench(args.rows)
+        return
+
+    conn = db.connect()
+    db.ensure_schema(conn)
+
+    hospital_ids = args.hospital
+    if hospital_ids is None:
+        with conn.cursor() as cur:
+            cur.execute("SELECT id FROM hospitals ORDER BY id")
+            hospital_ids = [x[0] for x in cur.fetchall()]
+        conn.rollback()
+
+    models = ModelCache()
+    for hospital_id in hospital_ids:
+        started = time.monotonic()
+        if args.cmd == "train":
+            scored = train_and_score(conn, hospital_id)
+        else:
+            scored = refresh_scores(conn, hospital_id, models)
+        log.info("hospital %s: scored %s rows in %.2fs",
+                 hospital_id, scored, time.monotonic() - started)
+
+
+if __name__ == "__main__":
+    main()
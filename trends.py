@@ -0,0 +1,278 @@
+import argparse
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+import plotly.graph_objects as go
+from dotenv import load_dotenv
+
+import archive
+import db
+
+# Advised vs converted patients and converted revenue over time. Buckets
+# come from date_trunc in SQL, so a range of years returns a few hundred
+# rows at most; archived patients are bucketed from their Parquet files the
+# same way. "auto" picks the finest granularity that stays within
+# MAX_POINTS buckets, and a finer choice is downsampled (LTTB) to that many
+# points per series before it reaches Plotly. Frames and figures are cached
+# per tenant, granularity and range, revalidated against db.data_version.
+#
+#   python trends.py bench --hospital 3 --years 5
+
+GRANULARITIES = ["day", "week", "month", "quarter", "year"]
+BUCKET_DAYS = {"day": 1, "week": 7, "month": 30.4, "quarter": 91.3, "year": 365.25}
+
+MAX_POINTS = 180
+CACHE_ENTRIES = 128
+
+# Archived rows are read by created_on; conversions this long after advice
+# still land in range.
+ARCHIVE_LOOKBACK = timedelta(days=365)
+
+COLUMNS = ["bucket", "advised", "converted", "revenue"]
+
+# Advised counts by created_on and conversions by converted_on. Legacy
+# conversions without a converted_on fall back to created_on.
+TREND_SQL = """
+    SELECT bucket,
+           SUM(advised)::bigint AS advised,
+           SUM(converted)::bigint AS converted,
+           SUM(revenue) AS revenue
+    FROM (
+        SELECT date_trunc(%(unit)s, created_on) AS bucket,
+               COUNT(*) AS advised,
+               COUNT(*) FILTER (WHERE status='Converted' AND converted_on IS NULL) AS converted,
+               COALESCE(SUM(cost) FILTER (WHERE status='Converted' AND converted_on IS NULL), 0) AS revenue
+        FROM patients
+        WHERE hospital_id=%(hid)s AND created_on BETWEEN %(start)s AND %(end)s
+        GROUP BY 1
+        UNION ALL
+        SELECT date_trunc(%(unit)s, converted_on), 0, COUNT(*), COALESCE(SUM(cost), 0)
+        FROM patients
+        WHERE hospital_id=%(hid)s AND converted_on BETWEEN %(start)s AND %(end)s
+        GROUP BY 1
+    ) t
+    GROUP BY bucket
+    ORDER BY bucket
+"""
+
+# ================== BUCKETS ================== #
+
+def pick_granularity(start, end, max_points=MAX_POINTS):
+    days = max((end - start).days, 1)
+    for unit in GRANULARITIES:
+        if days / BUCKET_DAYS[unit] <= max_points:
+            return unit
+    return GRANULARITIES[-1]
+
+
+def truncate(values, unit):
+    # pandas equivalent of date_trunc for the archived rows.
+    values = pd.to_datetime(values)
+    if unit == "day":
+        return values.dt.floor("D")
+    if unit == "week":
+        return (values - pd.to_timedelta(values.dt.weekday, unit="D")).dt.floor("D")
+    if unit == "month":
+        return values.dt.to_period("M").dt.start_time
+    if unit == "quarter":
+        return values.dt.to_period("Q").dt.start_time
+    return values.dt.to_period("Y").dt.start_time
+
+
+def archived_buckets(hospital_id, unit, start, end):
+    rows = archive.load_archived(
+        hospital_id, start - ARCHIVE_LOOKBACK, end,
+        ["created_on", "converted_on", "status", "cost"]
+    )
+    if rows.empty:
+        return pd.DataFrame(columns=COLUMNS)
+
+    created = pd.to_datetime(rows["created_on"])
+    converted_on = pd.to_datetime(rows["converted_on"])
+    converted_on = converted_on.where(converted_on.notna(), created)
+    cost = pd.to_numeric(rows["cost"], errors="coerce").fillna(0.0)
+    is_converted = rows["status"] == "Converted"
+
+    advised = rows[(created >= start) & (created <= end)]
+    advised = advised.groupby(truncate(advised["created_on"], unit)).size().rename("advised")
+
+    conv = is_converted & (converted_on >= start) & (converted_on <= end)
+    conv_frame = pd.DataFrame({"bucket": truncate(converted_on[conv], unit), "revenue": cost[conv]})
+    conversions = conv_frame.groupby("bucket").agg(converted=("revenue", "size"), revenue=("revenue", "sum"))
+
+    out = pd.concat([advised, conversions], axis=1).fillna(0)
+    out.index.name = "bucket"
+    return out.reset_index()[COLUMNS]
+
+
+def load_trend(conn, hospital_id, unit, start, end):
+    if unit not in GRANULARITIES:
+        raise ValueError(unit)
+
+    with conn.cursor() as cur:
+        cur.execute(TREND_SQL, {"unit": unit, "hid": hospital_id, "start": start, "end": end})
+        live = pd.DataFrame(cur.fetchall(), columns=COLUMNS)
+    conn.rollback()
+
+    df = pd.concat([live, archived_buckets(hospital_id, unit, start, end)], ignore_index=True)
+    if df.empty:
+        return pd.DataFrame(columns=COLUMNS + ["conversion_rate"])
+
+    df["bucket"] = pd.to_datetime(df["bucket"])
+    df[["advised", "converted"]] = df[["advised", "converted"]].astype("int64")
+    df["revenue"] = df["revenue"].astype(float)
+    df = df.groupby("bucket", as_index=False).sum().sort_values("bucket", ignore_index=True)
+    df["conversion_rate"] = (df["converted"] / df["advised"].where(df["advised"] > 0) * 100).round(1)
+    return df
+
+# ================== DOWNSAMPLING ================== #
+
+def lttb(x, y, threshold):
+    # Largest-Triangle-Three-Buckets: keeps the first and last point and, in
+    # each bucket between, the point that best preserves the line's shape.
+    n = len(x)
+    if threshold >= n or threshold < 3:
+        return np.arange(n)
+
+    xs = x.astype("float64")
+    ys = y.astype("float64")
+    keep = [0]
+    edges = np.linspace(1, n - 1, threshold - 1).astype(int)
+    a = 0
+    for i in range(threshold - 2):
+        lo, hi = edges[i], edges[i + 1]
+        nxt_lo, nxt_hi = edges[i + 1], edges[i + 2] if i + 2 < len(edges) else n
+        avg_x = xs[nxt_lo:nxt_hi].mean()
+        avg_y = ys[nxt_lo:nxt_hi].mean()
+        area = np.abs(
+            (xs[a] - avg_x) * (ys[lo:hi] - ys[a]) - (xs[a] - xs[lo:hi]) * (avg_y - ys[a])
+        )
+        a = lo + int(area.argmax())
+        keep.append(a)
+    keep.append(n - 1)
+    return np.array(keep)
+
+
+def downsample(df, columns, max_points=MAX_POINTS):
+    # Union of the points each series keeps, so every trace stays exact at
+    # the points shown.
+    if len(df) <= max_points:
+        return df
+    x = df["bucket"].to_numpy().astype("int64")
+    keep = set()
+    per_series = max(3, max_points // len(columns))
+    for col in columns:
+        keep.update(lttb(x, df[col].fillna(0).to_numpy(), per_series).tolist())
+    return df.iloc[sorted(keep)].reset_index(drop=True)
+
+# ================== FIGURES ================== #
+
+def figures(df, unit):
+    shown = downsample(df, ["advised", "converted", "revenue"])
+    mode = "lines+markers" if len(shown) <= 60 else "lines"
+
+    counts = go.Figure([
+        go.Scatter(x=shown["bucket"], y=shown["advised"], name="Advised", mode=mode),
+        go.Scatter(x=shown["bucket"], y=shown["converted"], name="Converted", mode=mode),
+    ])
+    counts.update_layout(
+        title=f"Advised vs converted per {unit}", hovermode="x unified",
+        margin=dict(t=50, b=20), legend=dict(orientation="h")
+    )
+
+    revenue = go.Figure([go.Bar(x=shown["bucket"], y=shown["revenue"], name="Revenue")])
+    revenue.update_layout(title=f"Converted revenue per {unit}", margin=dict(t=50, b=20))
+
+    return {"counts": counts, "revenue": revenue, "points": len(shown), "buckets": len(df)}
+
+# ================== CACHE ================== #
+
+class TrendCache:
+    # LRU of trend frames and their figures, keyed like pivot.PivotCache and
+    # revalidated against db.data_version on each read. Figures are shared
+    # between sessions and must not be modified.
+
+    def __init__(self, max_entries=CACHE_ENTRIES):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def get(self, conn, hospital_id, unit, start, end):
+        key = (hospital_id, unit, start, end)
+
+        with conn.cursor() as cur:
+            version = db.data_version(cur, hospital_id)
+        conn.rollback()
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == version:
+                self._entries.move_to_end(key)
+                return entry[1], entry[2]
+
+        df = load_trend(conn, hospital_id, unit, start, end)
+        figs = figures(df, unit) if not df.empty else None
+
+        with self._lock:
+            self._entries[key] = (version, df, figs)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return df, figs
+
+    def entries(self):
+        with self._lock:
+            return [(key[0], key, e[1], i) for i, (key, e) in enumerate(self._entries.items())]
+
+    def evict(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+
+def first_patient(cur, hospital_id):
+    # Earliest created_on, hot or archived, for "all time" ranges.
+    cur.execute("SELECT MIN(created_on) FROM patients WHERE hospital_id=%s", (hospital_id,))
+    first = cur.fetchone()[0]
+    for entry in archive.read_manifest()["files"]:
+        if entry["hospital_id"] == hospital_id:
+            archived = pd.Timestamp(entry["min_created_on"]).to_pydatetime()
+            first = archived if first is None else min(first, archived)
+    return first
+
+# ================== CLI ================== #
+
+def bench(conn, hospital_id, years):
+    end = datetime.now()
+    start = end - timedelta(days=int(365.25 * years))
+    for unit in GRANULARITIES:
+        started = time.perf_counter()
+        df = load_trend(conn, hospital_id, unit, start, end)
+        query_ms = (time.perf_counter() - started) * 1000
+        figs = figures(df, unit) if not df.empty else None
+        payload = len(figs["counts"].to_json()) + len(figs["revenue"].to_json()) if figs else 0
+        print(f"{unit:<8} {len(df):>6} buckets  {query_ms:8.1f} ms  "
+              f"{figs['points'] if figs else 0:>4} points  {payload / 1024:7.1f} KiB")
+    print(f"auto picks: {pick_granularity(start, end)}")
+
+
+def main():
+    load_dotenv()
+
+    parser = argparse.ArgumentParser(description="Conversion trends")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    b = sub.add_parser("bench")
+    b.add_argument("--hospital", type=int, required=True)
+    b.add_argument("--years", type=float, default=5)
+    args = parser.parse_args()
+
+    conn = db.connect()
+    db.ensure_schema(conn)
+    bench(conn, args.hospital, args.years)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,167 @@
+import argparse
+import logging
+import time
+
+import pandas as pd
+from dotenv import load_dotenv
+
+import db
+import prepared
+
+log = logging.getLogger("worklists")
+
+# Snapshot of each hospital's pending follow-ups, rebuilt once a day so the
+# morning Daily Reminders rush reads a small table instead of ageing the
+# whole patients table per session. Schedule it from cron, e.g.
+#
+#   30 0 * * *  cd /srv/ophthalmoai && python worklists.py
+#
+# Converted/deleted patients are removed from the snapshot by the
+# patients_drop_from_worklist trigger; patients added or reopened after the
+# snapshot are picked up live through updated_at.
+
+WORKLIST_COLUMNS = [
+    "patient_id","name","phone","procedure","cost","counsellor","created_on"
+]
+
+SNAPSHOT_SQL = """
+    INSERT INTO reminder_worklist
+    (hospital_id, snapshot_date, patient_id, name, phone, procedure, cost,
+     counsellor, created_on)
+    SELECT hospital_id, current_date, patient_id, name, phone,
+           procedure, cost, counsellor, created_on
+    FROM patients
+    WHERE hospital_id=%s AND status='Pending'
+    ON CONFLICT (hospital_id, snapshot_date, patient_id) DO NOTHING
+"""
+
+# ================== BUILD ================== #
+
+def build_worklist(conn, hospital_id):
+    with conn.cursor() as cur:
+        cur.execute(
+            "DELETE FROM reminder_worklist WHERE hospital_id=%s",
+            (hospital_id,)
+        )
+        cur.execute(SNAPSHOT_SQL, (hospital_id,))
+        rows = cur.rowcount
+        cur.execute("""
+            INSERT INTO reminder_worklist_runs (hospital_id, snapshot_date, taken_at, row_count)
+            VALUES (%s, current_date, now(), %s)
+            ON CONFLICT (hospital_id, snapshot_date)
+            DO UPDATE SET taken_at = EXCLUDED.taken_at, row_count = EXCLUDED.row_count
+        """, (hospital_id, rows))
+        cur.execute(
+            "DELETE FROM reminder_worklist_runs WHERE hospital_id=%s AND snapshot_date < current_date",
+            (hospital_id,)
+        )
+    conn.commit()
+    return rows
+
+
+def build_all(conn, hospital_ids=None):
+    if hospital_ids is None:
+        with conn.cursor() as cur:
+            cur.execute("SELECT id FROM hospitals WHERE subscription='active' ORDER BY id")
+            hospital_ids = [x[0] for x in cur.fetchall()]
+        conn.rollback()
+
+    for hospital_id in hospital_ids:
+        started = time.monotonic()
+        rows = build_worklist(conn, hospital_id)
+        log.info("hospital %s: %s pending rows in %.2fs",
+                 hospital_id, rows, time.monotonic() - started)
+
+# ================== READ ================== #
+
+SCORED_COLUMNS = WORKLIST_COLUMNS + ["score"]
+
+ORDERS = {
+    "newest": "created_on DESC",
+    "score": "score DESC NULLS LAST, created_on DESC",
+}
+
+PENDING_SELECT = ", ".join(f"w.{c}" for c in WORKLIST_COLUMNS) + ", s.score"
+
+PENDING_SCORES = """
+    LEFT JOIN patient_scores s
+      ON s.hospital_id = w.hospital_id AND s.patient_id = w.patient_id
+"""
+
+PENDING_LIVE = f"""
+    SELECT {PENDING_SELECT}
+    FROM patients w
+    {PENDING_SCORES}
+    WHERE w.hospital_id=%s AND w.status='Pending'
+"""
+
+# Rows edited after the snapshot come from the live side only.
+PENDING_SNAPSHOT = f"""
+    SELECT * FROM (
+        SELECT {PENDING_SELECT}
+        FROM reminder_worklist w
+        {PENDING_SCORES}
+        WHERE w.hospital_id=%s AND w.snapshot_date=current_date
+        AND NOT EXISTS (
+            SELECT 1 FROM patients p
+            WHERE p.hospital_id = w.hospital_id AND p.patient_id = w.patient_id
+            AND p.status='Pending' AND p.updated_at > %s
+        )
+        UNION ALL
+        {PENDING_LIVE} AND w.updated_at > %s
+    ) pending
+"""
+
+# Run on every Daily Reminders rerun, so they are prepared statements.
+PENDING_STATEMENTS = {
+    order: prepared.register(f"pending_{order}", PENDING_LIVE + f" ORDER BY {sql}")
+    for order, sql in ORDERS.items()
+}
+SNAPSHOT_STATEMENTS = {
+    order: prepared.register(f"pending_snapshot_{order}", PENDING_SNAPSHOT + f" ORDER BY {sql}")
+    for order, sql in ORDERS.items()
+}
+
+
+def load_pending(conn, hospital_id, order="newest"):
+    # Today's snapshot plus anything that turned Pending after it was taken;
+    # falls back to a live query when the nightly job has not run. Each row
+    # carries its conversion score (see scoring.py), NULL if not yet scored,
+    # and the list comes back already ordered.
+    with conn.cursor() as cur:
+        cur.execute("""
+            SELECT taken_at FROM reminder_worklist_runs
+            WHERE hospital_id=%s AND snapshot_date=current_date
+        """, (hospital_id,))
+        run = cur.fetchone()
+
+        if run is None:
+            prepared.execute(cur, PENDING_STATEMENTS[order], (hospital_id,))
+        else:
+            prepared.execute(
+                cur, SNAPSHOT_STATEMENTS[order],
+                (hospital_id, run[0], hospital_id, run[0])
+            )
+        df = pd.DataFrame(cur.fetchall(), columns=SCORED_COLUMNS)
+    conn.rollback()
+    return df
+
+# ================== CLI ================== #
+
+def main():
+    load_dotenv()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(name)s %(message)s")
+
+    parser = argparse.ArgumentParser(description="Rebuild daily reminder worklists")
+    parser.add_argument("--hospital", type=int, action="append",
+                        help="only rebuild this hospital (repeatable)")
+    args = parser.parse_args()
+
+    conn = db.connect()
+    db.ensure_schema(conn)
+    build_all(conn, args.hospital)
+    db.prune_patient_tombstones(conn)
+
+
+if __name__ == "__main__":
+    main()